@@ -1,8 +1,9 @@
 import os
+import tempfile
 from datetime import datetime, timedelta, timezone
 
 from dotenv import load_dotenv
-from flask import Flask, Response, request
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
 from flask_jwt_extended import (
     JWTManager,
@@ -14,8 +15,16 @@ from flask_jwt_extended import (
 
 from blueprints.episodes import episodes_bp
 from blueprints.podcasts import podcasts_bp
+from blueprints.search import search_bp
+from blueprints.uploads import uploads_bp
 from blueprints.users import users_bp
+from commands import db_cli
 from models import db
+from utils.categories import init_categories
+from utils.images import get_media_cache, init_image_pipeline, init_media_cache
+from utils.pagination import InvalidCursor
+from utils.search import get_search_cache, init_search_cache
+from utils.storage import init_blob_store
 
 
 def create_app(testing=False):
@@ -31,6 +40,65 @@ def create_app(testing=False):
     app.config["JWT_COOKIE_CSRF_PROTECT"] = False
     app.config["JWT_SECRET_KEY"] = os.getenv("JWT_SECRET_KEY")
     app.config["JWT_ACCESS_TOKEN_EXPIRES"] = timedelta(hours=1)
+    # bytes read from the database per chunk when streaming audio
+    app.config["AUDIO_CHUNK_SIZE"] = int(os.getenv("AUDIO_CHUNK_SIZE", 256 * 1024))
+    # media (audio, covers and avatars) live in a blob store, not in postgres
+    if testing:
+        app.config["BLOB_STORE"] = "local"
+        app.config["BLOB_STORE_PATH"] = tempfile.mkdtemp(prefix="gopodcast-blobs-")
+        app.config["UPLOAD_SESSION_PATH"] = tempfile.mkdtemp(
+            prefix="gopodcast-uploads-"
+        )
+    else:
+        app.config["BLOB_STORE"] = os.getenv("BLOB_STORE", "local")
+        app.config["BLOB_STORE_PATH"] = os.getenv(
+            "BLOB_STORE_PATH", os.path.join(app.instance_path, "blobs")
+        )
+        app.config["UPLOAD_SESSION_PATH"] = os.getenv(
+            "UPLOAD_SESSION_PATH", os.path.join(app.instance_path, "uploads")
+        )
+    # resumable uploads not finalized in this time are garbage collected
+    app.config["UPLOAD_SESSION_TTL"] = timedelta(hours=24)
+    # uploads are streamed, this is enforced while the audio is being read
+    app.config["MAX_AUDIO_SIZE"] = int(
+        os.getenv("MAX_AUDIO_SIZE", 500 * 1024 * 1024)
+    )
+    app.config["S3_BUCKET"] = os.getenv("S3_BUCKET")
+    app.config["S3_PREFIX"] = os.getenv("S3_PREFIX", "")
+    app.config["S3_ENDPOINT_URL"] = os.getenv("S3_ENDPOINT_URL")
+    init_blob_store(app)
+    # worker processes generating the thumbnails of covers and avatars,
+    # tests render them inline
+    app.config["IMAGE_WORKERS"] = (
+        0 if testing else int(os.getenv("IMAGE_WORKERS", os.cpu_count() or 1))
+    )
+    app.config["IMAGE_QUEUE_SIZE"] = int(os.getenv("IMAGE_QUEUE_SIZE", 64))
+    # seconds an upload waits for the queue before rendering by itself
+    app.config["IMAGE_QUEUE_TIMEOUT"] = float(os.getenv("IMAGE_QUEUE_TIMEOUT", 5))
+    init_image_pipeline(app)
+    # covers and avatars kept in memory, bounded by their total size
+    app.config["MEDIA_CACHE_SIZE"] = int(
+        os.getenv("MEDIA_CACHE_SIZE", 64 * 1024 * 1024)
+    )
+    app.config["MEDIA_CACHE_ITEM_SIZE"] = int(
+        os.getenv("MEDIA_CACHE_ITEM_SIZE", 2 * 1024 * 1024)
+    )
+    init_media_cache(app)
+    init_categories(app)
+    # "database" reads the names of a similar length from the database,
+    # "bktree" keeps an in-memory metric tree of them in every worker process
+    app.config["SEARCH_BACKEND"] = os.getenv("SEARCH_BACKEND", "database")
+    # ranked results of the fuzzy searches and the rows they show, by number
+    app.config["SEARCH_CACHE_SIZE"] = int(os.getenv("SEARCH_CACHE_SIZE", 1024))
+    app.config["SEARCH_CACHE_ENTITIES"] = int(
+        os.getenv("SEARCH_CACHE_ENTITIES", 10000)
+    )
+    # seconds, bounds how long changes made by other processes go unseen
+    app.config["SEARCH_CACHE_TTL"] = float(os.getenv("SEARCH_CACHE_TTL", 60))
+    init_search_cache(app)
+    # seconds before the autocomplete indexes of every process are rebuilt
+    # with the changes made by the others
+    app.config["AUTOCOMPLETE_TTL"] = float(os.getenv("AUTOCOMPLETE_TTL", 300))
     CORS(
         app,
         origins=[
@@ -41,6 +109,8 @@ def create_app(testing=False):
             os.getenv("FRONTEND_URL"),
         ],
         supports_credentials=True,
+        # cursor of the next page of the searches
+        expose_headers=["X-Next-Cursor"],
     )
     JWTManager(app)
     with app.app_context():
@@ -49,6 +119,9 @@ def create_app(testing=False):
     app.register_blueprint(users_bp)
     app.register_blueprint(podcasts_bp)
     app.register_blueprint(episodes_bp)
+    app.register_blueprint(search_bp)
+    app.register_blueprint(uploads_bp)
+    app.cli.add_command(db_cli)
 
     @app.before_request
     def handle_preflight():
@@ -70,6 +143,22 @@ def create_app(testing=False):
         except (RuntimeError, KeyError):
             return response
 
+    @app.errorhandler(InvalidCursor)
+    def handle_invalid_cursor(e):
+        return jsonify({"error": "Invalid cursor"}), 400
+
+    # the internals of the caches are not for the users to see
+    if testing or app.debug:
+
+        @app.get("/stats")
+        def get_stats():
+            return jsonify(
+                {
+                    "media_cache": get_media_cache().stats(),
+                    "search_cache": get_search_cache().stats(),
+                }
+            )
+
     @app.route("/")
     def hello_world():
         return os.getenv("FRONTEND_URL")
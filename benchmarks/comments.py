@@ -0,0 +1,100 @@
+"""
+Time the comment pages of an episode with many commenters, and count
+their queries. Uses the database of POSTGRES_TEST_URL, whose tables are
+dropped at the end.
+
+    python -m benchmarks.comments --comments 10 100 1000
+"""
+
+import argparse
+import time
+
+from sqlalchemy import event
+
+from app import create_app
+from models import Comment, Episode, Podcast, Reply, User, db
+
+
+def add_comments(episode, start, end, replies):
+    """Comments of different users, each with replies of other users."""
+    for i in range(start, end):
+        users = [
+            User(email=f"{i}-{j}@example.com", username=f"{i}-{j}", password="")
+            for j in range(replies + 1)
+        ]
+        db.session.add_all(users)
+        db.session.flush()
+        comment = Comment(
+            content=f"Comment {i}", id_user=users[0].id, id_episode=episode.id
+        )
+        db.session.add(comment)
+        db.session.flush()
+        db.session.add_all(
+            Reply(content="Reply", id_user=user.id, id_comment=comment.id)
+            for user in users[1:]
+        )
+    db.session.commit()
+
+
+def measure(app, url, repeat):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    client = app.test_client()
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        client.get(url)
+    elapsed = (time.perf_counter() - start) / repeat * 1000
+    event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return elapsed, len(statements) // repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--comments", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--replies", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_app(testing=True)
+    with app.app_context():
+        db.create_all()
+        author = User(email="author@example.com", username="author", password="")
+        db.session.add(author)
+        db.session.flush()
+        podcast = Podcast(
+            name="Podcast", summary="", description="", id_author=author.id
+        )
+        db.session.add(podcast)
+        db.session.flush()
+        episode = Episode(title="Episode", description="", id_podcast=podcast.id)
+        db.session.add(episode)
+        db.session.commit()
+        id_episode = episode.id
+
+    try:
+        created = 0
+        for comments in sorted(args.comments):
+            with app.app_context():
+                episode = db.session.get(Episode, id_episode)
+                add_comments(episode, created, comments, args.replies)
+            created = comments
+            for page in ["", "/comments"]:
+                url = f"/episodes/{id_episode}{page}"
+                elapsed, queries = measure(app, url, args.repeat)
+                print(
+                    f"{comments:>5} comments | {page or '/':<9} | "
+                    f"{elapsed:9.2f} ms | {queries:5} queries"
+                )
+    finally:
+        with app.app_context():
+            db.drop_all()
+
+
+if __name__ == "__main__":
+    main()
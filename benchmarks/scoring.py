@@ -0,0 +1,62 @@
+"""
+Compare the batch scoring of the database candidates with the loop over
+the names calling the Levenshtein distance one by one it replaced.
+
+    python -m benchmarks.scoring --sizes 10000 100000 1000000
+"""
+
+import argparse
+import random
+import time
+
+from benchmarks.search_index import make_query, random_name
+from utils.scoring import batch_distances, top_matches
+from utils.search import MATCH_THRESHOLD, best_matches, match_distance
+
+
+def python_loop(names, query, limit):
+    scored = ((id, match_distance(name, query)) for id, name in enumerate(names))
+    return best_matches([m for m in scored if m[1] is not None], limit)
+
+
+def batch(names, query, limit):
+    distances = batch_distances(query, names, MATCH_THRESHOLD)
+    return top_matches(range(len(names)), distances, MATCH_THRESHOLD, limit)
+
+
+def timed(function, queries):
+    start = time.perf_counter()
+    results = [function(query) for query in queries]
+    return results, (time.perf_counter() - start) / len(queries) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[4, 8, 16])
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    for size in args.sizes:
+        names = [random_name(rng) for _ in range(size)]
+        print(f"{size} names")
+        for length in args.lengths:
+            queries = [make_query(rng, names, length) for _ in range(args.queries)]
+            expected, loop = timed(
+                lambda query: python_loop(names, query, args.limit), queries
+            )
+            found, vectorized = timed(
+                lambda query: batch(names, query, args.limit), queries
+            )
+            assert found == expected, "both must return the same matches"
+            print(
+                f"  query length {length:>2} | loop {loop:9.2f} ms | "
+                f"batch {vectorized:9.2f} ms | speedup {loop / vectorized:6.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Compare the index of SEARCH_BACKEND=bktree with the linear scan of every
+name the search endpoints used to do.
+
+    python -m benchmarks.search_index --sizes 10000 100000 1000000
+
+Names are random two or three word titles, queries are the beginning of
+one of them with a typo, like the ones typed in the search box, of
+several lengths.
+"""
+
+import argparse
+import random
+import string
+import time
+
+from utils.search import MATCH_THRESHOLD, NameIndex, normalized_distance
+
+SYLLABLES = [a + b for a in "bcdfglmnprstv" for b in "aeiou"]
+
+
+def random_name(rng):
+    words = [
+        "".join(rng.choices(SYLLABLES, k=rng.randint(1, 4)))
+        for _ in range(rng.randint(2, 3))
+    ]
+    return " ".join(words)
+
+
+def make_query(rng, names, length):
+    while True:
+        name = rng.choice(names)
+        if len(name) >= length:
+            break
+    query = list(name[:length])
+    query[rng.randrange(length)] = rng.choice(string.ascii_lowercase)
+    return "".join(query)
+
+
+def linear_scan(names, query):
+    return {
+        id: normalized_distance(name, query)
+        for id, name in enumerate(names)
+        if normalized_distance(name, query) <= MATCH_THRESHOLD
+    }
+
+
+def timed(function, queries):
+    start = time.perf_counter()
+    results = [function(query) for query in queries]
+    return results, (time.perf_counter() - start) / len(queries) * 1000
+
+
+def run(size, queries, lengths, limit, rng):
+    names = list({random_name(rng) for _ in range(size)})
+
+    start = time.perf_counter()
+    index = NameIndex()
+    for id, name in enumerate(names):
+        index.add(name, id)
+    build = time.perf_counter() - start
+    print(f"{len(names)} names, index built in {build:.2f} s")
+
+    for length in lengths:
+        batch = [make_query(rng, names, length) for _ in range(queries)]
+        expected, scan = timed(lambda query: linear_scan(names, query), batch)
+        found, search = timed(lambda query: dict(index.search(query)), batch)
+        assert found == expected, "the index must return the same matches"
+        _, page = timed(lambda query: index.search(query, limit), batch)
+        print(
+            f"  query length {length:>2} | scan {scan:9.2f} ms | "
+            f"index {search:9.2f} ms | speedup {scan / search:6.1f}x | "
+            f"first {limit} {page:9.2f} ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[4, 6, 8, 12, 16])
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    for size in args.sizes:
+        run(size, args.queries, args.lengths, args.limit, rng)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,16 @@
-import io
-
-from flask import Blueprint, jsonify, request, send_file
+from flask import Blueprint, current_app, jsonify, request
 from flask_jwt_extended import get_jwt_identity, jwt_required
-from sqlalchemy import select
-from sqlalchemy.orm import undefer
+from sqlalchemy import func, select
+from sqlalchemy.orm import contains_eager, joinedload, selectinload
+from werkzeug.exceptions import RequestEntityTooLarge
 
 from models import Comment, Episode, Podcast, Reply, StreamLater, User, User_episode, db
+from utils.media import media_url, send_byte_range
 from utils.notifications import notify_new_episode
+from utils.pagination import page_response, paginate
+from utils.search import MAX_SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE, text_search_query
+from utils.storage import get_blob_store
+from utils.uploads import StreamingUpload
 
 episodes_bp = Blueprint("episodes_bp", __name__)
 
@@ -21,17 +25,9 @@ def get_episode(id_episode):
     podcast = db.session.scalars(
         select(Podcast).where(Podcast.id == episode.id_podcast)
     ).first()
-    comments = (
-        db.session.scalars(
-            select(Comment)
-            .where(Comment.id_episode == id_episode)
-            .order_by(Comment.created_at)
-            .join(Comment.user)
-            .outerjoin(Comment.replies)
-        )
-        .unique()
-        .all()
-    )
+    comments = db.session.scalars(
+        comments_query(id_episode).order_by(Comment.created_at, Comment.id)
+    ).all()
     user = db.session.scalars(select(User).where(User.id == podcast.id_author)).first()
     return (
         jsonify(
@@ -39,40 +35,15 @@ def get_episode(id_episode):
                 "id": episode.id,
                 "description": episode.description,
                 "title": episode.title,
-                "audio": f"/episodes/{episode.id}/audio",
+                "audio": media_url(
+                    f"/episodes/{episode.id}/audio", episode.audio_checksum
+                ),
                 "id_podcast": episode.id_podcast,
                 "podcast_name": podcast.name,
                 "id_author": podcast.id_author,
                 "author_name": user.username,
                 "tags": episode.get_tags(),
-                "comments": [
-                    {
-                        "id": comment.id,
-                        "id_user": comment.id_user,
-                        "id_episode": comment.id_episode,
-                        "content": comment.content,
-                        "created_at": comment.created_at,
-                        "user": {
-                            "id": comment.user.id,
-                            "username": comment.user.username,
-                        },
-                        "replies": [
-                            {
-                                "id": reply.id,
-                                "id_user": reply.id_user,
-                                "id_comment": reply.id_comment,
-                                "content": reply.content,
-                                "created_at": reply.created_at,
-                                "user": {
-                                    "id": reply.user.id,
-                                    "username": reply.user.username,
-                                },
-                            }
-                            for reply in comment.replies
-                        ],
-                    }
-                    for comment in comments
-                ],
+                "comments": [comment_result(comment) for comment in comments],
             }
         ),
         200,
@@ -86,49 +57,134 @@ def get_replies_of_comment(id_episode, id_comment):
     ).first()
     if not episode:
         return jsonify({"success": False, "error": "Episode not found"}), 404
-    comment = db.session.scalars(
-        select(Comment).where(Comment.id == id_comment)
-    ).first()
+    comment = db.session.scalar(select(Comment.id).where(Comment.id == id_comment))
     if not comment:
         return jsonify({"success": False, "error": "Comment not found"}), 404
+    replies, next_cursor = paginate(
+        select(Reply)
+        .where(Reply.id_comment == id_comment)
+        .options(joinedload(Reply.user)),
+        [Reply.created_at, Reply.id],
+        descending=False,
+    )
+    return page_response([reply_result(reply) for reply in replies], next_cursor), 200
+
+
+def comments_query(id_episode):
+    """
+    The comments of an episode with their replies and the users of both,
+    loaded in two queries (the replies of more than 500 comments take one
+    more query per 500).
+    """
     return (
-        jsonify(
-            [
-                {
-                    "id": reply.id,
-                    "id_user": reply.id_user,
-                    "id_comment": reply.id_comment,
-                    "content": reply.content,
-                    "created_at": reply.created_at,
-                    "user": {
-                        "id": reply.user.id,
-                        "username": reply.user.username,
-                    },
-                }
-                for reply in comment.replies
-            ]
-        ),
-        200,
+        select(Comment)
+        .where(Comment.id_episode == id_episode)
+        .join(Comment.user)
+        .options(
+            contains_eager(Comment.user),
+            selectinload(Comment.replies).joinedload(Reply.user),
+        )
     )
 
 
+def comment_result(comment) -> dict:
+    """A comment and its replies, they have to be loaded with their users."""
+    return {
+        "id": comment.id,
+        "id_user": comment.id_user,
+        "id_episode": comment.id_episode,
+        "content": comment.content,
+        "created_at": comment.created_at.isoformat(),
+        "user": {
+            "id": comment.user.id,
+            "username": comment.user.username,
+        },
+        "replies": [reply_result(reply) for reply in comment.replies],
+    }
+
+
+def reply_result(reply) -> dict:
+    return {
+        "id": reply.id,
+        "id_user": reply.id_user,
+        "id_comment": reply.id_comment,
+        "content": reply.content,
+        "created_at": reply.created_at.isoformat(),
+        "user": {
+            "id": reply.user.id,
+            "username": reply.user.username,
+        },
+    }
+
+
+@episodes_bp.get("/search/episode")
+def search_episode():
+    q = request.args.get("q", "")
+    limit = min(
+        max(request.args.get("limit", default=SEARCH_PAGE_SIZE, type=int), 1),
+        MAX_SEARCH_PAGE_SIZE,
+    )
+    offset = max(request.args.get("offset", default=0, type=int), 0)
+
+    if not q.strip():
+        return jsonify({"mensaje": "q parameter is mandatory"}), 400
+
+    return jsonify(search_episodes(q, limit, offset)), 200
+
+
+def search_episodes(q: str, limit: int, offset: int = 0) -> list:
+    """The episodes matching a text search, from the best ranked."""
+    # the audio (and the vector itself) are deferred, they are not read
+    tsquery = text_search_query(q)
+    rank = func.ts_rank_cd(Episode.search_vector, tsquery)
+    results = db.session.execute(
+        select(Episode, Podcast.name, rank)
+        .join(Podcast, Podcast.id == Episode.id_podcast)
+        .where(Episode.search_vector.op("@@")(tsquery))
+        .order_by(rank.desc(), Episode.id)
+        .limit(limit)
+        .offset(offset)
+    ).all()
+
+    return [
+        {
+            "id": episode.id,
+            "title": episode.title,
+            "description": episode.description,
+            "tags": episode.get_tags(),
+            "audio": media_url(
+                f"/episodes/{episode.id}/audio", episode.audio_checksum
+            ),
+            "id_podcast": episode.id_podcast,
+            "podcast_name": podcast_name,
+            "rank": round(rank, 4),
+        }
+        for episode, podcast_name, rank in results
+    ]
+
+
 @episodes_bp.get("/podcasts/<id_podcast>/episodes")
 def get_episodes_of_podcast(id_podcast):
-    episodes = db.session.scalars(
-        select(Episode).where(Episode.id_podcast == id_podcast)
-    ).all()
+    episodes, next_cursor = paginate(
+        select(Episode).where(Episode.id_podcast == id_podcast),
+        [Episode.created_at, Episode.id],
+        descending=False,
+    )
     return (
-        jsonify(
+        page_response(
             [
                 {
                     "id": episode.id,
                     "description": episode.description,
                     "title": episode.title,
                     "tags": episode.get_tags(),
-                    "audio": f"/episodes/{episode.id}/audio",
+                    "audio": media_url(
+                        f"/episodes/{episode.id}/audio", episode.audio_checksum
+                    ),
                 }
                 for episode in episodes
-            ]
+            ],
+            next_cursor,
         ),
         200,
     )
@@ -136,12 +192,47 @@ def get_episodes_of_podcast(id_podcast):
 
 @episodes_bp.get("/episodes/<id_episode>/audio")
 def get_episode_audio(id_episode):
-    episode = db.session.scalars(
-        select(Episode).options(undefer(Episode.audio)).where(Episode.id == id_episode)
+    # only the size is fetched here, the audio itself is read lazily
+    episode = db.session.execute(
+        select(
+            Episode.id,
+            Episode.audio_key,
+            Episode.audio_size,
+            Episode.audio_checksum,
+            Episode.audio_modified_at,
+            func.length(Episode.audio).label("legacy_size"),
+        ).where(Episode.id == id_episode)
     ).first()
     if not episode:
         return jsonify({"success": False, "error": "Episode not found"}), 404
-    return send_file(io.BytesIO(episode.audio), mimetype="audio/mp3")
+
+    if episode.audio_key is not None:
+        store = get_blob_store()
+        size = episode.audio_size
+
+        def read(offset, length):
+            return store.read(episode.audio_key, offset, length)
+
+    else:  # not moved to the blob store yet
+        size = episode.legacy_size or 0
+
+        def read(offset, length):
+            # substring() is 1-indexed and lets postgres return just the window
+            return db.session.scalar(
+                select(func.substring(Episode.audio, offset + 1, length)).where(
+                    Episode.id == id_episode
+                )
+            )
+
+    return send_byte_range(
+        read,
+        size,
+        request.range,
+        "audio/mp3",
+        current_app.config["AUDIO_CHUNK_SIZE"],
+        episode.audio_checksum,
+        episode.audio_modified_at,
+    )
 
 
 @episodes_bp.get("/episodes/<id_episode>/comments")
@@ -151,48 +242,13 @@ def get_episode_comments(id_episode):
     ).first()
     if not episode:
         return jsonify({"success": False, "error": "Episode not found"}), 404
-    comments = (
-        db.session.scalars(
-            select(Comment)
-            .where(Comment.id_episode == id_episode)
-            .order_by(Comment.created_at)
-            .join(Comment.user)
-            .outerjoin(Comment.replies)
-        )
-        .unique()
-        .all()
+    comments, next_cursor = paginate(
+        comments_query(id_episode),
+        [Comment.created_at, Comment.id],
+        descending=False,
     )
     return (
-        jsonify(
-            [
-                {
-                    "id": comment.id,
-                    "id_user": comment.id_user,
-                    "id_episode": comment.id_episode,
-                    "content": comment.content,
-                    "created_at": comment.created_at,
-                    "user": {
-                        "id": comment.user.id,
-                        "username": comment.user.username,
-                    },
-                    "replies": [
-                        {
-                            "id": reply.id,
-                            "id_user": reply.id_user,
-                            "id_comment": reply.id_comment,
-                            "content": reply.content,
-                            "created_at": reply.created_at,
-                            "user": {
-                                "id": reply.user.id,
-                                "username": reply.user.username,
-                            },
-                        }
-                        for reply in comment.replies
-                    ],
-                }
-                for comment in comments
-            ]
-        ),
+        page_response([comment_result(comment) for comment in comments], next_cursor),
         200,
     )
 
@@ -293,16 +349,24 @@ def delete_comment_replies(id_reply):
 @episodes_bp.post("/podcasts/<id_podcast>/episodes")
 @jwt_required()
 def post_episode(id_podcast):
+    current_user_id = get_jwt_identity()
+
+    # everything that can be checked without the body is checked first
     podcast = db.session.scalars(
-        select(Podcast.id).where(Podcast.id == id_podcast)
+        select(Podcast).where(Podcast.id == id_podcast)
     ).first()
     if not podcast:
         return jsonify({"success": False, "error": "Podcast not found"}), 404
 
-    audio = request.files.get("audio").read()
-    title = request.form.get("title")
-    description = request.form.get("description")
-    tags_str = request.form.get("tags")
+    if str(podcast.id_author) != current_user_id:
+        return jsonify({"error": "User can only edit their own creations"}), 404
+
+    upload = StreamingUpload(request, current_app.config["MAX_AUDIO_SIZE"])
+    try:
+        audio = upload.open_file("audio", required_fields=["title"])
+    except RequestEntityTooLarge:
+        return jsonify({"mensaje": "audio file is too large"}), 413
+    title = upload.form.get("title")
 
     if title == "":
         return jsonify({"mensaje": "title field is mandatory"}), 400
@@ -321,9 +385,30 @@ def post_episode(id_podcast):
             400,
         )
 
-    episode = Episode(
-        audio=audio, title=title, description=description, id_podcast=id_podcast
-    )
+    if audio is None:
+        return jsonify({"mensaje": "audio field is mandatory"}), 400
+
+    # the audio is only read now, straight into the blob store
+    try:
+        blob = get_blob_store().put(audio)
+    except RequestEntityTooLarge:
+        return jsonify({"mensaje": "audio file is too large"}), 413
+    upload.finish()
+    description = upload.form.get("description")
+    tags_str = upload.form.get("tags")
+
+    episode = create_episode(id_podcast, title, description, tags_str, blob)
+    return jsonify(success=True, id=episode.id), 201
+
+
+def create_episode(id_podcast, title, description, tags_str, blob):
+    """
+    Insert a new episode whose audio is already in the blob store and
+    notify the followers of the author. Shared by direct and resumable
+    uploads.
+    """
+    episode = Episode(title=title, description=description, id_podcast=id_podcast)
+    episode.set_audio(blob)
     if tags_str:
         tags = [tag.strip() for tag in tags_str.split("#")]
         episode.set_tags(tags)
@@ -333,7 +418,7 @@ def post_episode(id_podcast):
 
     notify_new_episode(episode, db.session)
 
-    return jsonify(success=True, id=episode.id), 201
+    return episode
 
 
 @episodes_bp.put("/update_current_sec/<id_episode>")
@@ -437,13 +522,7 @@ def delete_episode(id_episode):
 def edit_episode(id_episode):
     current_user_id = get_jwt_identity()
 
-    new_audio = request.files.get("audio")
-    if new_audio:
-        new_audio = new_audio.read()
-    new_title = request.form.get("title")
-    new_description = request.form.get("description")
-    new_tags = request.form.get("tags")
-
+    # everything that can be checked without the body is checked first
     episode = db.session.scalars(
         select(Episode).where(Episode.id == id_episode)
     ).first()
@@ -458,6 +537,13 @@ def edit_episode(id_episode):
     if str(podcast.id_author) != current_user_id:
         return jsonify({"error": "User can only edit their own creations"}), 404
 
+    upload = StreamingUpload(request, current_app.config["MAX_AUDIO_SIZE"])
+    try:
+        new_audio = upload.open_file("audio", required_fields=["title"])
+    except RequestEntityTooLarge:
+        return jsonify({"mensaje": "audio file is too large"}), 413
+    new_title = upload.form.get("title")
+
     if new_title and new_title != "" and new_title != episode.title:
         filtered_episode = (
             db.session.query(Episode)
@@ -478,7 +564,15 @@ def edit_episode(id_episode):
             episode.title = new_title
 
     if new_audio is not None:
-        episode.audio = new_audio
+        try:
+            episode.set_audio(get_blob_store().put(new_audio))
+        except RequestEntityTooLarge:
+            db.session.rollback()
+            return jsonify({"mensaje": "audio file is too large"}), 413
+    upload.finish()
+    new_description = upload.form.get("description")
+    new_tags = upload.form.get("tags")
+
     if new_description:
         episode.description = new_description
     if new_tags:
@@ -493,11 +587,16 @@ def edit_episode(id_episode):
 @jwt_required()
 def get_stream_later():
     current_user_id = get_jwt_identity()
-    stream_later = db.session.scalars(
-        select(StreamLater).filter_by(id_user=current_user_id).join(StreamLater.episode)
-    ).all()
+    stream_later, next_cursor = paginate(
+        select(StreamLater)
+        .filter_by(id_user=current_user_id)
+        .join(StreamLater.episode)
+        .options(contains_eager(StreamLater.episode)),
+        [StreamLater.id_episode],
+        descending=False,
+    )
     return (
-        jsonify(
+        page_response(
             [
                 {
                     "id": entry.episode.id,
@@ -506,7 +605,8 @@ def get_stream_later():
                     "id_podcast": entry.episode.id_podcast,
                 }
                 for entry in stream_later
-            ]
+            ],
+            next_cursor,
         ),
         200,
     )
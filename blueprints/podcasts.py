@@ -1,36 +1,78 @@
 import io
-import os
 
 from flask import Blueprint, jsonify, request, send_file
 from flask_jwt_extended import get_jwt_identity, jwt_required
-from Levenshtein import distance as levenshtein_distance
 from sqlalchemy import func, select
-from sqlalchemy.orm import undefer
-from unidecode import unidecode
+from sqlalchemy.orm import contains_eager, joinedload
 
 from constants.constants import CATEGORIES
 from models import Episode, Favorite, Podcast, User, User_episode, db
+from utils.categories import get_category_image, get_category_list
+from utils.images import (
+    COVER_SIZES,
+    get_image_pipeline,
+    get_media_cache,
+    send_image,
+    store_image,
+)
+from utils.media import add_validators, media_url, not_modified
+from utils.autocomplete import get_autocomplete_index
 from utils.notifications import notify_new_podcast
+from utils.pagination import (
+    MAX_PAGE_SIZE,
+    decode_cursor,
+    encode_cursor,
+    page_response,
+    paginate,
+)
+from utils.search import (
+    MAX_SEARCH_PAGE_SIZE,
+    SEARCH_CURSOR_TYPES,
+    SEARCH_PAGE_SIZE,
+    cached_fuzzy_search,
+    get_search_cache,
+    get_search_index,
+    match_percentage,
+    normalize,
+)
+from utils.storage import get_blob_store
 
 podcasts_bp = Blueprint("podcasts_bp", __name__)
 
 
 @podcasts_bp.get("/podcasts")
 def get_podcasts():
-    limit = request.args.get("limit", default=10, type=int)
-    offset = request.args.get("offset", default=0, type=int)
-    podcasts = db.session.scalars(
-        select(Podcast).join(Podcast.author).limit(limit).offset(offset)
-    ).all()
+    offset = request.args.get("offset", type=int)
+    # newest first, the id breaks the ties of podcasts created at once
+    keys = [Podcast.created_at, Podcast.id]
+    statement = (
+        select(Podcast).join(Podcast.author).options(contains_eager(Podcast.author))
+    )
+
+    if offset is not None and "cursor" not in request.args:  # the old pagination
+        limit = min(
+            max(request.args.get("limit", default=10, type=int), 1), MAX_PAGE_SIZE
+        )
+        podcasts = db.session.scalars(
+            statement.order_by(*[key.desc() for key in keys])
+            .limit(limit)
+            .offset(max(offset, 0))
+        ).all()
+        next_cursor = None
+    else:
+        podcasts, next_cursor = paginate(statement, keys, page_size=10)
+
     return (
-        jsonify(
+        page_response(
             [
                 {
                     "id": podcast.id,
                     "description": podcast.description,
                     "name": podcast.name,
                     "summary": podcast.summary,
-                    "cover": f"/podcasts/{podcast.id}/cover",
+                    "cover": media_url(
+                        f"/podcasts/{podcast.id}/cover", podcast.cover_checksum
+                    ),
                     "id_author": podcast.id_author,
                     "author": {
                         "id": podcast.author.id,
@@ -39,7 +81,8 @@ def get_podcasts():
                     "category": podcast.category,
                 }
                 for podcast in podcasts
-            ]
+            ],
+            next_cursor,
         ),
         200,
     )
@@ -47,7 +90,12 @@ def get_podcasts():
 
 @podcasts_bp.get("/podcasts/<id_podcast>")
 def get_podcast(id_podcast):
-    podcast = db.session.query(Podcast).filter_by(id=id_podcast).first()
+    podcast = (
+        db.session.query(Podcast)
+        .options(joinedload(Podcast.author))
+        .filter_by(id=id_podcast)
+        .first()
+    )
 
     if not podcast:
         return jsonify({"error": "Podcast not found"}), 404
@@ -59,7 +107,9 @@ def get_podcast(id_podcast):
                     "description": podcast.description,
                     "name": podcast.name,
                     "summary": podcast.summary,
-                    "cover": f"/podcasts/{podcast.id}/cover",
+                    "cover": media_url(
+                        f"/podcasts/{podcast.id}/cover", podcast.cover_checksum
+                    ),
                     "id_author": podcast.id_author,
                     "author": {
                         "id": podcast.id_author,
@@ -74,11 +124,16 @@ def get_podcast(id_podcast):
 
 @podcasts_bp.get("/user/created_podcasts/<user_id>")
 def get_podcasts_created_by_user(user_id):
-    # name attribute is unique, so there can only be 1 or 0 matches
-    podcasts = db.session.query(Podcast).filter_by(id_author=user_id).all()
+    podcasts, next_cursor = paginate(
+        select(Podcast)
+        .options(joinedload(Podcast.author))
+        .where(Podcast.id_author == user_id),
+        [Podcast.created_at, Podcast.id],
+        descending=False,
+    )
 
     return (
-        jsonify(
+        page_response(
             [
                 {
                     "id": podcast.id,
@@ -86,14 +141,17 @@ def get_podcasts_created_by_user(user_id):
                         "id": podcast.id_author,
                         "username": podcast.author.username,
                     },
-                    "cover": f"/podcasts/{podcast.id}/cover",
+                    "cover": media_url(
+                        f"/podcasts/{podcast.id}/cover", podcast.cover_checksum
+                    ),
                     "name": podcast.name,
                     "summary": podcast.summary,
                     "description": podcast.description,
                     "category": podcast.category,
                 }
                 for podcast in podcasts
-            ]
+            ],
+            next_cursor,
         ),
         200,
     )
@@ -101,12 +159,25 @@ def get_podcasts_created_by_user(user_id):
 
 @podcasts_bp.get("/podcasts/<id_podcast>/cover")
 def get_podcast_cover(id_podcast):
-    podcast = db.session.scalars(
-        select(Podcast).options(undefer(Podcast.cover)).where(Podcast.id == id_podcast)
-    ).first()
-    if not podcast:
+    response = send_image(
+        "podcast",
+        id_podcast,
+        lambda: db.session.execute(
+            select(
+                Podcast.cover_key.label("key"),
+                Podcast.cover_checksum.label("checksum"),
+                Podcast.cover_modified_at.label("modified_at"),
+                Podcast.cover_mimetype.label("mimetype"),
+                Podcast.cover_renditions.label("renditions"),
+            ).where(Podcast.id == id_podcast)
+        ).first(),
+        lambda: db.session.scalar(
+            select(Podcast.cover).where(Podcast.id == id_podcast)
+        ),
+    )
+    if response is None:
         return jsonify({"success": False, "error": "Podcast not found"}), 404
-    return send_file(io.BytesIO(podcast.cover), mimetype="image/jpeg")
+    return response
 
 
 @podcasts_bp.post("/podcasts")
@@ -114,7 +185,7 @@ def get_podcast_cover(id_podcast):
 def post_podcast():
     current_user_id = get_jwt_identity()
 
-    cover = request.files.get("cover").read()
+    cover = request.files.get("cover")
     name = request.form.get("name")
     summary = request.form.get("summary")
     description = request.form.get("description")
@@ -141,15 +212,21 @@ def post_podcast():
         )
 
     podcast = Podcast(
-        cover=cover,
         name=name,
         summary=summary,
         description=description,
         id_author=current_user_id,
         category=category,
     )
+    blob, mimetype = store_image(get_blob_store(), cover.stream)
+    podcast.set_cover(blob, mimetype)
     db.session.add(podcast)
     db.session.commit()
+    # thumbnails are generated in the background
+    get_image_pipeline().submit(Podcast, podcast.id, "cover", blob, COVER_SIZES)
+    get_search_index(Podcast.normalized_name).put(podcast.id, name)
+    get_autocomplete_index("podcast").put(podcast.id, name)
+    get_search_cache().bump("podcast")
 
     notify_new_podcast(podcast, db.session)
 
@@ -162,8 +239,6 @@ def edit_podcast(id_podcast):
     current_user_id = get_jwt_identity()
 
     new_cover = request.files.get("cover")
-    if new_cover:
-        new_cover = new_cover.read()
     new_name = request.form.get("name")
     new_summary = request.form.get("summary")
     new_description = request.form.get("description")
@@ -202,8 +277,9 @@ def edit_podcast(id_podcast):
         else:
             podcast.name = new_name
 
-    if new_cover is not None:
-        podcast.cover = new_cover
+    if new_cover:
+        blob, mimetype = store_image(get_blob_store(), new_cover.stream)
+        podcast.set_cover(blob, mimetype)
     if new_summary:
         podcast.summary = new_summary
     if new_description:
@@ -212,6 +288,14 @@ def edit_podcast(id_podcast):
         podcast.category = new_category
 
     db.session.commit()
+    if new_name:
+        get_search_index(Podcast.normalized_name).put(podcast.id, podcast.name)
+        get_autocomplete_index("podcast").put(podcast.id, podcast.name)
+        get_search_cache().bump("podcast")
+    get_search_cache().invalidate("podcast", podcast.id)
+    if new_cover:
+        get_media_cache().invalidate(("podcast", id_podcast))
+        get_image_pipeline().submit(Podcast, id_podcast, "cover", blob, COVER_SIZES)
     return jsonify({"message": "Podcast updated successfully"}), 201
 
 
@@ -233,96 +317,87 @@ def delete_podcast(id_podcast):
     # all episodes and other dependencies will be automatically deleted
     # because we set an "on delete cascade" behaviour
 
+    id = podcast.id
     db.session.delete(podcast)
     db.session.commit()
+    get_media_cache().invalidate(("podcast", id_podcast))
+    get_search_index(Podcast.normalized_name).discard(id)
+    get_autocomplete_index("podcast").discard(id)
+    get_search_cache().bump("podcast")
+    get_search_cache().invalidate("podcast", id)
     return jsonify({"success": True}), 200
 
 
 @podcasts_bp.get("/search/podcast/<podcast_name>")
 def search_podcast(podcast_name):
-    # name attribute is unique, so there can only be 1 or 0 matches
-    podcast = db.session.query(Podcast).filter_by(name=podcast_name).first()
+    # uppercase and accents are not considered, so a few podcasts may match
+    podcasts = db.session.scalars(
+        select(Podcast)
+        .options(joinedload(Podcast.author))
+        .where(Podcast.normalized_name == normalize(podcast_name))
+    ).all()
 
-    if podcast:  # perfect match
+    if podcasts:  # perfect match
         return (
             jsonify(
                 [
-                    {
-                        "id": podcast.id,
-                        "description": podcast.description,
-                        "name": podcast.name,
-                        "summary": podcast.summary,
-                        "cover": f"/podcasts/{podcast.id}/cover",
-                        "id_author": podcast.id_author,
-                        "author": {
-                            "id": podcast.id_author,
-                            "username": podcast.author.username,
-                        },
-                        "category": podcast.category,
-                        "match_percentage": 100,
-                    }
+                    {**podcast_search_result(podcast), "match_percentage": 100}
+                    for podcast in podcasts
                 ]
             ),
             201,
         )
 
     else:  # look for partial match
-        plain_podcast_name = unidecode(
-            podcast_name
-        ).lower()  # we do not consider uppercase and accents
-
-        # get all the names of the database
-        names_query = db.session.query(Podcast.name).all()
-        names = [n[0] for n in names_query]
-
-        # compute Levenshtein distance of all of them, keep values above a threshold
-        thr = 0.45
-
-        names_above_thr = {}  # dict with (key,value)=(name,distance)
-        for name in names:
-            plain_name = unidecode(
-                name
-            ).lower()  # we do not consider uppercase and accents
-            # just consider matches with normalized distance above a threshold
-            d = levenshtein_distance(plain_name, plain_podcast_name) / max(
-                len(plain_name), len(plain_podcast_name)
-            )
-            if d <= thr:
-                names_above_thr[name] = d
+        limit = min(
+            max(request.args.get("limit", default=SEARCH_PAGE_SIZE, type=int), 1),
+            MAX_SEARCH_PAGE_SIZE,
+        )
+        cursor = request.args.get("cursor")
+        after = tuple(decode_cursor(cursor, SEARCH_CURSOR_TYPES)) if cursor else None
+
+        # one more match tells whether there is a next page
+        matches = cached_fuzzy_search(
+            db.session,
+            Podcast,
+            Podcast.normalized_name,
+            podcast_name,
+            podcast_search_result,
+            options=[joinedload(Podcast.author)],
+            limit=limit + 1,
+            after=after,
+        )
 
-        if not names_above_thr:
+        if not matches and after is None:
             return jsonify({"message": "No good matches found"}), 404
 
-        # return best matches above the threshold
-        podcasts = (
-            db.session.query(Podcast).filter(Podcast.name.in_(names_above_thr)).all()
-        )
-
         podcast_list = [
-            {
-                "id": podcast.id,
-                "id_author": podcast.id_author,
-                "author": {
-                    "id": podcast.id_author,
-                    "username": podcast.author.username,
-                },
-                "cover": f"/podcasts/{podcast.id}/cover",
-                "name": podcast.name,
-                "summary": podcast.summary,
-                "description": podcast.description,
-                "category": podcast.category,
-                "match_percentage": round(
-                    float((1 - names_above_thr[podcast.name]) * 100), 2
-                ),
-            }
-            for podcast in podcasts
+            {**podcast, "match_percentage": match_percentage(distance)}
+            for podcast, distance in matches[:limit]
         ]
 
-        sorted_podcast_list = sorted(
-            podcast_list, key=lambda x: x["match_percentage"], reverse=True
-        )
-
-        return jsonify(sorted_podcast_list), 200
+        response = jsonify(podcast_list)
+        if len(matches) > limit:
+            podcast, distance = matches[limit - 1]
+            response.headers["X-Next-Cursor"] = encode_cursor([distance, podcast["id"]])
+        return response, 200
+
+
+def podcast_search_result(podcast):
+    """A podcast found by a search, its author has to be loaded."""
+    return {
+        "id": podcast.id,
+        "id_author": podcast.id_author,
+        "author": {
+            "id": podcast.id_author,
+            "username": podcast.author.username,
+        },
+        "cover": media_url(f"/podcasts/{podcast.id}/cover", podcast.cover_checksum),
+        "name": podcast.name,
+        "summary": podcast.summary,
+        "description": podcast.description,
+        "category": podcast.category,
+    }
 
 
 @podcasts_bp.get("/podcasts/categories/<category>")
@@ -330,14 +405,16 @@ def get_podcasts_of_category(category):
     if category not in CATEGORIES:
         return jsonify({"error": "Category not allowed"}), 401
 
-    podcasts = db.session.scalars(
+    podcasts, next_cursor = paginate(
         select(Podcast)
         .where(Podcast.category == category)
         .join(Podcast.author)
-    ).all()
+        .options(contains_eager(Podcast.author)),
+        [Podcast.created_at, Podcast.id],
+    )
 
     return (
-        jsonify(
+        page_response(
             [
                 {
                     "id": podcast.id,
@@ -346,14 +423,17 @@ def get_podcasts_of_category(category):
                         "id": podcast.id_author,
                         "username": podcast.author.username,
                     },
-                    "cover": f"/podcasts/{podcast.id}/cover",
+                    "cover": media_url(
+                        f"/podcasts/{podcast.id}/cover", podcast.cover_checksum
+                    ),
                     "name": podcast.name,
                     "summary": podcast.summary,
                     "description": podcast.description,
                     "category": podcast.category,
                 }
                 for podcast in podcasts
-            ]
+            ],
+            next_cursor,
         ),
         200,
     )
@@ -361,23 +441,19 @@ def get_podcasts_of_category(category):
 
 @podcasts_bp.get("/categories/images/<filename>")
 def get_image_of_category(filename):
-    return send_file(os.path.join("constants", filename))
+    image = get_category_image(filename)
+    if not image:
+        return jsonify({"error": "Image not found"}), 404
+    response = not_modified(image.checksum, None)
+    if response:
+        return response
+    response = send_file(io.BytesIO(image.data), mimetype=image.mimetype)
+    return add_validators(response, image.checksum, None)
 
 
 @podcasts_bp.get("/categories")
 def get_categories():
-    c = []
-    jpg_categories = ["Deportes", "Entretenimiento", "Música"]
-    for category in CATEGORIES:
-        if category in jpg_categories:
-            ext = ".jpg"
-        else:
-            ext = ".png"
-        c.append(
-            {"image_url": f"/categories/images/{category}" + ext, "title": category}
-        )
-
-    return jsonify(c), 200
+    return jsonify(get_category_list()), 200
 
 
 @podcasts_bp.get("/populars")
@@ -401,7 +477,7 @@ def get_populars():
     stmt = (
         select(
             podcast.c.id,
-            podcast.c.cover,
+            podcast.c.cover_checksum,
             podcast.c.name,
             podcast.c.summary,
             podcast.c.description,
@@ -429,7 +505,9 @@ def get_populars():
                 "description": result.description,
                 "name": result.name,
                 "summary": result.summary,
-                "cover": f"/podcasts/{result.id}/cover",
+                "cover": media_url(
+                    f"/podcasts/{result.id}/cover", result.cover_checksum
+                ),
                 "id_author": result.id_author,
                 "author": {
                     "id": result.id_author,
@@ -446,21 +524,27 @@ def get_populars():
 @jwt_required()
 def get_favorites():
     current_user_id = get_jwt_identity()
-    favorites = db.session.scalars(
+    favorites, next_cursor = paginate(
         select(Favorite)
         .filter_by(id_user=current_user_id)
         .join(Favorite.podcast)
         .join(Podcast.author)
-    ).all()
+        .options(contains_eager(Favorite.podcast).contains_eager(Podcast.author)),
+        [Favorite.id_podcast],
+        descending=False,
+    )
     return (
-        jsonify(
+        page_response(
             [
                 {
                     "id": entry.podcast.id,
                     "name": entry.podcast.name,
                     "description": entry.podcast.description,
                     "summary": entry.podcast.summary,
-                    "cover": f"/podcasts/{entry.podcast.id}/cover",
+                    "cover": media_url(
+                        f"/podcasts/{entry.podcast.id}/cover",
+                        entry.podcast.cover_checksum,
+                    ),
                     "id_author": entry.podcast.id_author,
                     "author": {
                         "id": entry.podcast.author.id,
@@ -469,7 +553,8 @@ def get_favorites():
                     "category": entry.podcast.category,
                 }
                 for entry in favorites
-            ]
+            ],
+            next_cursor,
         ),
         200,
     )
@@ -527,6 +612,7 @@ def post_favorites():
     )
     db.session.add(favorite)
     db.session.commit()
+    get_autocomplete_index("podcast").add_popularity(podcast, 1)
     return jsonify({"success": True}), 201
 
 
@@ -544,6 +630,8 @@ def delete_favorites(id):
             jsonify({"error": "This podcast is not in the favorites list"}),
             404,
         )
+    id_podcast = entry.id_podcast
     db.session.delete(entry)
     db.session.commit()
+    get_autocomplete_index("podcast").add_popularity(id_podcast, -1)
     return jsonify({"success": True}), 200
@@ -0,0 +1,86 @@
+from flask import Blueprint, jsonify, request
+from sqlalchemy.orm import joinedload
+
+from blueprints.episodes import search_episodes
+from blueprints.podcasts import podcast_search_result
+from blueprints.users import user_search_result
+from models import Podcast, User, db
+from utils.autocomplete import (
+    AUTOCOMPLETE_COLUMNS,
+    AUTOCOMPLETE_LIMIT,
+    MAX_AUTOCOMPLETE_LIMIT,
+    get_autocomplete_index,
+)
+from utils.search import fuzzy_search_many, match_percentage
+
+# results of each type returned by /search
+SEARCH_LIMIT = 10
+
+search_bp = Blueprint("search_bp", __name__)
+
+
+@search_bp.get("/autocomplete")
+def autocomplete():
+    q = request.args.get("q", "")
+    type = request.args.get("type")
+    limit = min(
+        max(request.args.get("limit", default=AUTOCOMPLETE_LIMIT, type=int), 1),
+        MAX_AUTOCOMPLETE_LIMIT,
+    )
+
+    if not q.strip():
+        return jsonify({"mensaje": "q parameter is mandatory"}), 400
+    if type is not None and type not in AUTOCOMPLETE_COLUMNS:
+        return jsonify({"mensaje": f"type must be one of {list(AUTOCOMPLETE_COLUMNS)}"}), 400
+
+    # without a type the most popular podcasts and users are mixed
+    suggestions = [
+        {"id": id, "name": name, "type": t, "popularity": popularity}
+        for t in ([type] if type else AUTOCOMPLETE_COLUMNS)
+        for id, name, popularity in get_autocomplete_index(t).complete(
+            db.session, q, limit
+        )
+    ]
+    suggestions.sort(key=lambda s: -s["popularity"])
+    return jsonify(suggestions[:limit]), 200
+
+
+@search_bp.get("/search")
+def search():
+    q = request.args.get("q", "")
+    limit = min(max(request.args.get("limit", default=SEARCH_LIMIT, type=int), 1), 50)
+
+    if not q.strip():
+        return jsonify({"mensaje": "q parameter is mandatory"}), 400
+
+    podcasts, users = fuzzy_search_many(
+        db.session,
+        [
+            (Podcast, Podcast.normalized_name, [joinedload(Podcast.author)]),
+            (User, User.normalized_username, []),
+        ],
+        q,
+        limit=limit,
+    )
+    return (
+        jsonify(
+            {
+                "podcasts": [
+                    {
+                        **podcast_search_result(podcast),
+                        "match_percentage": match_percentage(distance),
+                    }
+                    for podcast, distance in podcasts
+                ],
+                "users": [
+                    {
+                        **user_search_result(user),
+                        "match_percentage": match_percentage(distance),
+                    }
+                    for user, distance in users
+                ],
+                "episodes": search_episodes(q, limit),
+            }
+        ),
+        200,
+    )
@@ -0,0 +1,226 @@
+from datetime import datetime, timezone
+
+from flask import Blueprint, current_app, jsonify, request
+from flask_jwt_extended import get_jwt_identity, jwt_required
+from sqlalchemy import select
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from blueprints.episodes import create_episode
+from models import Episode, Podcast, UploadChunk, UploadSession, db
+from utils.storage import get_blob_store
+from utils.uploads import (
+    ChunkReader,
+    chunk_path,
+    delete_expired_uploads,
+    delete_upload,
+    write_chunk,
+)
+
+uploads_bp = Blueprint("uploads_bp", __name__)
+
+
+def get_own_upload(id_upload):
+    current_user_id = get_jwt_identity()
+    upload = db.session.scalars(
+        select(UploadSession).where(UploadSession.id == id_upload)
+    ).first()
+    if not upload or str(upload.id_user) != current_user_id:
+        return None
+    # it can be garbage collected at any moment
+    if upload.expires_at < datetime.now(timezone.utc):
+        return None
+    return upload
+
+
+def session_expiry():
+    """When a session expires if nothing is received from now on."""
+    return datetime.now(timezone.utc) + current_app.config["UPLOAD_SESSION_TTL"]
+
+
+def upload_status(upload):
+    return {
+        "id": upload.id,
+        "size": upload.size,
+        "received": sum(chunk.size for chunk in upload.chunks),
+        "chunks": [
+            {"index": chunk.index, "offset": chunk.offset, "size": chunk.size}
+            for chunk in upload.chunks
+        ],
+        "expires_at": upload.expires_at.isoformat(),
+    }
+
+
+@uploads_bp.post("/podcasts/<id_podcast>/uploads")
+@jwt_required()
+def create_upload(id_podcast):
+    current_user_id = get_jwt_identity()
+
+    podcast = db.session.scalars(
+        select(Podcast).where(Podcast.id == id_podcast)
+    ).first()
+    if not podcast:
+        return jsonify({"success": False, "error": "Podcast not found"}), 404
+
+    if str(podcast.id_author) != current_user_id:
+        return jsonify({"error": "User can only edit their own creations"}), 404
+
+    data = request.get_json()
+    if not isinstance(data, dict):
+        return jsonify({"mensaje": "the body must be a JSON object"}), 400
+    title = data.get("title")
+    description = data.get("description", "")
+    tags = data.get("tags")
+    size = data.get("size")
+
+    if not title:
+        return jsonify({"mensaje": "title field is mandatory"}), 400
+
+    if not all(isinstance(field, str) for field in [title, description, tags or ""]):
+        return jsonify({"mensaje": "title, description and tags must be text"}), 400
+
+    if not isinstance(size, int) or size <= 0:
+        return jsonify({"mensaje": "size must be a positive number of bytes"}), 400
+
+    if size > current_app.config["MAX_AUDIO_SIZE"]:
+        return jsonify({"mensaje": "audio file is too large"}), 413
+
+    filtered_episode = (
+        db.session.query(Episode).filter_by(id_podcast=id_podcast, title=title).first()
+    )
+
+    if filtered_episode is not None:
+        return (
+            jsonify(
+                {
+                    "mensaje": f"This podcast already has an episode with the title: {title}"
+                }
+            ),
+            400,
+        )
+
+    # a good moment to get rid of the sessions nobody is going to resume
+    delete_expired_uploads(current_app.config["UPLOAD_SESSION_PATH"], db.session)
+
+    upload = UploadSession(
+        id_user=current_user_id,
+        id_podcast=id_podcast,
+        title=title,
+        description=description,
+        size=size,
+        expires_at=session_expiry(),
+        tags=tags,
+    )
+    db.session.add(upload)
+    db.session.commit()
+
+    return jsonify(upload_status(upload)), 201
+
+
+@uploads_bp.get("/uploads/<id_upload>")
+@jwt_required()
+def get_upload(id_upload):
+    upload = get_own_upload(id_upload)
+    if not upload:
+        return jsonify({"error": "Upload not found"}), 404
+    return jsonify(upload_status(upload)), 200
+
+
+@uploads_bp.put("/uploads/<id_upload>/chunks/<int:index>")
+@jwt_required()
+def put_upload_chunk(id_upload, index):
+    upload = get_own_upload(id_upload)
+    if not upload:
+        return jsonify({"error": "Upload not found"}), 404
+
+    offset = request.args.get("offset", type=int)
+    if offset is None or offset < 0 or offset >= upload.size:
+        return jsonify({"error": "Specify a valid offset for the chunk"}), 400
+
+    try:
+        size = write_chunk(
+            current_app.config["UPLOAD_SESSION_PATH"],
+            upload.id,
+            index,
+            request.stream,
+            upload.size - offset,
+        )
+    except RequestEntityTooLarge:
+        return jsonify({"error": "Chunk goes past the size of the upload"}), 413
+
+    # retrying a chunk replaces the previous attempt
+    chunk = db.session.get(UploadChunk, (upload.id, index))
+    if chunk:
+        chunk.offset = offset
+        chunk.size = size
+    else:
+        db.session.add(
+            UploadChunk(id_upload=upload.id, index=index, offset=offset, size=size)
+        )
+    upload.expires_at = session_expiry()
+    db.session.commit()
+
+    return jsonify(upload_status(upload)), 200
+
+
+@uploads_bp.post("/uploads/<id_upload>/finalize")
+@jwt_required()
+def finalize_upload(id_upload):
+    upload = get_own_upload(id_upload)
+    if not upload:
+        return jsonify({"error": "Upload not found"}), 404
+
+    # the chunks must cover the whole file, one after the other
+    parts = []
+    expected_offset = 0
+    for chunk in upload.chunks:
+        if chunk.offset == expected_offset:
+            parts.append(chunk)
+            expected_offset += chunk.size
+    if expected_offset != upload.size:
+        return (
+            jsonify(
+                {
+                    "error": "Upload is incomplete",
+                    "missing_from": expected_offset,
+                    **upload_status(upload),
+                }
+            ),
+            409,
+        )
+
+    filtered_episode = (
+        db.session.query(Episode)
+        .filter_by(id_podcast=upload.id_podcast, title=upload.title)
+        .first()
+    )
+
+    if filtered_episode is not None:
+        return (
+            jsonify(
+                {
+                    "mensaje": f"This podcast already has an episode with the title: {upload.title}"
+                }
+            ),
+            400,
+        )
+
+    root = current_app.config["UPLOAD_SESSION_PATH"]
+    blob = get_blob_store().put(
+        ChunkReader(chunk_path(root, upload.id, chunk.index) for chunk in parts)
+    )
+    episode = create_episode(
+        upload.id_podcast, upload.title, upload.description, upload.tags, blob
+    )
+    delete_upload(root, upload, db.session)
+
+    return jsonify(success=True, id=episode.id), 201
+
+
+@uploads_bp.delete("/uploads/<id_upload>")
+@jwt_required()
+def delete_upload_session(id_upload):
+    upload = get_own_upload(id_upload)
+    if not upload:
+        return jsonify({"error": "Upload not found"}), 404
+    delete_upload(current_app.config["UPLOAD_SESSION_PATH"], upload, db.session)
+    return jsonify({"success": True}), 200
@@ -1,7 +1,6 @@
 import re
-import io
 
-from flask import Blueprint, jsonify, request, send_file
+from flask import Blueprint, jsonify, request
 from flask_jwt_extended import (
     create_access_token,
     get_jwt_identity,
@@ -9,15 +8,27 @@ from flask_jwt_extended import (
     set_access_cookies,
     unset_jwt_cookies,
 )
-from Levenshtein import distance as levenshtein_distance
-from sqlalchemy.orm import undefer
-from unidecode import unidecode
-
 from sqlalchemy import select
+from sqlalchemy.orm import contains_eager
 from werkzeug.security import check_password_hash, generate_password_hash
 
 from constants.constants import CATEGORIES
 from models import Follow, Notification, Podcast, User, db
+from utils.autocomplete import get_autocomplete_index
+from utils.images import AVATAR_SIZES, get_image_pipeline, send_image, store_image
+from utils.media import media_url
+from utils.pagination import decode_cursor, encode_cursor, page_response, paginate
+from utils.search import (
+    MAX_SEARCH_PAGE_SIZE,
+    SEARCH_CURSOR_TYPES,
+    SEARCH_PAGE_SIZE,
+    cached_fuzzy_search,
+    get_search_cache,
+    get_search_index,
+    match_percentage,
+    normalize,
+)
+from utils.storage import get_blob_store
 
 users_bp = Blueprint("users_bp", __name__)
 
@@ -25,7 +36,7 @@ users_bp = Blueprint("users_bp", __name__)
 @users_bp.post("/user")
 def create_user():
     username = request.form.get("username")
-    image = request.files.get("image").read()
+    image = request.files.get("image")
     email = request.form.get("email")
     password = request.form.get("password")
 
@@ -66,12 +77,17 @@ def create_user():
     # Create a new user
     new_user = User(
         username=username,
-        image=image,
         email=email,
         password=generate_password_hash(password)
     )
+    blob, mimetype = store_image(get_blob_store(), image.stream)
+    new_user.set_image(blob, mimetype)
     db.session.add(new_user)
     db.session.commit()
+    get_image_pipeline().submit(User, new_user.id, "image", blob, AVATAR_SIZES)
+    get_search_index(User.normalized_username).put(new_user.id, username)
+    get_autocomplete_index("user").put(new_user.id, username)
+    get_search_cache().bump("user")
 
     return (
         jsonify({"mensaje": "Usuario " + username + " registrado correctamente"}),
@@ -113,71 +129,64 @@ def protected():
 
 @users_bp.get("/search/user/<username>")
 def search_user(username):
-    # username attribute is unique, so there can only be 1 or 0 matches
-    user = db.session.query(User).filter_by(username=username).first()
+    # uppercase and accents are not considered, so a few users may match
+    users = (
+        db.session.query(User).filter_by(normalized_username=normalize(username)).all()
+    )
 
-    if user:  # perfect match
+    if users:  # perfect match
         return (
             jsonify(
                 [
-                    {
-                        "id": user.id,
-                        "image_url": f"/users/{user.id}/image",
-                        "username": user.username,
-                        "email": user.email,
-                        "verified": user.verified,
-                        "match_percentage": 100,
-                    }
+                    {**user_search_result(user), "match_percentage": 100}
+                    for user in users
                 ]
             ),
             201,
         )
 
     else:  # look for partial match
-        plain_username = unidecode(username).lower() # we do not consider uppercase and accents
-
-        # get all the names of the database
-        names_query = db.session.query(User.username).all()
-        names = [n[0] for n in names_query]
-
-        # compute Levenshtein distance of all of them, keep values above a threshold
-        thr = 0.45
-
-        names_above_thr = {}  # dict with (key,value)=(name,distance)
-        for name in names:
-            plain_name = unidecode(name).lower() # we do not consider uppercase and accents
-            # just consider matches with normalized distance above a threshold
-            d = levenshtein_distance(plain_name, plain_username) / max(
-                len(plain_name), len(plain_username)
-            )
-            if d <= thr:
-                names_above_thr[name] = d
-
-        if not names_above_thr:
-            return jsonify({"message": "No good matches found"}), 404
-
-        # return best matches above the threshold
-        usernames = (
-            db.session.query(User).filter(User.username.in_(names_above_thr)).all()
+        limit = min(
+            max(request.args.get("limit", default=SEARCH_PAGE_SIZE, type=int), 1),
+            MAX_SEARCH_PAGE_SIZE,
         )
+        cursor = request.args.get("cursor")
+        after = tuple(decode_cursor(cursor, SEARCH_CURSOR_TYPES)) if cursor else None
+
+        # one more match tells whether there is a next page
+        matches = cached_fuzzy_search(
+            db.session,
+            User,
+            User.normalized_username,
+            username,
+            user_search_result,
+            limit=limit + 1,
+            after=after,
+        )
+
+        if not matches and after is None:
+            return jsonify({"message": "No good matches found"}), 404
 
         user_list = [
-                    {
-                        "id": user.id,
-                        "image_url": f"/users/{user.id}/image",
-                        "username": user.username,
-                        "email": user.email,
-                        "verified": user.verified,
-                        "match_percentage": round(
-                            float((1 - names_above_thr[user.username]) * 100), 2
-                        ),
-                    }
-                    for user in usernames
-                ]
+            {**user, "match_percentage": match_percentage(distance)}
+            for user, distance in matches[:limit]
+        ]
 
-        sorted_user_list = sorted(user_list, key=lambda x: x["match_percentage"], reverse=True)
+        response = jsonify(user_list)
+        if len(matches) > limit:
+            user, distance = matches[limit - 1]
+            response.headers["X-Next-Cursor"] = encode_cursor([distance, user["id"]])
+        return response, 200
 
-        return jsonify(sorted_user_list), 200
+
+def user_search_result(user):
+    return {
+        "id": user.id,
+        "image_url": media_url(f"/users/{user.id}/image", user.image_checksum),
+        "username": user.username,
+        "email": user.email,
+        "verified": user.verified,
+    }
 
 
 @users_bp.get("/user/<user_id>")
@@ -194,7 +203,7 @@ def get_user(user_id):
         jsonify(
             {
                 "name": user.username,
-                "image_url": f"/users/{user.id}/image",
+                "image_url": media_url(f"/users/{user.id}/image", user.image_checksum),
                 "bio": user.bio,
                 "type": user_type,
             }
@@ -204,12 +213,23 @@ def get_user(user_id):
 
 @users_bp.get("/users/<id_user>/image")
 def get_podcast_cover(id_user):
-    user = db.session.scalars(
-        select(User).options(undefer(User.image)).where(User.id == id_user)
-    ).first()
-    if not user:
+    response = send_image(
+        "user",
+        id_user,
+        lambda: db.session.execute(
+            select(
+                User.image_key.label("key"),
+                User.image_checksum.label("checksum"),
+                User.image_modified_at.label("modified_at"),
+                User.image_mimetype.label("mimetype"),
+                User.image_renditions.label("renditions"),
+            ).where(User.id == id_user)
+        ).first(),
+        lambda: db.session.scalar(select(User.image).where(User.id == id_user)),
+    )
+    if response is None:
         return jsonify({"success": False, "error": "User not found"}), 404
-    return send_file(io.BytesIO(user.image), mimetype="image/jpeg")
+    return response
 
 @users_bp.put("/user/bio")
 @jwt_required()
@@ -227,12 +247,18 @@ def edit_bio():
 @jwt_required()
 def get_follows():
     user_id = get_jwt_identity()
-    follows = db.session.scalars(
-        select(Follow).filter_by(id_follower=user_id).join(Follow.followed)
-    ).all()
+    follows, next_cursor = paginate(
+        select(Follow)
+        .filter_by(id_follower=user_id)
+        .join(Follow.followed)
+        .options(contains_eager(Follow.followed)),
+        [Follow.id_followed],
+        descending=False,
+    )
     return (
-        jsonify(
-            [{"id": f.id_followed, "username": f.followed.username} for f in follows]
+        page_response(
+            [{"id": f.id_followed, "username": f.followed.username} for f in follows],
+            next_cursor,
         ),
         200,
     )
@@ -259,6 +285,7 @@ def post_follows():
     new_follow = Follow(id_follower=current_user_id, id_followed=id)
     db.session.add(new_follow)
     db.session.commit()
+    get_autocomplete_index("user").add_popularity(user.id, 1)
     return jsonify({"success": True}), 201
 
 
@@ -273,8 +300,10 @@ def delete_follows(id):
     ).first()
     if not follow:
         return jsonify({"error": "User not followed"}), 400
+    id_followed = follow.id_followed
     db.session.delete(follow)
     db.session.commit()
+    get_autocomplete_index("user").add_popularity(id_followed, -1)
     return jsonify({"success": True}), 200
 
 
@@ -282,21 +311,21 @@ def delete_follows(id):
 @jwt_required()
 def get_notifications():
     current_user_id = get_jwt_identity()
-    notifications = db.session.scalars(
-        select(Notification)
-        .where(Notification.id_user == current_user_id)
-        .order_by(Notification.created_at.desc())
-    ).all()
-    return jsonify(
+    notifications, next_cursor = paginate(
+        select(Notification).where(Notification.id_user == current_user_id),
+        [Notification.created_at, Notification.id],
+    )
+    return page_response(
         [
             {
                 "id": notification.id,
                 "type": notification.type,
                 "object": notification.object,
-                "created_at": notification.created_at,
+                "created_at": notification.created_at.isoformat(),
             }
             for notification in notifications
-        ]
+        ],
+        next_cursor,
     )
 
 
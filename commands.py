@@ -0,0 +1,273 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import select, text, update
+from sqlalchemy.orm import undefer
+
+from models import Episode, Podcast, User, db, episode_search_vector
+from utils.images import (
+    AVATAR_SIZES,
+    COVER_SIZES,
+    SNIFF_LENGTH,
+    get_image_pipeline,
+    sniff_mimetype,
+)
+from utils.search import normalize
+from utils.storage import get_blob_store
+from utils.uploads import delete_expired_uploads
+
+db_cli = AppGroup("db", help="Database maintenance commands.")
+
+
+def to_timestamptz(table: str, column: str) -> str:
+    """
+    Convert a column that earlier versions created as VARCHAR, text in the
+    session time zone does not sort in time order across DST changes.
+    """
+    return f"""
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns WHERE table_name = '{table}'
+            AND column_name = '{column}' AND data_type = 'character varying'
+    ) THEN
+        ALTER TABLE {table} ALTER COLUMN {column} DROP DEFAULT;
+        ALTER TABLE {table} ALTER COLUMN {column} TYPE TIMESTAMPTZ
+            USING {column}::timestamptz;
+        ALTER TABLE {table} ALTER COLUMN {column} SET DEFAULT now();
+    END IF;
+END
+$$
+"""
+
+
+# db.create_all() only creates missing tables, these statements bring the
+# tables of an existing deployment up to date with the models. They are
+# idempotent, so `flask db upgrade` can be run on every deploy.
+SCHEMA_UPGRADES = [
+    'ALTER TABLE "user" ADD COLUMN IF NOT EXISTS image_key VARCHAR',
+    'ALTER TABLE "user" ADD COLUMN IF NOT EXISTS image_size INTEGER',
+    'ALTER TABLE "user" ADD COLUMN IF NOT EXISTS image_checksum VARCHAR',
+    'ALTER TABLE "user" ADD COLUMN IF NOT EXISTS image_modified_at TIMESTAMPTZ',
+    'ALTER TABLE "user" ADD COLUMN IF NOT EXISTS image_mimetype VARCHAR',
+    'ALTER TABLE "user" ADD COLUMN IF NOT EXISTS image_renditions JSONB',
+    'ALTER TABLE "user" ADD COLUMN IF NOT EXISTS normalized_username VARCHAR',
+    'ALTER TABLE "user" ADD COLUMN IF NOT EXISTS '
+    "normalized_username_length INTEGER",
+    'UPDATE "user" SET normalized_username_length = '
+    "char_length(normalized_username) WHERE normalized_username_length IS NULL",
+    # the trigram indexes could not be used without losing matches
+    "DROP INDEX IF EXISTS user_normalized_username_trgm",
+    "ALTER TABLE podcast ADD COLUMN IF NOT EXISTS created_at "
+    "TIMESTAMPTZ NOT NULL DEFAULT now()",
+    to_timestamptz("podcast", "created_at"),
+    "ALTER TABLE podcast ALTER COLUMN cover DROP NOT NULL",
+    "ALTER TABLE podcast ADD COLUMN IF NOT EXISTS cover_key VARCHAR",
+    "ALTER TABLE podcast ADD COLUMN IF NOT EXISTS cover_size INTEGER",
+    "ALTER TABLE podcast ADD COLUMN IF NOT EXISTS cover_checksum VARCHAR",
+    "ALTER TABLE podcast ADD COLUMN IF NOT EXISTS cover_modified_at TIMESTAMPTZ",
+    "ALTER TABLE podcast ADD COLUMN IF NOT EXISTS cover_mimetype VARCHAR",
+    "ALTER TABLE podcast ADD COLUMN IF NOT EXISTS cover_renditions JSONB",
+    "ALTER TABLE podcast ADD COLUMN IF NOT EXISTS normalized_name VARCHAR",
+    "ALTER TABLE podcast ADD COLUMN IF NOT EXISTS normalized_name_length INTEGER",
+    "UPDATE podcast SET normalized_name_length = char_length(normalized_name) "
+    "WHERE normalized_name_length IS NULL",
+    "DROP INDEX IF EXISTS podcast_normalized_name_trgm",
+    "ALTER TABLE episode ALTER COLUMN audio DROP NOT NULL",
+    "ALTER TABLE episode ALTER COLUMN audio SET STORAGE EXTERNAL",
+    "ALTER TABLE episode ADD COLUMN IF NOT EXISTS audio_key VARCHAR",
+    "ALTER TABLE episode ADD COLUMN IF NOT EXISTS audio_size INTEGER",
+    "ALTER TABLE episode ADD COLUMN IF NOT EXISTS audio_checksum VARCHAR",
+    "ALTER TABLE episode ADD COLUMN IF NOT EXISTS audio_modified_at TIMESTAMPTZ",
+    "ALTER TABLE episode ADD COLUMN IF NOT EXISTS search_vector TSVECTOR",
+    "ALTER TABLE episode ADD COLUMN IF NOT EXISTS created_at "
+    "TIMESTAMPTZ NOT NULL DEFAULT now()",
+    to_timestamptz("episode", "created_at"),
+    to_timestamptz("comment", "created_at"),
+    to_timestamptz("reply", "created_at"),
+    to_timestamptz("notification", "created_at"),
+    # it was naive local time, the conversion takes it as the session's
+    "ALTER TABLE upload_session ALTER COLUMN expires_at TYPE TIMESTAMPTZ",
+]
+
+# indexes of the searches, of the foreign keys and of the orders of the
+# lists, name -> what it indexes. They are built with CREATE INDEX
+# CONCURRENTLY, which does not block the writes to the table meanwhile but
+# can't run in a transaction.
+INDEX_UPGRADES = {
+    "ix_user_normalized_username": '"user" (normalized_username)',
+    "ix_user_normalized_username_length": '"user" (normalized_username_length)',
+    "ix_podcast_normalized_name": "podcast (normalized_name)",
+    "ix_podcast_normalized_name_length": "podcast (normalized_name_length)",
+    "ix_episode_search_vector": "episode USING gin (search_vector)",
+    "ix_podcast_created_at_id": "podcast (created_at, id)",
+    "ix_podcast_id_author_created_at_id": "podcast (id_author, created_at, id)",
+    "ix_podcast_category_created_at_id": "podcast (category, created_at, id)",
+    "ix_episode_id_podcast_created_at_id": "episode (id_podcast, created_at, id)",
+    "ix_section_id_episode": "section (id_episode)",
+    "ix_user_episode_id_user": "user_episode (id_user)",
+    "ix_stream_later_id_user_id_episode": "stream_later (id_user, id_episode)",
+    "ix_favorite_id_user_id_podcast": "favorite (id_user, id_podcast)",
+    "ix_comment_id_user": "comment (id_user)",
+    "ix_comment_id_episode_created_at_id": "comment (id_episode, created_at, id)",
+    "ix_reply_id_user": "reply (id_user)",
+    "ix_reply_id_comment_created_at_id": "reply (id_comment, created_at, id)",
+    "ix_follow_id_followed": "follow (id_followed)",
+    "ix_notification_id_user_created_at_id": "notification (id_user, created_at, id)",
+    "ix_upload_session_id_user": "upload_session (id_user)",
+    "ix_upload_session_id_podcast": "upload_session (id_podcast)",
+}
+
+# (column, its normalized copy)
+NORMALIZED_COLUMNS = [
+    (User.username, User.normalized_username),
+    (Podcast.name, Podcast.normalized_name),
+]
+
+# (model, name of the legacy BYTEA column, sizes of its renditions when it
+# is an image)
+MEDIA_COLUMNS = [
+    (User, "image", AVATAR_SIZES),
+    (Podcast, "cover", COVER_SIZES),
+    (Episode, "audio", None),
+]
+
+
+@db_cli.command("upgrade")
+def upgrade():
+    """Add the columns introduced after the tables were created."""
+    for statement in SCHEMA_UPGRADES:
+        db.session.execute(text(statement))
+    db.session.commit()
+    click.echo(f"Applied {len(SCHEMA_UPGRADES)} schema upgrades")
+
+    with db.engine.connect().execution_options(
+        isolation_level="AUTOCOMMIT"
+    ) as connection:
+        # an interrupted concurrent build leaves an invalid index behind
+        invalid = set(
+            connection.scalars(
+                text(
+                    "SELECT c.relname FROM pg_index i "
+                    "JOIN pg_class c ON c.oid = i.indexrelid WHERE NOT i.indisvalid"
+                )
+            )
+        )
+        for name, on in INDEX_UPGRADES.items():
+            if name in invalid:
+                connection.execute(text(f"DROP INDEX CONCURRENTLY {name}"))
+            connection.execute(
+                text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {on}")
+            )
+    click.echo(f"Created {len(INDEX_UPGRADES)} indexes")
+
+    # columns derived in python have to be filled in here
+    for column, normalized in NORMALIZED_COLUMNS:
+        model = column.class_
+        rows = db.session.execute(
+            select(model.id, column).where(normalized.is_(None))
+        ).all()
+        for id, value in rows:
+            name = normalize(value)
+            db.session.execute(
+                update(model)
+                .where(model.id == id)
+                .values({normalized.key: name, f"{normalized.key}_length": len(name)})
+            )
+        db.session.commit()
+        click.echo(f"Normalized {len(rows)} {model.__tablename__} {column.key}s")
+
+    episodes = db.session.execute(
+        select(Episode.id, Episode.title, Episode.description, Episode.tags).where(
+            Episode.search_vector.is_(None)
+        )
+    ).all()
+    for id, title, description, tags in episodes:
+        db.session.execute(
+            update(Episode)
+            .where(Episode.id == id)
+            .values(
+                search_vector=episode_search_vector(
+                    title, description, json.loads(tags) if tags else []
+                )
+            )
+        )
+    db.session.commit()
+    click.echo(f"Indexed {len(episodes)} episodes for search")
+
+
+@db_cli.command("move-blobs")
+@click.option("--batch-size", default=10, help="Rows committed at once.")
+def move_blobs(batch_size):
+    """Move the media still stored in BYTEA columns to the blob store."""
+    store = get_blob_store()
+    pipeline = get_image_pipeline()
+    for model, column, sizes in MEDIA_COLUMNS:
+        legacy = getattr(model, column)
+        key = getattr(model, f"{column}_key")
+        moved = 0
+        while True:
+            # rows are loaded one at a time so only one file is in memory
+            ids = db.session.scalars(
+                select(model.id)
+                .where(legacy.is_not(None), key.is_(None))
+                .limit(batch_size)
+            ).all()
+            if not ids:
+                break
+            images = []
+            for id in ids:
+                entity = db.session.get(model, id, options=[undefer(legacy)])
+                data = getattr(entity, column)
+                blob = store.put_bytes(data)
+                if sizes is None:
+                    getattr(entity, f"set_{column}")(blob)
+                else:
+                    mimetype = sniff_mimetype(data[:SNIFF_LENGTH])
+                    getattr(entity, f"set_{column}")(blob, mimetype)
+                    images.append((id, blob))
+                db.session.flush()
+                db.session.expunge(entity)
+            db.session.commit()
+            # the renditions are only saved for the checksum committed above
+            for id, blob in images:
+                pipeline.submit(model, id, column, blob, sizes)
+            moved += len(ids)
+        click.echo(f"Moved {moved} {model.__tablename__} {column} blobs")
+    pipeline.join()
+
+
+@db_cli.command("gc-uploads")
+def gc_uploads():
+    """Delete the resumable uploads that expired before being finalized."""
+    deleted = delete_expired_uploads(
+        current_app.config["UPLOAD_SESSION_PATH"], db.session
+    )
+    click.echo(f"Deleted {deleted} expired uploads")
+
+
+@db_cli.command("gc-blobs")
+@click.option(
+    "--min-age", default=24, help="Hours a blob is kept after it was written."
+)
+def gc_blobs(min_age):
+    """Delete the media and thumbnails no row refers to any more."""
+    store = get_blob_store()
+    # a blob written meanwhile may belong to a row not committed yet, and
+    # storing the same content again writes the blob again
+    before = datetime.now(timezone.utc) - timedelta(hours=min_age)
+    keys = set(store.keys(before))
+
+    for model, column, sizes in MEDIA_COLUMNS:
+        keys -= set(db.session.scalars(select(getattr(model, f"{column}_key"))))
+        if sizes is not None:
+            for renditions in db.session.scalars(
+                select(getattr(model, f"{column}_renditions"))
+            ):
+                keys -= {rendition["key"] for rendition in (renditions or {}).values()}
+    for key in keys:
+        store.delete(key)
+    click.echo(f"Deleted {len(keys)} unused blobs")
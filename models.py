@@ -1,9 +1,21 @@
 import uuid
+from datetime import datetime, timezone
 from typing import List
 
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import UUID, ForeignKey, PrimaryKeyConstraint, text
-from sqlalchemy.dialects.postgresql import BYTEA, JSONB
+from sqlalchemy import (
+    DDL,
+    UUID,
+    DateTime,
+    ForeignKey,
+    Index,
+    PrimaryKeyConstraint,
+    cast,
+    event,
+    func,
+    text,
+)
+from sqlalchemy.dialects.postgresql import BYTEA, JSONB, REGCONFIG, TSVECTOR
 from sqlalchemy.orm import (
     DeclarativeBase,
     Mapped,
@@ -13,6 +25,8 @@ from sqlalchemy.orm import (
 )
 import json
 
+from utils.search import SEARCH_CONFIGS, normalize
+
 
 class Base(MappedAsDataclass, DeclarativeBase):
     pass
@@ -32,9 +46,35 @@ class User(Base):
     email: Mapped[str] = mapped_column(unique=True)
     username: Mapped[str] = mapped_column(unique=True)
     password: Mapped[str]
+    # unidecode'd and lowercased username, kept in sync with `username`,
+    # what the search compares
+    normalized_username: Mapped[str] = mapped_column(
+        init=False, nullable=True, index=True
+    )
+    # the search only compares names of a length close to the query's
+    normalized_username_length: Mapped[int] = mapped_column(
+        init=False, nullable=True, index=True
+    )
     verified: Mapped[bool] = mapped_column(default=False)
     bio: Mapped[str] = mapped_column(nullable=True, default=None)
+    # legacy storage, moved to the blob store by `flask db move-blobs`
     image: Mapped[bytes] = mapped_column(BYTEA, nullable=True, default=None, deferred=True)
+    image_key: Mapped[str] = mapped_column(nullable=True, default=None)
+    image_size: Mapped[int] = mapped_column(nullable=True, default=None)
+    image_checksum: Mapped[str] = mapped_column(nullable=True, default=None)
+    image_modified_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=True, default=None
+    )
+    image_mimetype: Mapped[str] = mapped_column(nullable=True, default=None)
+    # thumbnails, {size: {"key", "checksum"}}
+    image_renditions: Mapped[dict] = mapped_column(JSONB, nullable=True, default=None)
+
+    def set_image(self, blob, mimetype=None, renditions=None):
+        self.image_key, self.image_size, self.image_checksum = blob
+        self.image_modified_at = datetime.now(timezone.utc)
+        self.image_mimetype = mimetype
+        self.image_renditions = renditions
+        self.image = None
 
 
 class Podcast(Base):
@@ -48,15 +88,70 @@ class Podcast(Base):
         unique=True,
         nullable=False,
     )
-    cover: Mapped[bytes] = mapped_column(BYTEA, deferred=True)
     name: Mapped[str] = mapped_column(unique=True)
     summary: Mapped[str]
     description: Mapped[str]
+    # unidecode'd and lowercased name, kept in sync with `name`, what the
+    # fuzzy search compares
+    normalized_name: Mapped[str] = mapped_column(
+        init=False, nullable=True, index=True
+    )
+    normalized_name_length: Mapped[int] = mapped_column(
+        init=False, nullable=True, index=True
+    )
     id_author: Mapped[uuid.UUID] = mapped_column(
         ForeignKey("user.id", ondelete="CASCADE")
     )
     author: Mapped[User] = relationship(init=False)
     category: Mapped[str] = mapped_column(nullable=True, default=None)
+    # the lists are ordered by it, so it is not text in the session time zone
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        nullable=False,
+        server_default=text("now()"),
+        init=False,
+    )
+    # legacy storage, moved to the blob store by `flask db move-blobs`
+    cover: Mapped[bytes] = mapped_column(BYTEA, nullable=True, default=None, deferred=True)
+    cover_key: Mapped[str] = mapped_column(nullable=True, default=None)
+    cover_size: Mapped[int] = mapped_column(nullable=True, default=None)
+    cover_checksum: Mapped[str] = mapped_column(nullable=True, default=None)
+    cover_modified_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=True, default=None
+    )
+    cover_mimetype: Mapped[str] = mapped_column(nullable=True, default=None)
+    # thumbnails, {size: {"key", "checksum"}}
+    cover_renditions: Mapped[dict] = mapped_column(JSONB, nullable=True, default=None)
+
+    # the orders of the podcast lists
+    __table_args__ = (
+        Index("ix_podcast_created_at_id", "created_at", "id"),
+        Index("ix_podcast_id_author_created_at_id", "id_author", "created_at", "id"),
+        Index("ix_podcast_category_created_at_id", "category", "created_at", "id"),
+    )
+
+    def set_cover(self, blob, mimetype=None, renditions=None):
+        self.cover_key, self.cover_size, self.cover_checksum = blob
+        self.cover_modified_at = datetime.now(timezone.utc)
+        self.cover_mimetype = mimetype
+        self.cover_renditions = renditions
+        self.cover = None
+
+
+@event.listens_for(User.username, "set")
+def normalize_username(user, username, oldvalue, initiator):
+    user.normalized_username = normalize(username) if username is not None else None
+    user.normalized_username_length = (
+        len(user.normalized_username) if username is not None else None
+    )
+
+
+@event.listens_for(Podcast.name, "set")
+def normalize_podcast_name(podcast, name, oldname, initiator):
+    podcast.normalized_name = normalize(name) if name is not None else None
+    podcast.normalized_name_length = (
+        len(podcast.normalized_name) if name is not None else None
+    )
 
 
 class Episode(Base):
@@ -70,14 +165,41 @@ class Episode(Base):
         unique=True,
         nullable=False,
     )
-
-    audio: Mapped[bytes] = mapped_column(BYTEA, deferred=True)
     title: Mapped[str]
     description: Mapped[str]
     id_podcast: Mapped[uuid.UUID] = mapped_column(
         ForeignKey("podcast.id", ondelete="CASCADE")
     )
     tags: Mapped[str] = mapped_column(nullable=True, default=None)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        nullable=False,
+        server_default=text("now()"),
+        init=False,
+    )
+    # legacy storage, moved to the blob store by `flask db move-blobs`
+    audio: Mapped[bytes] = mapped_column(BYTEA, nullable=True, default=None, deferred=True)
+    audio_key: Mapped[str] = mapped_column(nullable=True, default=None)
+    audio_size: Mapped[int] = mapped_column(nullable=True, default=None)
+    audio_checksum: Mapped[str] = mapped_column(nullable=True, default=None)
+    audio_modified_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=True, default=None
+    )
+
+    # title, tags and description, for the full text search
+    search_vector: Mapped[str] = mapped_column(
+        TSVECTOR, init=False, nullable=True, deferred=True
+    )
+
+    __table_args__ = (
+        Index("ix_episode_search_vector", "search_vector", postgresql_using="gin"),
+        Index("ix_episode_id_podcast_created_at_id", "id_podcast", "created_at", "id"),
+    )
+
+    def set_audio(self, blob):
+        self.audio_key, self.audio_size, self.audio_checksum = blob
+        self.audio_modified_at = datetime.now(timezone.utc)
+        self.audio = None
 
     def set_tags(self, tags):
         self.tags = json.dumps(tags)
@@ -86,6 +208,43 @@ class Episode(Base):
         return json.loads(self.tags) if self.tags else []
 
 
+def episode_search_vector(title, description, tags):
+    """
+    The words of an episode both stemmed in spanish and as they are (the
+    "simple" configuration), for names and other languages. Matches in the
+    title weigh the most, then the tags and then the description.
+    """
+    parts = [(title, "A"), (" ".join(tags), "B"), (description, "C")]
+    vector = None
+    for text_, weight in parts:
+        for config in SEARCH_CONFIGS:
+            part = func.setweight(
+                func.to_tsvector(
+                    cast(config, REGCONFIG), func.coalesce(text_, "")
+                ),
+                weight,
+            )
+            vector = part if vector is None else vector.op("||")(part)
+    return vector
+
+
+@event.listens_for(Episode, "before_insert")
+@event.listens_for(Episode, "before_update")
+def update_episode_search_vector(mapper, connection, episode):
+    episode.search_vector = episode_search_vector(
+        episode.title, episode.description, episode.get_tags()
+    )
+
+
+# audio files are already compressed, so keeping them out of pglz lets
+# substring() read just the TOAST chunks of the requested byte range
+event.listen(
+    Episode.__table__,
+    "after_create",
+    DDL("ALTER TABLE episode ALTER COLUMN audio SET STORAGE EXTERNAL"),
+)
+
+
 class Section(Base):
     __tablename__ = "section"
 
@@ -94,7 +253,7 @@ class Section(Base):
     title: Mapped[str]
     description: Mapped[str]
     id_episode: Mapped[uuid.UUID] = mapped_column(
-        ForeignKey("episode.id", ondelete="CASCADE")
+        ForeignKey("episode.id", ondelete="CASCADE"), index=True
     )
 
     # create a composite primary key
@@ -113,7 +272,7 @@ class User_episode(Base):
         ForeignKey("episode.id", ondelete="CASCADE")
     )
     id_user: Mapped[uuid.UUID] = mapped_column(
-        ForeignKey("user.id", ondelete="CASCADE")
+        ForeignKey("user.id", ondelete="CASCADE"), index=True
     )
     current_sec: Mapped[int]  # represents seconds
 
@@ -132,7 +291,11 @@ class StreamLater(Base):
     )
     episode: Mapped[Episode] = relationship(init=False)
 
-    __table_args__ = (PrimaryKeyConstraint("id_episode", "id_user"),)
+    __table_args__ = (
+        PrimaryKeyConstraint("id_episode", "id_user"),
+        # the list of a user, the primary key only finds the users of an episode
+        Index("ix_stream_later_id_user_id_episode", "id_user", "id_episode"),
+    )
 
 
 class Favorite(Base):
@@ -146,7 +309,11 @@ class Favorite(Base):
     )
     podcast: Mapped[Podcast] = relationship(init=False)
 
-    __table_args__ = (PrimaryKeyConstraint("id_podcast", "id_user"),)
+    __table_args__ = (
+        PrimaryKeyConstraint("id_podcast", "id_user"),
+        # the list of a user, the primary key only finds the users of a podcast
+        Index("ix_favorite_id_user_id_podcast", "id_user", "id_podcast"),
+    )
 
 
 class Comment(Base):
@@ -161,11 +328,14 @@ class Comment(Base):
         nullable=False,
     )
     content: Mapped[str]
-    created_at: Mapped[str] = mapped_column(
-        nullable=False, server_default=text("now()"), init=False
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        nullable=False,
+        server_default=text("now()"),
+        init=False,
     )
     id_user: Mapped[uuid.UUID] = mapped_column(
-        ForeignKey("user.id", ondelete="CASCADE")
+        ForeignKey("user.id", ondelete="CASCADE"), index=True
     )
     id_episode: Mapped[uuid.UUID] = mapped_column(
         ForeignKey("episode.id", ondelete="CASCADE")
@@ -179,6 +349,10 @@ class Comment(Base):
         cascade="all, delete-orphan",
     )
 
+    __table_args__ = (
+        Index("ix_comment_id_episode_created_at_id", "id_episode", "created_at", "id"),
+    )
+
 
 class Reply(Base):
     __tablename__ = "reply"
@@ -192,11 +366,14 @@ class Reply(Base):
         nullable=False,
     )
     content: Mapped[str]
-    created_at: Mapped[str] = mapped_column(
-        nullable=False, server_default=text("now()"), init=False
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        nullable=False,
+        server_default=text("now()"),
+        init=False,
     )
     id_user: Mapped[uuid.UUID] = mapped_column(
-        ForeignKey("user.id", ondelete="CASCADE")
+        ForeignKey("user.id", ondelete="CASCADE"), index=True
     )
     id_comment: Mapped[uuid.UUID] = mapped_column(
         ForeignKey("comment.id", ondelete="CASCADE")
@@ -204,6 +381,10 @@ class Reply(Base):
     user: Mapped[User] = relationship(init=False)
     comment: Mapped[Comment] = relationship(init=False, back_populates="replies")
 
+    __table_args__ = (
+        Index("ix_reply_id_comment_created_at_id", "id_comment", "created_at", "id"),
+    )
+
 
 class Follow(Base):
     __tablename__ = "follow"
@@ -212,7 +393,7 @@ class Follow(Base):
         ForeignKey("user.id", ondelete="CASCADE")
     )
     id_followed: Mapped[uuid.UUID] = mapped_column(
-        ForeignKey("user.id", ondelete="CASCADE")
+        ForeignKey("user.id", ondelete="CASCADE"), index=True
     )
     
     followed: Mapped[User] = relationship(init=False, foreign_keys=[id_followed])
@@ -236,9 +417,62 @@ class Notification(Base):
     )
     type: Mapped[str]
     object: Mapped[dict[str, any]] =  mapped_column(JSONB)
-    created_at: Mapped[str] = mapped_column(
-        nullable=False, server_default=text("now()"), init=False
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        nullable=False,
+        server_default=text("now()"),
+        init=False,
+    )
+
+    __table_args__ = (
+        Index("ix_notification_id_user_created_at_id", "id_user", "created_at", "id"),
+    )
+
+
+class UploadSession(Base):
+    """
+    Resumable upload of the audio of a new episode. The episode data is
+    validated when the session is created and the episode is inserted
+    once every chunk has been received.
+    """
+
+    __tablename__ = "upload_session"
+
+    id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True),
+        init=False,
+        primary_key=True,
+        server_default=text("gen_random_uuid()"),
+        unique=True,
+        nullable=False,
     )
+    id_user: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey("user.id", ondelete="CASCADE"), index=True
+    )
+    id_podcast: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey("podcast.id", ondelete="CASCADE"), index=True
+    )
+    title: Mapped[str]
+    description: Mapped[str]
+    size: Mapped[int]  # total size of the audio in bytes
+    expires_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    tags: Mapped[str] = mapped_column(nullable=True, default=None)
+    chunks: Mapped[List["UploadChunk"]] = relationship(
+        init=False, order_by="UploadChunk.offset", cascade="all, delete-orphan"
+    )
+
+
+class UploadChunk(Base):
+    __tablename__ = "upload_chunk"
+
+    id_upload: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey("upload_session.id", ondelete="CASCADE")
+    )
+    index: Mapped[int]
+    offset: Mapped[int]
+    size: Mapped[int]
+
+    __table_args__ = (PrimaryKeyConstraint("id_upload", "index"),)
 
 
 db = SQLAlchemy(model_class=Base)
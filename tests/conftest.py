@@ -0,0 +1,31 @@
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+from models import db
+
+
+@pytest.fixture
+def count_queries(app):
+    """
+    Context manager collecting the SQL statements run inside its block,
+    uses the `app` fixture of the test module.
+    """
+
+    @contextmanager
+    def count():
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+    return count
@@ -219,8 +219,11 @@ def test_get_comments(app, data):
             },
         ],
     }
-    # assert sorted(response.json, key=lambda x: x["content"]) == expected_response
-    assert response.get_json() == expected_response
+    # the comments written at once are ordered by their random ids
+    episode = response.get_json()
+    for result in [episode, expected_response]:
+        result["comments"].sort(key=lambda x: x["content"])
+    assert episode == expected_response
 
     response = client.get(
         f"/episodes/{data['id_episode']}/comments/{data['id_comment1']}/replies"
@@ -250,7 +253,7 @@ def test_get_comments(app, data):
             },
         },
     ]
-    assert response.get_json() == expected_response
+    assert sorted(response.json, key=lambda x: x["content"]) == expected_response
 
     # test for comment with no replies
     response = client.get(
@@ -216,7 +216,8 @@ def test_edit_delete_podcasts_episodes(app):
         "description": "Very nice podcast!",
         "name": "Nice podcast",
         "summary": "New summary",
-        "cover": f"/podcasts/{id_podcast}/cover",
+        # the new cover is versioned with its checksum, the sha256 of b""
+        "cover": f"/podcasts/{id_podcast}/cover?v=e3b0c44298fc1c14",
         "id_author": str(id_user),
         "author": {
             "id": str(id_user),
@@ -229,7 +230,15 @@ def test_edit_delete_podcasts_episodes(app):
     # check if changes in episode have been successfully applied
     response = client.get(f"/podcasts/{id_podcast}/episodes")
     assert response.status_code == 200
+    # in the order they were created, editing does not move them
     expected_response = [
+        {
+            "id": str(id_episode),
+            "description": "I made the episode even better",
+            "title": "Episode1B",
+            "tags": ["chill"],
+            "audio": f"/episodes/{id_episode}/audio?v=e3b0c44298fc1c14",
+        },
         {
             "id": str(id_episode2),
             "description": "how I met your mother",
@@ -237,13 +246,6 @@ def test_edit_delete_podcasts_episodes(app):
             "tags": [],
             "audio": f"/episodes/{id_episode2}/audio",
         },
-        {
-            "id": str(id_episode),
-            "description": "I made the episode even better",
-            "title": "Episode1B",
-            "tags": ["chill"],
-            "audio": f"/episodes/{id_episode}/audio",
-        },
     ]
     assert response.get_json() == expected_response
 
@@ -268,7 +270,7 @@ def test_edit_delete_podcasts_episodes(app):
             "description": "I made the episode even better",
             "title": "Episode1B",
             "tags": ["chill"],
-            "audio": f"/episodes/{id_episode}/audio",
+            "audio": f"/episodes/{id_episode}/audio?v=e3b0c44298fc1c14",
         }
     ]
     assert response.get_json() == expected_response
@@ -105,7 +105,7 @@ def test_get_favorites(app, data):
     ]
     response = client.get("/favorites")
     assert response.status_code == 200
-    assert response.json == expected_response
+    assert response.json == sorted(expected_response, key=lambda x: x["id"])
 
 
 def test_get_favorite_by_id(app, data):
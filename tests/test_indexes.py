@@ -0,0 +1,283 @@
+import random
+import uuid
+
+import pytest
+from sqlalchemy import event, insert, text, update
+from werkzeug.security import generate_password_hash
+
+from app import create_app
+from constants.constants import CATEGORIES
+from commands import INDEX_UPGRADES, SCHEMA_UPGRADES
+from models import (
+    Comment,
+    Episode,
+    Favorite,
+    Follow,
+    Notification,
+    Podcast,
+    Reply,
+    Section,
+    StreamLater,
+    User,
+    User_episode,
+    db,
+    episode_search_vector,
+)
+from utils.search import get_search_cache
+
+# rows of every table, enough for postgres to prefer an index when the
+# query can use one, most users only listen and podcasts have a few episodes
+ROWS = 2000
+USERS = 10 * ROWS
+EPISODES = 10 * ROWS
+# a sequential scan of a bigger table fails the test
+SEQ_SCAN_MAX_ROWS = 1000
+# the words of the names are made of 2 to 4 of these
+SYLLABLES = ["ra", "di", "o", "cien", "cia", "his", "to", "mu", "si", "ca", "no"]
+# endpoints that read a whole table on purpose, and the tables
+FULL_SCANS = {
+    # the views of every podcast are counted to rank them
+    "/populars": {"podcast", "episode", "user_episode", "user"},
+    # the fuzzy searches score the names of a length close to the query's,
+    # which are most of them for names of usual lengths
+    "/search/podcast/<podcast_name>": {"podcast"},
+    "/search/user/<username>": {"user"},
+    "/search": {"podcast", "user"},
+}
+
+
+@pytest.fixture
+def app():
+    app = create_app(testing=True)
+    with app.app_context():
+        db.create_all()
+    yield app
+    with app.app_context():
+        db.drop_all()
+
+
+@pytest.fixture
+def data(app):
+    """
+    ROWS podcasts of different users, each with EPISODES / ROWS episodes,
+    and a comment in the first episode of each one.
+    """
+    # names of a few words, most of them 10 to 25 characters long like real
+    # ones, the searches read the names of a length close to the query's
+    rng = random.Random(0)
+    words = [
+        "".join(rng.choices(SYLLABLES, k=rng.randint(2, 4))) for _ in range(1000)
+    ]
+    names = [
+        " ".join(rng.choices(words, k=rng.randint(1, 3))) + f" {i}"
+        for i in range(USERS)
+    ]
+    with app.app_context():
+        users = [uuid.uuid4() for _ in range(USERS)]
+        podcasts = [uuid.uuid4() for _ in range(ROWS)]
+        episodes = [uuid.uuid4() for _ in range(EPISODES)]
+        comments = [uuid.uuid4() for _ in range(ROWS)]
+        # the authors follow, save and listen to the content of the next one
+        following = users[1 : ROWS + 1]
+        db.session.execute(
+            insert(User),
+            [
+                {
+                    "id": id,
+                    "email": f"test{i}@example.com",
+                    "username": f"user{names[i]}",
+                    "normalized_username": f"user{names[i]}",
+                    "normalized_username_length": len(f"user{names[i]}"),
+                    "password": generate_password_hash("Test1234") if i == 0 else "",
+                    "verified": True,
+                }
+                for i, id in enumerate(users)
+            ],
+        )
+        db.session.execute(
+            insert(Podcast),
+            [
+                {
+                    "id": id,
+                    "name": f"Podcast {names[i]}",
+                    "normalized_name": f"podcast {names[i]}",
+                    "normalized_name_length": len(f"podcast {names[i]}"),
+                    "summary": "",
+                    "description": "",
+                    "id_author": users[i],
+                    "category": CATEGORIES[i % len(CATEGORIES)],
+                }
+                for i, id in enumerate(podcasts)
+            ],
+        )
+        db.session.execute(
+            insert(Episode),
+            [
+                {
+                    "id": id,
+                    "title": f"Episode {names[i]}",
+                    "description": "",
+                    "id_podcast": podcasts[i % ROWS],
+                }
+                for i, id in enumerate(episodes)
+            ],
+        )
+        db.session.execute(
+            insert(Comment),
+            [
+                {
+                    "id": id,
+                    "content": "",
+                    "id_user": users[i],
+                    "id_episode": episodes[i],
+                }
+                for i, id in enumerate(comments)
+            ],
+        )
+        rows = {
+            Reply: [
+                {"content": "", "id_user": following[i], "id_comment": id}
+                for i, id in enumerate(comments)
+            ],
+            Section: [
+                {"begin": 0, "end": 1, "title": "", "description": "", "id_episode": id}
+                for id in episodes[:ROWS]
+            ],
+            Follow: [
+                {"id_follower": id, "id_followed": following[i]}
+                for i, id in enumerate(users[:ROWS])
+            ],
+            Favorite: [
+                {"id_user": id, "id_podcast": podcasts[(i + 1) % ROWS]}
+                for i, id in enumerate(users[:ROWS])
+            ],
+            StreamLater: [
+                {"id_user": id, "id_episode": episodes[(i + 1) % ROWS]}
+                for i, id in enumerate(users[:ROWS])
+            ],
+            User_episode: [
+                {
+                    "id_user": id,
+                    "id_episode": episodes[(i + 1) % ROWS],
+                    "current_sec": 0,
+                }
+                for i, id in enumerate(users[:ROWS])
+            ],
+            Notification: [
+                {"id_user": id, "type": "new_podcast", "object": {}}
+                for id in users[:ROWS]
+            ],
+        }
+        for model, values in rows.items():
+            db.session.execute(insert(model), values)
+        db.session.execute(
+            update(Episode).values(
+                search_vector=episode_search_vector(
+                    Episode.title, Episode.description, []
+                )
+            )
+        )
+        db.session.commit()
+        # like autovacuum would, the GIN indexes are slow to read until their
+        # pending entries are merged
+        with db.engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT"
+        ) as connection:
+            connection.execute(text("VACUUM ANALYZE"))
+        return {
+            "id_user": str(users[1]),
+            "id_podcast": str(podcasts[1]),
+            "id_episode": str(episodes[1]),
+            "id_comment": str(comments[1]),
+            # misspelled, an exact name would not run the fuzzy search
+            "username": f"usr{names[1]}",
+            "podcast_name": f"Podcats {names[1]}",
+            "category": CATEGORIES[1],
+            "episode_words": names[1],
+        }
+
+
+def seq_scans(plan: dict) -> set:
+    """The tables read with a sequential scan by a query plan."""
+    tables = set()
+    if plan["Node Type"] == "Seq Scan":
+        tables.add(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        tables |= seq_scans(child)
+    return tables
+
+
+def test_no_seq_scans(app, data):
+    """The queries of every endpoint use an index to find their rows."""
+    client = app.test_client()
+    client.post("/login", json={"email": "test0@example.com", "password": "Test1234"})
+    values = {
+        "user_id": data["id_user"],
+        "id_user": data["id_user"],
+        "id_podcast": data["id_podcast"],
+        "id_episode": data["id_episode"],
+        "id_comment": data["id_comment"],
+        "category": data["category"],
+        "username": data["username"],
+        "podcast_name": data["podcast_name"],
+    }
+    query_strings = {
+        "/search/episode": {"q": data["episode_words"]},
+        "/autocomplete": {"q": "pod", "type": "podcast"},
+        "/search": {"q": data["podcast_name"]},
+    }
+    urls = []
+    for rule in app.url_map.iter_rules():
+        if "GET" not in rule.methods or rule.arguments - values.keys():
+            continue  # files and uploads, there are none of them
+        url = rule.build({key: values[key] for key in rule.arguments})[1]
+        urls.append((rule.rule, url, query_strings.get(rule.rule)))
+
+    with app.app_context():
+        engine = db.engine
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    for rule, url, query_string in urls:
+        # anything built once per process, like the search indexes
+        client.get(url, query_string=query_string)
+        with app.app_context():
+            get_search_cache().results.clear()
+        statements.clear()
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            response = client.get(url, query_string=query_string)
+        finally:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+        assert response.status_code < 500, url
+        if rule in ("/search/podcast/<podcast_name>", "/search/user/<username>"):
+            assert response.status_code == 200, f"{url} is an exact match"
+
+        with engine.connect() as connection:
+            sizes = dict(
+                connection.execute(
+                    text("SELECT relname, reltuples FROM pg_class WHERE relkind = 'r'")
+                ).all()
+            )
+            for statement, parameters in statements:
+                plan = connection.exec_driver_sql(
+                    f"EXPLAIN (FORMAT JSON) {statement}", parameters
+                ).scalar()[0]["Plan"]
+                big = {
+                    table
+                    for table in seq_scans(plan) - FULL_SCANS.get(rule, set())
+                    if sizes[table] > SEQ_SCAN_MAX_ROWS
+                }
+                assert not big, f"{url} scans {big}: {statement}"
+
+
+def test_indexes_are_upgraded():
+    """`flask db upgrade` creates every index of the models concurrently."""
+    upgrades = " ".join(SCHEMA_UPGRADES)
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            assert index.name in INDEX_UPGRADES, index.name
+    assert "CREATE INDEX" not in upgrades
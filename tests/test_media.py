@@ -0,0 +1,659 @@
+import hashlib
+import io
+import os
+from datetime import datetime, timezone
+
+import pytest
+from PIL import Image
+from sqlalchemy import select, update
+from werkzeug.security import generate_password_hash
+
+from app import create_app
+from models import Episode, Podcast, User, db
+from utils.cache import LRUCache
+from utils.images import ImagePipeline
+from utils.storage import BlobStore, S3BlobStore, StoredBlob, get_blob_store
+
+
+@pytest.fixture
+def app():
+    app = create_app(testing=True)
+    with app.app_context():
+        db.create_all()
+    yield app
+    with app.app_context():
+        db.drop_all()
+
+
+@pytest.fixture
+def data(app):
+    with app.app_context():
+        user = User(
+            email="test@example.com",
+            username="test",
+            password=generate_password_hash("Test1234"),
+            verified=True,
+        )
+        db.session.add(user)
+        db.session.commit()
+        podcast = Podcast(
+            cover=b"",
+            name="podcast",
+            summary="summary",
+            description="description",
+            id_author=user.id,
+        )
+        db.session.add(podcast)
+        db.session.commit()
+        episode = Episode(
+            audio=bytes(range(256)) * 4,
+            title="episode",
+            description="description",
+            id_podcast=podcast.id,
+        )
+        db.session.add(episode)
+        db.session.commit()
+        yield {
+            "id_user": user.id,
+            "id_podcast": podcast.id,
+            "id_episode": episode.id,
+            "audio": bytes(range(256)) * 4,
+        }
+
+
+def test_audio_range(app, data):
+    client = app.test_client()
+    url = f"/episodes/{data['id_episode']}/audio"
+
+    # Whole file
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.headers["Content-Length"] == "1024"
+    assert response.data == data["audio"]
+
+    # Bounded range
+    response = client.get(url, headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 10-19/1024"
+    assert response.headers["Content-Length"] == "10"
+    assert response.data == data["audio"][10:20]
+
+    # Open ended range
+    response = client.get(url, headers={"Range": "bytes=1000-"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 1000-1023/1024"
+    assert response.data == data["audio"][1000:]
+
+    # Suffix range
+    response = client.get(url, headers={"Range": "bytes=-4"})
+    assert response.status_code == 206
+    assert response.data == data["audio"][-4:]
+
+    # Range past the end of the file
+    response = client.get(url, headers={"Range": "bytes=2000-"})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */1024"
+
+    # Episode not found
+    response = client.get("/episodes/00000000-0000-0000-0000-000000000000/audio")
+    assert response.status_code == 404
+
+
+def test_audio_streamed_in_chunks(app, data):
+    app.config["AUDIO_CHUNK_SIZE"] = 100
+    client = app.test_client()
+    url = f"/episodes/{data['id_episode']}/audio"
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.is_streamed
+    chunks = list(response.response)
+    assert max(len(chunk) for chunk in chunks) == 100
+    assert len(chunks) == 11
+    assert b"".join(chunks) == data["audio"]
+
+    response = client.get(url, headers={"Range": "bytes=150-449"})
+    assert response.status_code == 206
+    chunks = list(response.response)
+    assert [len(chunk) for chunk in chunks] == [100, 100, 100]
+    assert b"".join(chunks) == data["audio"][150:450]
+
+
+class FakeS3Client:
+    """Local stand-in implementing the S3 calls used by S3BlobStore"""
+
+    def __init__(self):
+        self.objects = {}
+        self.modified = {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body.read()
+        self.modified[(Bucket, Key)] = datetime.now(timezone.utc)
+
+    def get_object(self, Bucket, Key, Range=None):
+        data = self.objects[(Bucket, Key)]
+        if Range:
+            start, end = Range.removeprefix("bytes=").split("-")
+            data = data[int(start) : int(end) + 1]
+        return {"Body": io.BytesIO(data)}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def list_objects_v2(self, Bucket, Prefix, ContinuationToken=0):
+        # one object per page, to go through every page
+        keys = sorted(
+            key
+            for bucket, key in self.objects
+            if bucket == Bucket and key.startswith(Prefix)
+        )
+        page = keys[ContinuationToken : ContinuationToken + 1]
+        return {
+            "Contents": [
+                {"Key": key, "LastModified": self.modified[(Bucket, key)]}
+                for key in page
+            ],
+            "IsTruncated": ContinuationToken + 1 < len(keys),
+            "NextContinuationToken": ContinuationToken + 1,
+        }
+
+
+def test_uploads_go_to_blob_store(app, data):
+    client = app.test_client()
+    response = client.post(
+        "/login", json={"email": "test@example.com", "password": "Test1234"}
+    )
+    assert response.status_code == 200
+
+    response = client.post(
+        f"/podcasts/{data['id_podcast']}/episodes",
+        data={
+            "title": "stored",
+            "description": "description",
+            "audio": (io.BytesIO(b"stored audio"), "test.mp3", "audio/mpeg"),
+        },
+    )
+    assert response.status_code == 201
+    id_episode = response.get_json()["id"]
+
+    with app.app_context():
+        episode = db.session.get(Episode, id_episode)
+        assert episode.audio_key is not None
+        assert episode.audio_size == 12
+        assert episode.audio_checksum == hashlib.sha256(b"stored audio").hexdigest()
+        assert db.session.scalar(select(Episode.audio).where(Episode.id == id_episode)) is None
+        path = os.path.join(app.config["BLOB_STORE_PATH"], episode.audio_key)
+        assert open(path, "rb").read() == b"stored audio"
+
+    response = client.get(f"/episodes/{id_episode}/audio", headers={"Range": "bytes=7-"})
+    assert response.status_code == 206
+    assert response.data == b"audio"
+
+
+def test_move_blobs(app, data):
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["db", "move-blobs"])
+    assert result.exit_code == 0
+    assert "Moved 1 episode audio blobs" in result.output
+
+    with app.app_context():
+        episode = db.session.get(Episode, data["id_episode"])
+        assert episode.audio_size == 1024
+        assert db.session.scalar(select(Episode.audio).where(Episode.id == episode.id)) is None
+        podcast = db.session.get(Podcast, data["id_podcast"])
+        assert podcast.cover_size == 0
+
+    client = app.test_client()
+    response = client.get(f"/episodes/{data['id_episode']}/audio")
+    assert response.data == data["audio"]
+    response = client.get(f"/podcasts/{data['id_podcast']}/cover")
+    assert response.status_code == 200
+    assert response.data == b""
+
+    # nothing left to move
+    result = runner.invoke(args=["db", "move-blobs"])
+    assert "Moved 0 episode audio blobs" in result.output
+
+
+def test_move_image_blobs(app, data):
+    image = io.BytesIO()
+    Image.new("RGB", (300, 300), "red").save(image, "PNG")
+    with app.app_context():
+        db.session.execute(
+            update(User)
+            .where(User.id == data["id_user"])
+            .values(image=image.getvalue())
+        )
+        db.session.commit()
+
+    # The type of the images stored before it was recorded is detected
+    client = app.test_client()
+    response = client.get(f"/users/{data['id_user']}/image")
+    assert response.data == image.getvalue()
+    assert response.mimetype == "image/png"
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["db", "move-blobs"])
+    assert result.exit_code == 0
+    assert "Moved 1 user image blobs" in result.output
+
+    with app.app_context():
+        user = db.session.get(User, data["id_user"])
+        assert user.image_mimetype == "image/png"
+        assert sorted(user.image_renditions, key=int) == ["64", "256"]
+    response = client.get(f"/users/{data['id_user']}/image")
+    assert response.mimetype == "image/png"
+    response = client.get(f"/users/{data['id_user']}/image?size=64")
+    assert response.mimetype == "image/webp"
+
+
+def test_s3_blob_store(app, data):
+    s3 = FakeS3Client()
+    app.extensions["blob_store"] = S3BlobStore(s3, "bucket", prefix="media/")
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["db", "move-blobs"])
+    assert result.exit_code == 0
+
+    with app.app_context():
+        episode = db.session.get(Episode, data["id_episode"])
+        assert s3.objects[("bucket", "media/" + episode.audio_key)] == data["audio"]
+        podcast = db.session.get(Podcast, data["id_podcast"])
+        keys = get_blob_store().keys(datetime.now(timezone.utc))
+        assert set(keys) == {episode.audio_key, podcast.cover_key}
+
+    client = app.test_client()
+    response = client.get(
+        f"/episodes/{data['id_episode']}/audio", headers={"Range": "bytes=10-19"}
+    )
+    assert response.status_code == 206
+    assert response.data == data["audio"][10:20]
+
+
+class CountingStream(io.BytesIO):
+    def __init__(self, data):
+        super().__init__(data)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def test_gc_blobs(app, data):
+    client = app.test_client()
+    client.post("/login", json={"email": "test@example.com", "password": "Test1234"})
+    runner = app.test_cli_runner()
+    runner.invoke(args=["db", "move-blobs"])
+
+    def stored():
+        with app.app_context():
+            return set(get_blob_store().keys(datetime.now(timezone.utc)))
+
+    def upload_cover(color):
+        image = io.BytesIO()
+        Image.new("RGB", (600, 300), color).save(image, "PNG")
+        image.seek(0)
+        response = client.put(
+            f"/podcasts/{data['id_podcast']}",
+            data={"cover": (image, "cover.png", "image/png")},
+        )
+        assert response.status_code == 201
+        with app.app_context():
+            podcast = db.session.get(Podcast, data["id_podcast"])
+            return {podcast.cover_key} | {
+                rendition["key"] for rendition in podcast.cover_renditions.values()
+            }
+
+    with app.app_context():
+        audio_key = db.session.get(Episode, data["id_episode"]).audio_key
+    red = upload_cover("red")
+    assert len(red) == 3
+    blue = upload_cover("blue")
+    response = client.delete(f"/episodes/{data['id_episode']}")
+    assert response.status_code == 200
+    assert red | blue | {audio_key} <= stored()
+
+    # recent blobs may belong to rows being inserted, they are kept
+    result = runner.invoke(args=["db", "gc-blobs"])
+    assert "Deleted 0 unused blobs" in result.output
+
+    # the replaced cover, its thumbnails and the deleted audio are removed
+    result = runner.invoke(args=["db", "gc-blobs", "--min-age", "0"])
+    assert result.exit_code == 0
+    assert stored() == blue
+
+
+def test_blob_store_interface():
+    class PutOnlyStore(BlobStore):
+        def put(self, stream):
+            return StoredBlob("key", 0, "")
+
+    # a store missing part of the interface fails when it is created
+    with pytest.raises(TypeError):
+        PutOnlyStore()
+    with pytest.raises(TypeError):
+        BlobStore()
+
+
+def multipart_body(parts, boundary="boundary"):
+    body = b""
+    for name, value in parts:
+        body += f"--{boundary}\r\n".encode()
+        if isinstance(value, bytes):
+            body += (
+                f'Content-Disposition: form-data; name="{name}"; filename="a.mp3"\r\n'
+                "Content-Type: audio/mpeg\r\n\r\n"
+            ).encode() + value
+        else:
+            body += (
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n{value}'
+            ).encode()
+        body += b"\r\n"
+    return body + f"--{boundary}--\r\n".encode()
+
+
+def test_streaming_upload(app, data):
+    client = app.test_client()
+    response = client.post(
+        "/login", json={"email": "test@example.com", "password": "Test1234"}
+    )
+    assert response.status_code == 200
+    url = f"/podcasts/{data['id_podcast']}/episodes"
+    content_type = "multipart/form-data; boundary=boundary"
+
+    # Duplicate title is rejected before the audio is read
+    stream = CountingStream(
+        multipart_body(
+            [("title", "episode"), ("description", "d"), ("audio", b"x" * 5_000_000)]
+        )
+    )
+    response = client.post(url, input_stream=stream, content_type=content_type)
+    assert response.status_code == 400
+    assert stream.bytes_read < 1_000_000
+
+    # Fields sent after the file are still read
+    body = multipart_body(
+        [("audio", b"late fields"), ("title", "late"), ("description", "d"), ("tags", "a#b")]
+    )
+    response = client.post(url, data=body, content_type=content_type)
+    assert response.status_code == 201
+    with app.app_context():
+        episode = db.session.get(Episode, response.get_json()["id"])
+        assert episode.title == "late"
+        assert episode.get_tags() == ["a", "b"]
+        assert episode.audio_size == 11
+
+    # Audio bigger than the configured limit
+    app.config["MAX_AUDIO_SIZE"] = 1000
+    body = multipart_body([("title", "big"), ("description", "d"), ("audio", b"x" * 1001)])
+    response = client.post(url, data=body, content_type=content_type)
+    assert response.status_code == 413
+    response = client.put(
+        f"/episodes/{data['id_episode']}", data=body, content_type=content_type
+    )
+    assert response.status_code == 413
+    with app.app_context():
+        assert db.session.scalar(select(Episode).where(Episode.title == "big")) is None
+
+    # Only the author of the podcast can upload episodes
+    with app.app_context():
+        user = User(
+            email="other@example.com",
+            username="other",
+            password=generate_password_hash("Test1234"),
+        )
+        db.session.add(user)
+        db.session.commit()
+    response = client.post(
+        "/login", json={"email": "other@example.com", "password": "Test1234"}
+    )
+    body = multipart_body([("title", "not mine"), ("description", "d"), ("audio", b"x")])
+    response = client.post(url, data=body, content_type=content_type)
+    assert response.status_code == 404
+
+
+def test_conditional_requests(app, data):
+    client = app.test_client()
+    response = client.post(
+        "/login", json={"email": "test@example.com", "password": "Test1234"}
+    )
+    response = client.put(
+        f"/podcasts/{data['id_podcast']}",
+        data={"cover": (io.BytesIO(b"cover"), "cover.jpg", "image/jpeg")},
+    )
+    assert response.status_code == 201
+    checksum = hashlib.sha256(b"cover").hexdigest()
+
+    response = client.get(f"/podcasts/{data['id_podcast']}")
+    cover_url = response.get_json()["cover"]
+    assert cover_url == f"/podcasts/{data['id_podcast']}/cover?v={checksum[:16]}"
+
+    # Versioned URLs can be cached forever
+    response = client.get(cover_url)
+    assert response.status_code == 200
+    assert response.data == b"cover"
+    assert response.headers["ETag"] == f'"{checksum}"'
+    assert "immutable" in response.headers["Cache-Control"]
+    last_modified = response.headers["Last-Modified"]
+
+    # Unversioned URLs have to be revalidated
+    response = client.get(f"/podcasts/{data['id_podcast']}/cover")
+    assert response.headers["Cache-Control"] == "no-cache"
+
+    # The blob store is not touched to answer a 304
+    store = app.extensions["blob_store"]
+    app.extensions["blob_store"] = None
+    response = client.get(cover_url, headers={"If-None-Match": f'"{checksum}"'})
+    assert response.status_code == 304
+    assert response.data == b""
+    response = client.get(cover_url, headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+    app.extensions["blob_store"] = store
+
+    response = client.get(cover_url, headers={"If-None-Match": '"other"'})
+    assert response.status_code == 200
+
+    # Audio
+    response = client.put(
+        f"/episodes/{data['id_episode']}",
+        data={"audio": (io.BytesIO(b"new audio"), "a.mp3", "audio/mpeg")},
+    )
+    assert response.status_code == 201
+    checksum = hashlib.sha256(b"new audio").hexdigest()
+    url = f"/episodes/{data['id_episode']}/audio"
+    response = client.get(url, headers={"If-None-Match": f'"{checksum}"'})
+    assert response.status_code == 304
+
+    # If-Range only honours the range while the audio is unchanged
+    response = client.get(
+        url, headers={"Range": "bytes=4-", "If-Range": f'"{checksum}"'}
+    )
+    assert response.status_code == 206
+    assert response.data == b"audio"
+    response = client.get(url, headers={"Range": "bytes=4-", "If-Range": '"old"'})
+    assert response.status_code == 200
+    assert response.data == b"new audio"
+
+
+def test_cover_thumbnails(app, data):
+    client = app.test_client()
+    response = client.post(
+        "/login", json={"email": "test@example.com", "password": "Test1234"}
+    )
+    image = io.BytesIO()
+    Image.new("RGB", (600, 300), "red").save(image, "PNG")
+    original = image.getvalue()
+    response = client.put(
+        f"/podcasts/{data['id_podcast']}",
+        data={"cover": (io.BytesIO(original), "cover.png", "image/png")},
+    )
+    assert response.status_code == 201
+    cover_url = client.get(f"/podcasts/{data['id_podcast']}").get_json()["cover"]
+
+    # The original keeps its own type
+    response = client.get(cover_url)
+    assert response.data == original
+    assert response.mimetype == "image/png"
+
+    # Sizes bigger than the original are not generated
+    with app.app_context():
+        podcast = db.session.get(Podcast, data["id_podcast"])
+        assert sorted(podcast.cover_renditions, key=int) == ["64", "256"]
+
+    # The smallest thumbnail at least as big as the requested size is sent
+    response = client.get(f"{cover_url}&size=100")
+    assert response.status_code == 200
+    assert response.mimetype == "image/webp"
+    assert Image.open(io.BytesIO(response.data)).size == (256, 128)
+    assert len(response.data) < len(original)
+    assert "immutable" in response.headers["Cache-Control"]
+    etag = response.headers["ETag"]
+    assert etag != f'"{hashlib.sha256(original).hexdigest()}"'
+
+    response = client.get(f"{cover_url}&size=64")
+    assert Image.open(io.BytesIO(response.data)).size == (64, 32)
+    response = client.get(f"{cover_url}&size=100", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    response = client.get(f"{cover_url}&size=1024")
+    assert response.data == original
+
+    # Files that are not images are kept as they are
+    response = client.put(
+        f"/podcasts/{data['id_podcast']}",
+        data={"cover": (io.BytesIO(b"not an image"), "cover.jpg", "image/jpeg")},
+    )
+    assert response.status_code == 201
+    response = client.get(f"/podcasts/{data['id_podcast']}/cover?size=64")
+    assert response.data == b"not an image"
+    assert response.mimetype == "application/octet-stream"
+
+
+def test_image_pipeline(app, data):
+    client = app.test_client()
+    response = client.post(
+        "/login", json={"email": "test@example.com", "password": "Test1234"}
+    )
+    pipeline = ImagePipeline(app, workers=1, max_pending=1, timeout=0)
+    app.extensions["image_pipeline"] = pipeline
+
+    def upload_cover(color):
+        image = io.BytesIO()
+        Image.new("RGB", (300, 300), color).save(image, "PNG")
+        image.seek(0)
+        response = client.put(
+            f"/podcasts/{data['id_podcast']}",
+            data={"cover": (image, "cover.png", "image/png")},
+        )
+        assert response.status_code == 201
+
+    def renditions():
+        with app.app_context():
+            return db.session.get(Podcast, data["id_podcast"]).cover_renditions
+
+    # The request returns before the thumbnails are generated by the workers
+    upload_cover("red")
+    assert pipeline.join(timeout=60)
+    assert sorted(renditions(), key=int) == ["64", "256"]
+
+    # With the queue full the request renders the thumbnails itself
+    assert pipeline.slots.acquire()
+    upload_cover("blue")
+    assert pipeline.pending == 0
+    assert sorted(renditions(), key=int) == ["64", "256"]
+    pipeline.slots.release()
+
+    # A pool that cannot take the image gives its slot back and the request
+    # renders the thumbnails itself
+    pipeline.executor.shutdown()
+    upload_cover("green")
+    assert pipeline.pending == 0
+    assert sorted(renditions(), key=int) == ["64", "256"]
+    assert pipeline.slots.acquire(timeout=0)
+    pipeline.slots.release()
+
+
+def test_lru_cache():
+    cache = LRUCache(max_bytes=10, max_item_bytes=6)
+    cache.put("a", b"aaaa", 4, group="x")
+    cache.put("b", b"bbbb", 4, group="y")
+    assert cache.get("a") == b"aaaa"
+    # the least recently used entry is evicted to make room
+    cache.put("c", b"cccc", 4, group="x")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"aaaa"
+    # too big to be cached
+    cache.put("d", b"ddddddd", 7)
+    assert cache.get("d") is None
+    cache.invalidate("x")
+    assert cache.get("a") is None and cache.get("c") is None
+    assert cache.stats() == {
+        "entries": 0,
+        "bytes": 0,
+        "max_bytes": 10,
+        "hits": 2,
+        "misses": 4,
+        "evictions": 1,
+    }
+
+
+def test_lru_cache_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("utils.cache.time.monotonic", lambda: now[0])
+    cache = LRUCache(max_bytes=10, ttl=5)
+    cache.put("a", "a", 1)
+    now[0] += 5
+    assert cache.get("a") == "a"
+    now[0] += 1
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_media_cache(app, data):
+    client = app.test_client()
+    response = client.post(
+        "/login", json={"email": "test@example.com", "password": "Test1234"}
+    )
+    response = client.put(
+        f"/podcasts/{data['id_podcast']}",
+        data={"cover": (io.BytesIO(b"cover"), "cover.jpg", "image/jpeg")},
+    )
+    cover_url = client.get(f"/podcasts/{data['id_podcast']}").get_json()["cover"]
+
+    response = client.get(cover_url)
+    assert response.data == b"cover"
+    # Unversioned URLs are not cached
+    response = client.get(f"/podcasts/{data['id_podcast']}/cover")
+    assert response.data == b"cover"
+    stats = client.get("/stats").get_json()["media_cache"]
+    assert stats["entries"] == 1
+    assert stats["hits"] == 0
+
+    # Hits need neither the database nor the blob store
+    with app.app_context():
+        db.session.execute(
+            update(Podcast)
+            .where(Podcast.id == data["id_podcast"])
+            .values(cover_key="missing")
+        )
+        db.session.commit()
+    response = client.get(cover_url)
+    assert response.data == b"cover"
+    assert "immutable" in response.headers["Cache-Control"]
+    stats = client.get("/stats").get_json()["media_cache"]
+    assert stats["hits"] == 1
+    assert stats["bytes"] == len(b"cover")
+
+    # Changing the cover drops the old one
+    response = client.put(
+        f"/podcasts/{data['id_podcast']}",
+        data={"cover": (io.BytesIO(b"new cover"), "cover.jpg", "image/jpeg")},
+    )
+    assert client.get("/stats").get_json()["media_cache"]["entries"] == 0
+    cover_url = client.get(f"/podcasts/{data['id_podcast']}").get_json()["cover"]
+    assert client.get(cover_url).data == b"new cover"
+
+    response = client.delete(f"/podcasts/{data['id_podcast']}")
+    assert response.status_code == 200
+    assert client.get("/stats").get_json()["media_cache"]["entries"] == 0
@@ -38,6 +38,10 @@ def test_preflight(app, data):
     assert res.headers["X-Content-Type-Options"] == "*"
 
 
+def test_stats_only_in_development():
+    assert create_app().test_client().get("/stats").status_code == 404
+
+
 def test_hello_world(app):
     client = app.test_client()
     res = client.get("/")
@@ -0,0 +1,178 @@
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import select, text, update
+from werkzeug.security import generate_password_hash
+
+from app import create_app
+from models import Comment, Episode, Favorite, Follow, Podcast, StreamLater, User, db
+from utils.pagination import InvalidCursor, decode_cursor, encode_cursor
+
+
+@pytest.fixture
+def app():
+    app = create_app(testing=True)
+    with app.app_context():
+        db.create_all()
+    yield app
+    with app.app_context():
+        db.drop_all()
+
+
+@pytest.fixture
+def data(app):
+    """5 podcasts of user1 with an episode each, all followed and saved by user0."""
+    with app.app_context():
+        users = [
+            User(
+                email=f"test{i}@example.com",
+                username=f"user{i}",
+                password=generate_password_hash("Test1234"),
+            )
+            for i in range(2)
+        ]
+        db.session.add_all(users)
+        db.session.flush()
+        db.session.add(Follow(id_follower=users[0].id, id_followed=users[1].id))
+        for i in range(5):
+            podcast = Podcast(
+                name=f"Podcast {i}",
+                summary="",
+                description="",
+                id_author=users[1].id,
+                category="Ciencia",
+            )
+            db.session.add(podcast)
+            db.session.flush()
+            episode = Episode(
+                title=f"Episode {i}", description="", id_podcast=podcast.id
+            )
+            db.session.add(episode)
+            db.session.flush()
+            db.session.add(Favorite(id_user=users[0].id, id_podcast=podcast.id))
+            db.session.add(StreamLater(id_user=users[0].id, id_episode=episode.id))
+            db.session.add(
+                Comment(
+                    content=f"Comment {i}", id_user=users[0].id, id_episode=episode.id
+                )
+            )
+        db.session.commit()
+        return {
+            "id_user": str(users[1].id),
+            "id_podcast": str(podcast.id),
+            "id_episode": str(episode.id),
+        }
+
+
+def get_pages(client, url, limit):
+    """Every page of a list, following the X-Next-Cursor of each one."""
+    pages = []
+    params = {"limit": limit}
+    while True:
+        response = client.get(url, query_string=params)
+        assert response.status_code == 200, url
+        pages.append(response.get_json())
+        if "X-Next-Cursor" not in response.headers:
+            return pages
+        params["cursor"] = response.headers["X-Next-Cursor"]
+
+
+def test_list_pages(app, data):
+    client = app.test_client()
+    client.post("/login", json={"email": "test0@example.com", "password": "Test1234"})
+
+    for url in [
+        "/podcasts/categories/Ciencia",
+        f"/user/created_podcasts/{data['id_user']}",
+        "/favorites",
+        "/stream_later",
+    ]:
+        pages = get_pages(client, url, 2)
+        assert [len(page) for page in pages] == [2, 2, 1], url
+        # the pages together are the whole list, in the same order
+        assert sum(pages, []) == client.get(url).get_json(), url
+
+    # the last page of lists that fit in one has no cursor
+    for url in [
+        "/follows",
+        f"/podcasts/{data['id_podcast']}/episodes",
+        f"/episodes/{data['id_episode']}/comments",
+        "/notifications",
+    ]:
+        assert len(get_pages(client, url, 2)) == 1, url
+
+    response = client.get("/favorites", query_string={"cursor": "not a cursor"})
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "Invalid cursor"}
+
+
+def test_cursor(app):
+    with app.app_context():
+        types = [datetime, uuid.UUID]
+        values = [datetime(2023, 11, 20, 10, 0, 0, 123, timezone.utc), uuid.uuid4()]
+        # converted back to their types
+        assert decode_cursor(encode_cursor(values), types) == values
+        assert decode_cursor(encode_cursor([0.25]), [float]) == [0.25]
+        with pytest.raises(InvalidCursor):
+            decode_cursor(encode_cursor(values[:1]), types)
+        with pytest.raises(InvalidCursor):
+            decode_cursor(encode_cursor(["not an id"]), [uuid.UUID])
+
+
+def test_pages_across_dst(app):
+    """The lists are in time order even where the local time goes back."""
+    with app.app_context():
+        db.session.execute(text("SET TIME ZONE 'Europe/Madrid'"))
+        user = User(email="test@example.com", username="user", password="")
+        db.session.add(user)
+        db.session.flush()
+        # 02:30 summer time is 20 minutes before 02:10 winter time
+        for name, created_at in [
+            ("Before", "2026-10-25 02:30:00+02"),
+            ("After", "2026-10-25 02:10:00+01"),
+        ]:
+            podcast = Podcast(name=name, summary="", description="", id_author=user.id)
+            db.session.add(podcast)
+            db.session.flush()
+            db.session.execute(
+                update(Podcast)
+                .where(Podcast.id == podcast.id)
+                .values(created_at=text(f"'{created_at}'::timestamptz"))
+            )
+        db.session.commit()
+
+    client = app.test_client()
+    response = client.get("/podcasts?limit=1")
+    assert [p["name"] for p in response.get_json()] == ["After"]
+    cursor = response.headers["X-Next-Cursor"]
+    response = client.get("/podcasts", query_string={"limit": 1, "cursor": cursor})
+    assert [p["name"] for p in response.get_json()] == ["Before"]
+
+
+def test_created_at_upgrade(app, data):
+    """`flask db upgrade` converts the created_at stored as text."""
+    tables = ["podcast", "episode", "comment", "reply", "notification"]
+    with app.app_context():
+        created_at = db.session.scalar(select(Comment.created_at).limit(1))
+        for table in tables:
+            db.session.execute(
+                text(
+                    f"ALTER TABLE {table} ALTER COLUMN created_at DROP DEFAULT, "
+                    "ALTER COLUMN created_at TYPE VARCHAR"
+                )
+            )
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["db", "upgrade"])
+    assert result.exit_code == 0, result.output
+    with app.app_context():
+        types = db.session.execute(
+            text(
+                "SELECT table_name, data_type FROM information_schema.columns "
+                "WHERE column_name = 'created_at' AND table_name = ANY(:tables)"
+            ),
+            {"tables": tables},
+        ).all()
+        assert dict(types) == dict.fromkeys(tables, "timestamp with time zone")
+        assert db.session.scalar(select(Comment.created_at).limit(1)) == created_at
@@ -1,3 +1,6 @@
+import hashlib
+import os
+
 import pytest
 from werkzeug.security import generate_password_hash
 
@@ -5,6 +8,12 @@ from app import create_app
 from models import Episode, Podcast, User, User_episode, db
 
 
+def category_image_url(filename):
+    with open(os.path.join("constants", filename), "rb") as f:
+        checksum = hashlib.sha256(f.read()).hexdigest()
+    return f"/categories/images/{filename}?v={checksum[:16]}"
+
+
 @pytest.fixture
 def app():
     app = create_app(testing=True)
@@ -140,7 +149,8 @@ def test_post_episode(app):
         "id": id_created,
         "description": "description",
         "title": "title",
-        "audio": f"/episodes/{id_created}/audio",
+        # the audio is versioned with its checksum, the sha256 of b""
+        "audio": f"/episodes/{id_created}/audio?v=e3b0c44298fc1c14",
         "id_podcast": str(id_podcast),
         "podcast_name": "podcast",
         "id_author": str(id_author),
@@ -608,40 +618,56 @@ def test_categories(app):
 
     client = app.test_client()
 
-    # get all categories
+    # get all categories, the image URLs are versioned with their content
     response = client.get(f"/categories")
     assert response.status_code == 200
     expected_response = [
-        {"image_url": "/categories/images/Actualidad.png", "title": "Actualidad"},
-        {"image_url": "/categories/images/Educación.png", "title": "Educación"},
+        {"image_url": category_image_url("Actualidad.png"), "title": "Actualidad"},
+        {"image_url": category_image_url("Educación.png"), "title": "Educación"},
         {
-            "image_url": "/categories/images/Negocios y Finanzas.png",
+            "image_url": category_image_url("Negocios y Finanzas.png"),
             "title": "Negocios y Finanzas",
         },
         {
-            "image_url": "/categories/images/Salud y Fitness.png",
+            "image_url": category_image_url("Salud y Fitness.png"),
             "title": "Salud y Fitness",
         },
-        {"image_url": "/categories/images/Tecnología.png", "title": "Tecnología"},
-        {"image_url": "/categories/images/Ciencia.png", "title": "Ciencia"},
-        {"image_url": "/categories/images/Historia.png", "title": "Historia"},
+        {"image_url": category_image_url("Tecnología.png"), "title": "Tecnología"},
+        {"image_url": category_image_url("Ciencia.png"), "title": "Ciencia"},
+        {"image_url": category_image_url("Historia.png"), "title": "Historia"},
         {
-            "image_url": "/categories/images/Entretenimiento.jpg",
+            "image_url": category_image_url("Entretenimiento.jpg"),
             "title": "Entretenimiento",
         },
-        {"image_url": "/categories/images/Deportes.jpg", "title": "Deportes"},
+        {"image_url": category_image_url("Deportes.jpg"), "title": "Deportes"},
         {
-            "image_url": "/categories/images/Arte y Cultura.png",
+            "image_url": category_image_url("Arte y Cultura.png"),
             "title": "Arte y Cultura",
         },
-        {"image_url": "/categories/images/Other.png", "title": "Other"},
-        {"image_url": "/categories/images/Música.jpg", "title": "Música"},
+        {"image_url": category_image_url("Other.png"), "title": "Other"},
+        {"image_url": category_image_url("Música.jpg"), "title": "Música"},
     ]
     assert response.get_json() == expected_response
 
     # Get image of a given category
     response = client.get(f"/categories/images/Actualidad.png")
     assert response.status_code == 200
+    assert response.mimetype == "image/png"
+    response = client.get(category_image_url("Música.jpg"))
+    assert response.status_code == 200
+    assert response.mimetype == "image/jpeg"
+    assert "immutable" in response.headers["Cache-Control"]
+    response = client.get(
+        "/categories/images/Música.jpg",
+        headers={"If-None-Match": response.headers["ETag"]},
+    )
+    assert response.status_code == 304
+
+    # Only the images of the categories can be read
+    response = client.get("/categories/images/constants.py")
+    assert response.status_code == 404
+    response = client.get("/categories/images/..%2Fapp.py")
+    assert response.status_code == 404
 
     # get podcasts of a given category
     response = client.get(f"/podcasts/categories/Actualidad")
@@ -679,3 +705,46 @@ def test_categories(app):
     # get podcasts of a given category that does not exist
     response = client.get(f"/podcasts/categories/INVALID")
     assert response.status_code == 401
+
+
+def test_get_podcasts_pages(app):
+    with app.app_context():
+        user = User(
+            email="test@example.com",
+            username="test",
+            password=generate_password_hash("Test1234"),
+        )
+        db.session.add(user)
+        db.session.commit()
+        # created in two transactions, so some share their created_at
+        for names in [["A", "B", "C"], ["D", "E", "F", "G"]]:
+            for name in names:
+                db.session.add(
+                    Podcast(name=name, summary="", description="", id_author=user.id)
+                )
+            db.session.commit()
+
+    client = app.test_client()
+    everything = [p["name"] for p in client.get("/podcasts").get_json()]
+    assert sorted(everything[:4]) == ["D", "E", "F", "G"]  # newest first
+    assert sorted(everything[4:]) == ["A", "B", "C"]
+
+    pages, cursor = [], None
+    while True:
+        url = "/podcasts?limit=3" + (f"&cursor={cursor}" if cursor else "")
+        response = client.get(url)
+        assert response.status_code == 200
+        pages.append([p["name"] for p in response.get_json()])
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert pages == [everything[0:3], everything[3:6], everything[6:]]
+
+    # offsets still work, in the same order
+    response = client.get("/podcasts?limit=3&offset=3")
+    assert [p["name"] for p in response.get_json()] == everything[3:6]
+    response = client.get("/podcasts?limit=-1&offset=-1")
+    assert response.status_code == 200
+    assert [p["name"] for p in response.get_json()] == everything[:1]
+
+    assert client.get("/podcasts?cursor=nope").status_code == 400
@@ -0,0 +1,135 @@
+import pytest
+from werkzeug.security import generate_password_hash
+
+from app import create_app
+from models import Comment, Episode, Favorite, Follow, Podcast, Reply, User, db
+from utils.search import get_search_cache
+
+
+@pytest.fixture
+def app():
+    app = create_app(testing=True)
+    with app.app_context():
+        db.create_all()
+    yield app
+    with app.app_context():
+        db.drop_all()
+
+
+def add_podcasts(app, start, end):
+    """Podcasts of different authors, all favorites and followed by test0."""
+    with app.app_context():
+        for i in range(start, end):
+            user = User(
+                email=f"test{i}@example.com",
+                username=f"user{i}",
+                password=generate_password_hash("Test1234"),
+            )
+            db.session.add(user)
+            db.session.flush()
+            podcast = Podcast(
+                name=f"Cosmos {i}",
+                summary="",
+                description="",
+                id_author=user.id,
+                category="Ciencia",
+            )
+            db.session.add(podcast)
+            db.session.flush()
+            id_user = db.session.query(User.id).filter_by(username="user0").scalar()
+            db.session.add(Favorite(id_user=id_user, id_podcast=podcast.id))
+            db.session.add(Follow(id_follower=id_user, id_followed=user.id))
+        db.session.commit()
+        return str(db.session.query(User.id).filter_by(username="user0").scalar())
+
+
+def test_list_queries_do_not_grow(app, count_queries):
+    """The number of queries of the list endpoints does not depend on their rows."""
+    client = app.test_client()
+    id_user = add_podcasts(app, 0, 1)
+    client.post("/login", json={"email": "test0@example.com", "password": "Test1234"})
+    urls = [
+        "/podcasts",
+        "/podcasts/categories/Ciencia",
+        f"/user/created_podcasts/{id_user}",
+        "/favorites",
+        "/follows",
+        "/search/podcast/cosmo",
+        "/populars",
+    ]
+
+    counts = []
+    for start, end in [(1, 1), (1, 6)]:
+        add_podcasts(app, start, end)
+        for url in urls:
+            client.get(url)  # anything done once per process
+        with app.app_context():
+            get_search_cache().results.clear()
+        counts.append({})
+        for url in urls:
+            with count_queries() as statements:
+                response = client.get(url)
+            assert response.status_code in (200, 201), url
+            counts[-1][url] = len(statements)
+
+    assert counts[0] == counts[1]
+    assert counts[1]["/podcasts"] == 1
+
+
+def add_comments(app, id_episode, start, end):
+    """Comments of different users, each with two replies of other users."""
+    with app.app_context():
+        for i in range(start, end):
+            users = [
+                User(
+                    email=f"comment{i}-{j}@example.com",
+                    username=f"comment{i}-{j}",
+                    password="",
+                )
+                for j in range(3)
+            ]
+            db.session.add_all(users)
+            db.session.flush()
+            comment = Comment(
+                content=f"Comment {i}", id_user=users[0].id, id_episode=id_episode
+            )
+            db.session.add(comment)
+            db.session.flush()
+            for user in users[1:]:
+                db.session.add(
+                    Reply(content="Reply", id_user=user.id, id_comment=comment.id)
+                )
+        db.session.commit()
+        return db.session.query(Comment.id).filter_by(content="Comment 0").scalar()
+
+
+def test_comment_queries_do_not_grow(app, count_queries):
+    add_podcasts(app, 0, 1)
+    with app.app_context():
+        podcast = db.session.query(Podcast).one()
+        episode = Episode(title="Episode", description="", id_podcast=podcast.id)
+        db.session.add(episode)
+        db.session.commit()
+        id_episode = str(episode.id)
+
+    client = app.test_client()
+    id_comment = add_comments(app, id_episode, 0, 1)
+    urls = [
+        f"/episodes/{id_episode}",
+        f"/episodes/{id_episode}/comments",
+        f"/episodes/{id_episode}/comments/{id_comment}/replies",
+    ]
+    counts = []
+    for start, end in [(1, 1), (1, 6)]:
+        add_comments(app, id_episode, start, end)
+        counts.append({})
+        for url in urls:
+            with count_queries() as statements:
+                response = client.get(url)
+            assert response.status_code == 200, url
+            counts[-1][url] = len(statements)
+
+    assert counts[0] == counts[1]
+    # the episode, then the comments and the replies
+    assert counts[1][f"/episodes/{id_episode}/comments"] == 3
+    assert len(client.get(urls[1]).get_json()[0]["replies"]) == 2
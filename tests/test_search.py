@@ -1,13 +1,33 @@
+import io
+import random
+import time
+
 import pytest
+from Levenshtein import distance as levenshtein
+from sqlalchemy import select, update
 from werkzeug.security import generate_password_hash
 
 from app import create_app
-from models import Podcast, User, db
+from utils import autocomplete
+from utils.autocomplete import AUTOCOMPLETE_COLUMNS, PrefixIndex
+from utils.scoring import batch_distances, top_matches
+from models import Episode, Favorite, Follow, Podcast, User, db
+from utils.search import (
+    BKTree,
+    NameIndex,
+    best_matches,
+    length_window,
+    match_distance,
+    normalized_distance,
+    score_by_length,
+    score_names,
+)
 
 
-@pytest.fixture
-def app():
+@pytest.fixture(params=["database", "bktree"])
+def app(request):
     app = create_app(testing=True)
+    app.config["SEARCH_BACKEND"] = request.param
     with app.app_context():
         db.create_all()
     yield app
@@ -190,3 +210,578 @@ def test_search_perfect_match(app):
     # Image from non-existent user
     response = client.get(f"/users/00000000-0000-0000-0000-000000000000/image")
     assert response.status_code == 404
+
+
+def test_search_normalized_name(app):
+    with app.app_context():
+        user = User(
+            email="test@example.com",
+            username="Carl Sagan",
+            password=generate_password_hash("Test1234"),
+            verified=True,
+        )
+        db.session.add(user)
+        db.session.commit()
+        podcast = Podcast(
+            cover=b"",
+            name="Música Clásica",
+            summary="summary",
+            description="description",
+            id_author=user.id,
+        )
+        db.session.add(podcast)
+        db.session.commit()
+        id_podcast = podcast.id
+        assert podcast.normalized_name == "musica clasica"
+        assert user.normalized_username == "carl sagan"
+
+    client = app.test_client()
+
+    # Perfect matches do not consider uppercase and accents either
+    response = client.get("/search/podcast/MUSICA CLÁSICA")
+    assert response.status_code == 201
+    assert response.get_json()[0]["match_percentage"] == 100
+    response = client.get("/search/user/carl sagán")
+    assert response.status_code == 201
+    assert response.get_json()[0]["username"] == "Carl Sagan"
+
+    response = client.get("/search/podcast/musica clasika")
+    assert response.status_code == 200
+    assert response.get_json()[0]["name"] == "Música Clásica"
+
+    # Renaming keeps the normalized name in sync
+    client.post("/login", json={"email": "test@example.com", "password": "Test1234"})
+    response = client.put(f"/podcasts/{id_podcast}", data={"name": "Ópera"})
+    assert response.status_code == 201
+    response = client.get("/search/podcast/opera!")
+    assert response.status_code == 200
+    assert response.get_json()[0]["name"] == "Ópera"
+    assert response.get_json()[0]["match_percentage"] == 83.33
+    response = client.get("/search/podcast/musica clasika")
+    assert response.status_code == 404
+
+    # Existing rows are filled in by `flask db upgrade`
+    with app.app_context():
+        db.session.execute(update(Podcast).values(normalized_name=None))
+        db.session.execute(update(User).values(normalized_username=None))
+        db.session.commit()
+    result = app.test_cli_runner().invoke(args=["db", "upgrade"])
+    assert "Normalized 1 podcast names" in result.output
+    assert "Normalized 1 user usernames" in result.output
+    with app.app_context():
+        assert db.session.get(Podcast, id_podcast).normalized_name == "opera"
+        assert db.session.scalar(select(User.normalized_username)) == "carl sagan"
+
+
+def test_search_short_names(app):
+    """Names 1 edit away from a short query share almost no trigrams with it."""
+    with app.app_context():
+        user = User(email="test@example.com", username="Carl Sagan", password="")
+        db.session.add(user)
+        db.session.flush()
+        for name in ["bat", "hat", "mat", "dog"]:
+            db.session.add(
+                Podcast(name=name, summary="", description="", id_author=user.id)
+            )
+        db.session.commit()
+    response = app.test_client().get("/search/podcast/cat")
+    assert response.status_code == 200
+    # the ties are ordered by their random ids
+    assert sorted(p["name"] for p in response.get_json()) == ["bat", "hat", "mat"]
+    assert {p["match_percentage"] for p in response.get_json()} == {66.67}
+
+
+def test_name_index():
+    random.seed(0)
+    names = {
+        "".join(random.choices("abcdefghij ", k=random.randint(1, 12)))
+        for _ in range(2000)
+    }
+    index = NameIndex()
+    tree = BKTree()
+    for name in names:
+        index.add(name, name)
+        tree.add(name, name)
+    for query in ["abc", "hello world", "a", "jjjjjjjjjjjj"]:
+        expected = {
+            name: normalized_distance(name, query)
+            for name in names
+            if normalized_distance(name, query) <= 0.45
+        }
+        assert dict(index.search(query)) == expected
+        for radius in [1, 3]:
+            expected = {name for name in names if levenshtein(name, query) <= radius}
+            assert {name for name, _, _ in tree.search(query, radius)} == expected
+            assert {name for name, _, _ in tree.scan(query, radius)} == expected
+
+    index.add("abc", "other")
+    index.remove("abc", "other")
+    assert "other" not in dict(index.search("abc"))
+
+
+def test_search_index_updates(app):
+    client = app.test_client()
+    response = client.post(
+        "/user",
+        data={
+            "username": "Carl Sagan",
+            "email": "carl@example.com",
+            "password": "Test1234",
+            "image": (io.BytesIO(b""), "image.jpg"),
+        },
+    )
+    assert response.status_code == 201
+    client.post("/login", json={"email": "carl@example.com", "password": "Test1234"})
+
+    # the index is built by the first search and then kept up to date
+    assert client.get("/search/podcast/cosmos").status_code == 404
+    response = client.post(
+        "/podcasts",
+        data={
+            "name": "Cosmos",
+            "summary": "summary",
+            "description": "description",
+            "cover": (io.BytesIO(b""), "cover.jpg"),
+        },
+    )
+    assert response.status_code == 201
+    id_podcast = response.get_json()["id"]
+    assert client.get("/search/podcast/cosmo").get_json()[0]["name"] == "Cosmos"
+
+    response = client.put(f"/podcasts/{id_podcast}", data={"name": "Contact"})
+    assert client.get("/search/podcast/cosmo").status_code == 404
+    assert client.get("/search/podcast/contac").get_json()[0]["name"] == "Contact"
+
+    response = client.delete(f"/podcasts/{id_podcast}")
+    assert response.status_code == 200
+    assert client.get("/search/podcast/contac").status_code == 404
+
+    assert client.get("/search/user/carl sagn").get_json()[0]["username"] == "Carl Sagan"
+
+
+def test_length_window():
+    for length in range(1, 40):
+        shortest, longest = length_window(length)
+        query = "a" * length
+        # names outside the window can never be within the threshold
+        for other in range(1, 80):
+            if not shortest <= other <= longest:
+                assert normalized_distance("a" * other, query) > 0.45
+        assert normalized_distance("a" * shortest, query) <= 0.45
+        assert normalized_distance("a" * longest, query) <= 0.45
+
+    assert match_distance("carl sagan", "carl sagn") == 0.1
+    assert match_distance("carlos latre", "pirlo") is None
+    assert best_matches([("a", 0.3), ("b", 0.1), ("c", 0.2)], limit=2) == [
+        ("b", 0.1),
+        ("c", 0.2),
+    ]
+
+
+def test_search_limit(app):
+    with app.app_context():
+        for i, username in enumerate(["Carl", "Carla", "Carlos", "Carlota", "Karl"]):
+            db.session.add(
+                User(
+                    email=f"test{i}@example.com",
+                    username=username,
+                    password=generate_password_hash("Test1234"),
+                )
+            )
+        db.session.commit()
+
+    client = app.test_client()
+    response = client.get("/search/user/carlo")
+    assert [user["match_percentage"] for user in response.get_json()] == [
+        83.33,
+        80.0,
+        80.0,
+        71.43,
+        60.0,
+    ]
+    response = client.get("/search/user/carlo?limit=2")
+    assert [user["match_percentage"] for user in response.get_json()] == [83.33, 80.0]
+
+
+def test_search_episode(app):
+    with app.app_context():
+        user = User(
+            email="test@example.com",
+            username="Carl Sagan",
+            password=generate_password_hash("Test1234"),
+        )
+        db.session.add(user)
+        db.session.commit()
+        podcast = Podcast(
+            name="Cosmos",
+            summary="Space",
+            description="A personal voyage",
+            id_author=user.id,
+        )
+        db.session.add(podcast)
+        db.session.commit()
+        for title, description, tags in [
+            ("Los planetas", "Un viaje por el sistema solar", ["Ciencia"]),
+            ("Las estrellas", "Viajes a los planetas lejanos", ["Astronomía"]),
+            ("Entrevista a Carl", "Hablamos de ciencia", ["Ciencia", "Planetas"]),
+        ]:
+            episode = Episode(
+                title=title, description=description, id_podcast=podcast.id
+            )
+            episode.set_tags(tags)
+            db.session.add(episode)
+        db.session.commit()
+
+    client = app.test_client()
+    assert client.get("/search/episode").status_code == 400
+
+    # the title weighs more than the tags and the description
+    response = client.get("/search/episode?q=planeta")
+    assert response.status_code == 200
+    assert [e["title"] for e in response.get_json()] == [
+        "Los planetas",
+        "Entrevista a Carl",
+        "Las estrellas",
+    ]
+    assert response.get_json()[0]["podcast_name"] == "Cosmos"
+    assert response.get_json()[0]["tags"] == ["Ciencia"]
+
+    # words are stemmed in spanish: viaje and viajes
+    response = client.get("/search/episode?q=viaje")
+    assert {e["title"] for e in response.get_json()} == {
+        "Los planetas",
+        "Las estrellas",
+    }
+    response = client.get("/search/episode?q=astronomía")
+    assert [e["title"] for e in response.get_json()] == ["Las estrellas"]
+    response = client.get("/search/episode?q=carl ciencia")
+    assert [e["title"] for e in response.get_json()] == ["Entrevista a Carl"]
+    assert client.get("/search/episode?q=galaxias").get_json() == []
+
+    response = client.get("/search/episode?q=planeta&limit=1&offset=1")
+    assert [e["title"] for e in response.get_json()] == ["Entrevista a Carl"]
+    first = client.get("/search/episode?q=planeta&limit=1").get_json()
+    response = client.get("/search/episode?q=planeta&limit=-1&offset=-1")
+    assert response.status_code == 200
+    assert response.get_json() == first
+
+    with app.app_context():
+        episode = db.session.scalars(
+            select(Episode).where(Episode.title == "Las estrellas")
+        ).one()
+        episode.title = "Las galaxias"
+        db.session.commit()
+    response = client.get("/search/episode?q=galaxias")
+    assert [e["title"] for e in response.get_json()] == ["Las galaxias"]
+
+
+def test_autocomplete(app):
+    with app.app_context():
+        users = [
+            User(
+                email=f"test{i}@example.com",
+                username=username,
+                password=generate_password_hash("Test1234"),
+            )
+            for i, username in enumerate(["Carl", "Carla", "Carlos", "Andreu"])
+        ]
+        db.session.add_all(users)
+        db.session.commit()
+        podcasts = [
+            Podcast(name=name, summary="", description="", id_author=users[0].id)
+            for name in ["Cosmos", "Cósmico", "Ciencia"]
+        ]
+        db.session.add_all(podcasts)
+        db.session.commit()
+        db.session.add_all(
+            [
+                Follow(id_follower=users[0].id, id_followed=users[2].id),
+                Follow(id_follower=users[1].id, id_followed=users[2].id),
+                Follow(id_follower=users[2].id, id_followed=users[1].id),
+                Favorite(id_user=users[0].id, id_podcast=podcasts[1].id),
+            ]
+        )
+        db.session.commit()
+        id_andreu, id_cosmos = str(users[3].id), str(podcasts[0].id)
+        id_cosmico = str(podcasts[1].id)
+
+    client = app.test_client()
+    assert client.get("/autocomplete").status_code == 400
+    assert client.get("/autocomplete?q=c&type=episode").status_code == 400
+
+    # the most followed first
+    response = client.get("/autocomplete?q=CAR&type=user")
+    assert response.status_code == 200
+    assert [(u["name"], u["popularity"]) for u in response.get_json()] == [
+        ("Carlos", 2),
+        ("Carla", 1),
+        ("Carl", 0),
+    ]
+    response = client.get("/autocomplete?q=cos&type=podcast")
+    assert [p["name"] for p in response.get_json()] == ["Cósmico", "Cosmos"]
+    response = client.get("/autocomplete?q=c&limit=1")
+    assert [(s["name"], s["type"]) for s in response.get_json()] == [
+        ("Carlos", "user")
+    ]
+    assert client.get("/autocomplete?q=x").get_json() == []
+
+    # the index is kept up to date
+    client.post("/login", json={"email": "test0@example.com", "password": "Test1234"})
+    client.post("/favorites", json={"id": id_cosmos})
+    client.post("/favorites", json={"id": id_cosmos})  # already a favorite
+    client.delete(f"/favorites/{id_cosmico}")
+    response = client.get("/autocomplete?q=cos&type=podcast")
+    assert [(p["name"], p["popularity"]) for p in response.get_json()] == [
+        ("Cosmos", 1),
+        ("Cósmico", 0),
+    ]
+
+    client.put(f"/podcasts/{id_cosmos}", data={"name": "Universo"})
+    response = client.get("/autocomplete?q=cos&type=podcast")
+    assert [p["name"] for p in response.get_json()] == ["Cósmico"]
+    response = client.get("/autocomplete?q=uni&type=podcast")
+    assert [(p["name"], p["popularity"]) for p in response.get_json()] == [
+        ("Universo", 1)
+    ]
+    client.delete(f"/podcasts/{id_cosmos}")
+    assert client.get("/autocomplete?q=uni&type=podcast").get_json() == []
+
+    client.post("/follows", json={"id": id_andreu})
+    response = client.get("/autocomplete?q=andreu&type=user")
+    assert response.get_json() == [
+        {
+            "id": id_andreu,
+            "name": "Andreu",
+            "type": "user",
+            "popularity": 1,
+        }
+    ]
+    client.delete(f"/follows/{id_andreu}")
+    response = client.get("/autocomplete?q=andreu&type=user")
+    assert response.get_json()[0]["popularity"] == 0
+
+    # the changes made by other processes show up once the index expires
+    with app.app_context():
+        db.session.execute(
+            update(User)
+            .where(User.id == id_andreu)
+            .values(username="Andrea", normalized_username="andrea")
+        )
+        db.session.commit()
+    response = client.get("/autocomplete?q=andrea&type=user")
+    assert response.get_json() == []
+    app.extensions["autocomplete_indexes"]["user"].built_at -= (
+        app.config["AUTOCOMPLETE_TTL"] + 1
+    )
+    response = client.get("/autocomplete?q=andrea&type=user")
+    assert [u["name"] for u in response.get_json()] == ["Andrea"]
+
+
+def test_autocomplete_kept_tops(monkeypatch):
+    """The most popular names kept for a prefix follow the changes."""
+    monkeypatch.setattr(autocomplete, "TOP_CACHE_MIN_NAMES", 2)
+    index = PrefixIndex(*AUTOCOMPLETE_COLUMNS["user"], ttl=60)
+    names = ["carl", "carla", "carlos", "cosmo", "dan", "carmen"]
+    index.rows = {id: [name, name, id] for id, name in enumerate(names)}
+    index.keys = sorted((name, id) for id, name in enumerate(names))
+    index.built_at = time.monotonic()
+
+    def complete(prefix):
+        return [name for _, name, _ in index.complete(None, prefix, 3)]
+
+    assert complete("c") == ["carmen", "cosmo", "carlos"]
+    assert complete("car") == ["carmen", "carlos", "carla"]
+    assert "c" in index.top and "car" in index.top
+    index.add_popularity(0, 10)
+    assert complete("c") == ["carl", "carmen", "cosmo"]
+    index.add_popularity(5, -10)
+    assert complete("car") == ["carl", "carlos", "carla"]
+    index.put(4, "carlota")
+    assert complete("carl") == ["carl", "carlota", "carlos"]
+    index.discard(0)
+    assert complete("c") == ["carlota", "cosmo", "carlos"]
+    assert complete("d") == []
+
+
+def test_search_all(app):
+    with app.app_context():
+        user = User(
+            email="test@example.com",
+            username="Carl Sagan",
+            password=generate_password_hash("Test1234"),
+        )
+        db.session.add(user)
+        db.session.commit()
+        for name in ["Cosmos", "Cosmic", "Ciencia"]:
+            db.session.add(
+                Podcast(name=name, summary="", description="", id_author=user.id)
+            )
+        db.session.commit()
+        podcast = db.session.scalars(select(Podcast).filter_by(name="Cosmos")).one()
+        db.session.add(
+            Episode(
+                title="Cosmos y Carl Sagan",
+                description="Un viaje",
+                id_podcast=podcast.id,
+            )
+        )
+        db.session.commit()
+
+    client = app.test_client()
+    assert client.get("/search").status_code == 400
+
+    response = client.get("/search?q=cosmos")
+    assert response.status_code == 200
+    results = response.get_json()
+    assert [(p["name"], p["match_percentage"]) for p in results["podcasts"]] == [
+        ("Cosmos", 100),
+        ("Cosmic", 66.67),
+    ]
+    assert results["podcasts"][0]["author"]["username"] == "Carl Sagan"
+    assert results["users"] == []
+    assert [e["title"] for e in results["episodes"]] == ["Cosmos y Carl Sagan"]
+
+    for limit in [1, 0, -3]:
+        results = client.get(f"/search?q=carl sagn&limit={limit}").get_json()
+        assert [u["username"] for u in results["users"]] == ["Carl Sagan"]
+        assert results["podcasts"] == []
+        assert results["episodes"] == []
+
+
+def test_search_cache(app):
+    client = app.test_client()
+    client.post(
+        "/user",
+        data={
+            "username": "Carl Sagan",
+            "email": "test@example.com",
+            "password": "Test1234",
+            "image": (io.BytesIO(b""), "image.jpg"),
+        },
+    )
+    client.post("/login", json={"email": "test@example.com", "password": "Test1234"})
+    response = client.post(
+        "/podcasts",
+        data={
+            "name": "Cosmos",
+            "summary": "Space",
+            "description": "A personal voyage",
+            "cover": (io.BytesIO(b""), "cover.jpg"),
+        },
+    )
+    id_podcast = response.get_json()["id"]
+
+    response = client.get("/search/podcast/cosmo")
+    assert response.get_json()[0]["description"] == "A personal voyage"
+    assert client.get("/search/podcast/cosmo").get_json() == response.get_json()
+    stats = client.get("/stats").get_json()["search_cache"]
+    assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (1, 1, 0.5)
+    assert stats["time_saved_ms"] >= 0
+
+    # edits are shown and renames change the results
+    client.put(f"/podcasts/{id_podcast}", data={"description": "Carl Sagan"})
+    response = client.get("/search/podcast/cosmo")
+    assert response.get_json()[0]["description"] == "Carl Sagan"
+    client.put(f"/podcasts/{id_podcast}", data={"name": "Contact"})
+    assert client.get("/search/podcast/cosmo").status_code == 404
+    assert client.get("/search/podcast/contac").get_json()[0]["name"] == "Contact"
+
+    assert client.get("/search/user/carl sagn").get_json()[0]["match_percentage"] == 90
+    client.post(
+        "/user",
+        data={
+            "username": "Carl Sagen",
+            "email": "test2@example.com",
+            "password": "Test1234",
+            "image": (io.BytesIO(b""), "image.jpg"),
+        },
+    )
+    assert len(client.get("/search/user/carl sagn").get_json()) == 2
+
+
+def test_search_pages(app):
+    with app.app_context():
+        for i, username in enumerate(["Carl", "Carla", "Carlos", "Carlota", "Karl"]):
+            for j in range(3):  # ties are ordered by id
+                db.session.add(
+                    User(
+                        email=f"test{i}{j}@example.com",
+                        username=f"{username}{j}",
+                        password=generate_password_hash("Test1234"),
+                    )
+                )
+        db.session.commit()
+
+    client = app.test_client()
+    everything = client.get("/search/user/carlo").get_json()
+    assert "X-Next-Cursor" not in client.get("/search/user/carlo").headers
+    keys = [(-user["match_percentage"], user["id"]) for user in everything]
+    assert keys == sorted(keys)
+
+    pages, cursor = [], None
+    while True:
+        url = "/search/user/carlo?limit=4" + (f"&cursor={cursor}" if cursor else "")
+        response = client.get(url)
+        assert response.status_code == 200
+        pages.append(response.get_json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert [len(page) for page in pages[:-1]] == [4] * (len(pages) - 1)
+    assert [user for page in pages for user in page] == everything
+
+    response = client.get("/search/user/carlo?cursor=nope")
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "Invalid cursor"}
+
+    # pages of less than one match have one
+    for limit in [0, -5]:
+        for url in ["/search/user/carlo", "/search/podcast/carlo"]:
+            response = client.get(f"{url}?limit={limit}")
+            assert response.status_code in (200, 404), url
+        response = client.get(f"/search/user/carlo?limit={limit}")
+        assert response.get_json() == everything[:1]
+
+
+def test_score_names():
+    names = [(i, name) for i, name in enumerate(["abcd", "abce", "abc", "abcdefgh"])]
+    assert score_names(names, "abcd") == [(0, 0.0), (1, 0.25), (2, 0.25)]
+    assert score_names(names, "abcd", limit=2) == [(0, 0.0), (1, 0.25)]
+    assert score_names(names, "abcd", limit=1, after=(0.0, 0)) == [(1, 0.25)]
+
+    # with enough matches better than the bound of the next length, the
+    # other lengths are not scored
+    scored = []
+
+    def score(length, group):
+        scored.append(length)
+        return [(id, normalized_distance(name, "abcd")) for id, name in group]
+
+    groups = {4: [(0, "abcd"), (1, "abce")], 3: [(2, "abc")], 6: [(3, "abcdef")]}
+    assert score_by_length(groups, "abcd", score, limit=1) == [(0, 0.0)]
+    assert scored == [4]
+    # abc could tie with abce, 0.25 away
+    assert score_by_length(groups, "abcd", score, limit=2) == [(0, 0.0), (1, 0.25)]
+    assert scored == [4, 4, 3]
+
+
+def test_batch_scoring():
+    random.seed(1)
+    names = ["".join(random.choices("abc", k=random.randint(1, 8))) for _ in range(500)]
+    ids = list(range(len(names)))
+    query = "abcab"
+    distances = batch_distances(query, names, 0.45)
+    expected = best_matches(
+        (id, match_distance(name, query))
+        for id, name in enumerate(names)
+        if match_distance(name, query) is not None
+    )
+    assert top_matches(ids, distances, 0.45) == expected
+    # many ties, the pages are still the same
+    for limit in [1, 7, 50]:
+        assert top_matches(ids, distances, 0.45, limit) == expected[:limit]
+        after = (expected[limit][1], expected[limit][0])
+        assert top_matches(ids, distances, 0.45, limit, after) == (
+            expected[limit + 1 : 2 * limit + 1]
+        )
+    assert top_matches([], batch_distances(query, [], 0.45), 0.45) == []
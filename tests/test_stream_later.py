@@ -96,7 +96,7 @@ def test_get_stream_later(app, data):
     ]
     response = client.get("/stream_later")
     assert response.status_code == 200
-    assert response.get_json() == expected_response
+    assert response.get_json() == sorted(expected_response, key=lambda x: x["id"])
 
 
 def test_get_stream_later_by_id(app, data):
@@ -0,0 +1,199 @@
+import os
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+from app import create_app
+from models import Episode, Follow, Notification, Podcast, UploadSession, User, db
+
+
+@pytest.fixture
+def app():
+    app = create_app(testing=True)
+    with app.app_context():
+        db.create_all()
+    yield app
+    with app.app_context():
+        db.drop_all()
+
+
+@pytest.fixture
+def data(app):
+    with app.app_context():
+        author = User(
+            email="test@example.com",
+            username="test",
+            password=generate_password_hash("Test1234"),
+            verified=True,
+        )
+        follower = User(
+            email="follower@example.com",
+            username="follower",
+            password=generate_password_hash("Test1234"),
+            verified=True,
+        )
+        db.session.add_all([author, follower])
+        db.session.commit()
+        db.session.add(Follow(id_follower=follower.id, id_followed=author.id))
+        podcast = Podcast(
+            name="podcast",
+            summary="summary",
+            description="description",
+            id_author=author.id,
+        )
+        db.session.add(podcast)
+        db.session.commit()
+        yield {
+            "id_author": author.id,
+            "id_follower": follower.id,
+            "id_podcast": podcast.id,
+        }
+
+
+def login(client, email="test@example.com"):
+    response = client.post("/login", json={"email": email, "password": "Test1234"})
+    assert response.status_code == 200
+
+
+def test_resumable_upload(app, data):
+    client = app.test_client()
+    url = f"/podcasts/{data['id_podcast']}/uploads"
+    audio = os.urandom(2500)
+    session = {
+        "title": "episode",
+        "description": "description",
+        "tags": "chill#cooking",
+        "size": len(audio),
+    }
+
+    # Unauthenticated
+    response = client.post(url, json=session)
+    assert response.status_code == 401
+
+    # Only the author can upload episodes
+    login(client, "follower@example.com")
+    response = client.post(url, json=session)
+    assert response.status_code == 404
+
+    login(client)
+    response = client.post(url, json={**session, "title": ""})
+    assert response.status_code == 400
+    for field, value in [("title", 123), ("description", None), ("tags", ["a"])]:
+        response = client.post(url, json={**session, field: value})
+        assert response.status_code == 400, field
+    response = client.post(url, json=[session])
+    assert response.status_code == 400
+    response = client.post(url, json={**session, "size": 10**12})
+    assert response.status_code == 413
+    response = client.post(url, json=session)
+    assert response.status_code == 201
+    id_upload = response.get_json()["id"]
+    assert response.get_json()["received"] == 0
+
+    # Chunks can arrive out of order and be retried
+    response = client.put(
+        f"/uploads/{id_upload}/chunks/2?offset=2000", data=audio[2000:]
+    )
+    assert response.status_code == 200
+    response = client.put(f"/uploads/{id_upload}/chunks/0?offset=0", data=b"broken")
+    assert response.status_code == 200
+    response = client.put(f"/uploads/{id_upload}/chunks/0?offset=0", data=audio[:1000])
+    assert response.status_code == 200
+    assert response.get_json()["received"] == 1500
+
+    # Chunk past the declared size
+    response = client.put(f"/uploads/{id_upload}/chunks/3?offset=2400", data=b"x" * 200)
+    assert response.status_code == 413
+
+    # Missing chunk
+    response = client.post(f"/uploads/{id_upload}/finalize")
+    assert response.status_code == 409
+    assert response.get_json()["missing_from"] == 1000
+
+    # Resume
+    response = client.get(f"/uploads/{id_upload}")
+    assert response.status_code == 200
+    assert [c["index"] for c in response.get_json()["chunks"]] == [0, 2]
+    response = client.put(
+        f"/uploads/{id_upload}/chunks/1?offset=1000", data=audio[1000:2000]
+    )
+    assert response.status_code == 200
+
+    response = client.post(f"/uploads/{id_upload}/finalize")
+    assert response.status_code == 201
+    id_episode = response.get_json()["id"]
+
+    response = client.get(f"/episodes/{id_episode}")
+    assert response.get_json()["tags"] == ["chill", "cooking"]
+    response = client.get(f"/episodes/{id_episode}/audio")
+    assert response.data == audio
+
+    with app.app_context():
+        assert db.session.get(UploadSession, id_upload) is None
+        notifications = db.session.query(Notification).all()
+        assert len(notifications) == 1
+        assert notifications[0].id_user == data["id_follower"]
+        assert notifications[0].type == "new_episode"
+    assert os.listdir(app.config["UPLOAD_SESSION_PATH"]) == []
+
+    # Duplicate title
+    response = client.post(url, json=session)
+    assert response.status_code == 400
+
+
+def test_expired_uploads(app, data):
+    client = app.test_client()
+    login(client)
+    response = client.post(
+        f"/podcasts/{data['id_podcast']}/uploads",
+        json={"title": "episode", "description": "d", "size": 10},
+    )
+    id_upload = response.get_json()["id"]
+    client.put(f"/uploads/{id_upload}/chunks/0?offset=0", data=b"12345")
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["db", "gc-uploads"])
+    assert "Deleted 0 expired uploads" in result.output
+
+    with app.app_context():
+        upload = db.session.get(UploadSession, id_upload)
+        upload.expires_at = datetime.now(timezone.utc) - timedelta(minutes=1)
+        db.session.commit()
+
+    # an expired session cannot be resumed before it is garbage collected
+    response = client.get(f"/uploads/{id_upload}")
+    assert response.status_code == 404
+    response = client.put(f"/uploads/{id_upload}/chunks/1?offset=5", data=b"67890")
+    assert response.status_code == 404
+
+    result = runner.invoke(args=["db", "gc-uploads"])
+    assert "Deleted 1 expired uploads" in result.output
+    assert os.listdir(app.config["UPLOAD_SESSION_PATH"]) == []
+    response = client.get(f"/uploads/{id_upload}")
+    assert response.status_code == 404
+    with app.app_context():
+        assert db.session.query(Episode).count() == 0
+
+
+def test_orphaned_upload_chunks(app, data):
+    client = app.test_client()
+    login(client)
+    response = client.post(
+        f"/podcasts/{data['id_podcast']}/uploads",
+        json={"title": "episode", "description": "d", "size": 10},
+    )
+    id_upload = response.get_json()["id"]
+    client.put(f"/uploads/{id_upload}/chunks/0?offset=0", data=b"12345")
+
+    # the session goes away with its podcast, its chunks stay on disk
+    with app.app_context():
+        db.session.delete(db.session.get(Podcast, data["id_podcast"]))
+        db.session.commit()
+        assert db.session.get(UploadSession, id_upload) is None
+    assert os.listdir(app.config["UPLOAD_SESSION_PATH"]) == [id_upload]
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["db", "gc-uploads"])
+    assert "Deleted 0 expired uploads" in result.output
+    assert os.listdir(app.config["UPLOAD_SESSION_PATH"]) == []
@@ -0,0 +1,178 @@
+import bisect
+import heapq
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import func, select
+from sqlalchemy.orm import scoped_session
+
+from models import Favorite, Follow, Podcast, User
+from utils.search import normalize
+
+# type -> (name column, its normalized copy, column counted as popularity)
+AUTOCOMPLETE_COLUMNS = {
+    "podcast": (Podcast.name, Podcast.normalized_name, Favorite.id_podcast),
+    "user": (User.username, User.normalized_username, Follow.id_followed),
+}
+AUTOCOMPLETE_LIMIT = 10
+MAX_AUTOCOMPLETE_LIMIT = 50
+# prefixes of more names than this keep their most popular ones, the short
+# prefixes sent with the first keystrokes would be too slow to go through
+TOP_CACHE_MIN_NAMES = 1000
+
+
+class PrefixIndex:
+    """
+    Normalized names of a table in a sorted list, the names starting with a
+    prefix are then a contiguous slice found with bisect. The most popular
+    ones of the slice are picked with a heap, and kept for the prefixes of
+    many names.
+
+    It is built from the database the first time it is used and then kept
+    up to date by the views, like the SearchIndex. Every worker process has
+    its own copy, so it is also rebuilt after `ttl` seconds to pick up the
+    changes made in other processes. Meanwhile the old copy keeps answering.
+    """
+
+    def __init__(self, column, normalized, popularity, ttl: float):
+        self.model = column.class_
+        self.column = column
+        self.normalized = normalized
+        self.popularity = popularity
+        self.ttl = ttl
+        self.built_at = 0.0
+        self.building = False
+        self.keys = None  # sorted (normalized name, id)
+        self.rows = {}  # id -> [normalized name, name, popularity]
+        # prefix -> ids of its MAX_AUTOCOMPLETE_LIMIT most popular names
+        self.top = {}
+        self.lock = threading.Lock()
+
+    def _rank(self, id):
+        normalized, _, popularity = self.rows[id]
+        return -popularity, normalized
+
+    def build(self, session: scoped_session):
+        counts = dict(
+            session.execute(
+                select(self.popularity, func.count()).group_by(self.popularity)
+            ).all()
+        )
+        rows = {
+            id: [normalized, name, counts.get(id, 0)]
+            for id, name, normalized in session.execute(
+                select(self.model.id, self.column, self.normalized)
+            )
+        }
+        keys = sorted((row[0], id) for id, row in rows.items())
+        # the changes made while it was read are lost until the next build
+        with self.lock:
+            self.keys, self.rows, self.top = keys, rows, {}
+            self.built_at = time.monotonic()
+
+    def put(self, id, name: str):
+        """Add a row or rename it, ignored until the index is built."""
+        with self.lock:
+            if self.keys is None:
+                return
+            popularity = self._remove(id)
+            self.rows[id] = [normalize(name), name, popularity]
+            bisect.insort(self.keys, (self.rows[id][0], id))
+            self._promote(id)
+
+    def discard(self, id):
+        with self.lock:
+            if self.keys is not None:
+                self._remove(id)
+
+    def add_popularity(self, id, delta: int):
+        with self.lock:
+            if self.keys is None or id not in self.rows:
+                return
+            if delta < 0:
+                self._demote(id)
+            self.rows[id][2] += delta
+            if delta > 0:
+                self._promote(id)
+
+    def _remove(self, id) -> int:
+        """Remove a row, returns its popularity."""
+        if id not in self.rows:
+            return 0
+        self._demote(id)
+        row = self.rows.pop(id)
+        i = bisect.bisect_left(self.keys, (row[0], id))
+        del self.keys[i]
+        return row[2]
+
+    def _prefixes(self, id):
+        normalized = self.rows[id][0]
+        return (normalized[:i] for i in range(len(normalized) + 1))
+
+    def _promote(self, id):
+        """Move a row added or more popular up the kept tops it belongs to."""
+        rank = self._rank(id)
+        for prefix in self._prefixes(id):
+            top = self.top.get(prefix)
+            if top is None:
+                continue
+            if id in top:
+                top.sort(key=self._rank)
+            elif rank < self._rank(top[-1]):
+                bisect.insort(top, id, key=self._rank)
+                top.pop()
+
+    def _demote(self, id):
+        """
+        Forget the kept tops of a row removed or less popular, the next one
+        is not known without going through the names again.
+        """
+        for prefix in self._prefixes(id):
+            if id in self.top.get(prefix, ()):
+                del self.top[prefix]
+
+    def _best(self, prefix: str) -> list:
+        """The ids of the MAX_AUTOCOMPLETE_LIMIT most popular names."""
+        top = self.top.get(prefix)
+        if top is not None:
+            return top
+        # every name with the prefix sorts between these two keys
+        start = bisect.bisect_left(self.keys, (prefix,))
+        end = bisect.bisect_left(self.keys, (prefix + chr(0x10FFFF),), start)
+        top = heapq.nsmallest(
+            MAX_AUTOCOMPLETE_LIMIT,
+            (self.keys[i][1] for i in range(start, end)),
+            key=self._rank,
+        )
+        if end - start > TOP_CACHE_MIN_NAMES:
+            self.top[prefix] = top
+        return top
+
+    def complete(self, session: scoped_session, prefix: str, limit: int) -> list:
+        """The (id, name, popularity) of the most popular names with a prefix."""
+        prefix = normalize(prefix)
+        with self.lock:
+            expired = time.monotonic() - self.built_at > self.ttl
+            # a single request rebuilds an expired index
+            rebuild = self.keys is None or (expired and not self.building)
+            self.building = self.building or rebuild
+        if rebuild:
+            try:
+                self.build(session)
+            finally:
+                with self.lock:
+                    self.building = False
+        with self.lock:
+            best = self._best(prefix)[:limit]
+            return [(id, self.rows[id][1], self.rows[id][2]) for id in best]
+
+
+def get_autocomplete_index(type: str) -> PrefixIndex:
+    """The prefix index of a type of AUTOCOMPLETE_COLUMNS."""
+    indexes = current_app.extensions.setdefault("autocomplete_indexes", {})
+    if type not in indexes:
+        indexes[type] = PrefixIndex(
+            *AUTOCOMPLETE_COLUMNS[type], current_app.config["AUTOCOMPLETE_TTL"]
+        )
+    return indexes[type]
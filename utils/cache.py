@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe least recently used cache bounded by the total size of its
+    values in bytes rather than by their number. Values bigger than
+    `max_item_bytes` are not cached at all, so a single big file cannot
+    flush everything else.
+
+    Entries can be tagged with a group (e.g. the row they come from) to be
+    invalidated all at once when it changes. With a `ttl` they also expire
+    that many seconds after being put.
+
+    The sizes do not have to be bytes, caches of small objects can give
+    every entry a size of 1 to be bounded by their number.
+    """
+
+    def __init__(self, max_bytes: int, max_item_bytes: int = None, ttl: float = None):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes or max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (value, size, group, expires)
+        self.groups = {}  # group -> keys
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[3] is not None:
+                if entry[3] < time.monotonic():  # expired
+                    self._remove(key)
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size: int, group=None):
+        if size > self.max_item_bytes:
+            return
+        with self.lock:
+            self._remove(key)
+            expires = time.monotonic() + self.ttl if self.ttl else None
+            self.entries[key] = (value, size, group, expires)
+            self.groups.setdefault(group, set()).add(key)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, group):
+        with self.lock:
+            for key in list(self.groups.get(group, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.groups.clear()
+            self.bytes = 0
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        _, size, group, _ = entry
+        self.bytes -= size
+        keys = self.groups[group]
+        keys.discard(key)
+        if not keys:
+            del self.groups[group]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
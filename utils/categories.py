@@ -0,0 +1,72 @@
+import hashlib
+import os
+import unicodedata
+from typing import NamedTuple
+
+from flask import Flask, current_app
+
+from constants.constants import CATEGORIES
+from utils.images import sniff_mimetype
+from utils.media import media_url
+
+# the category images are shipped next to the list of categories
+IMAGES_PATH = os.path.normpath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "constants")
+)
+IMAGE_EXTENSIONS = (".png", ".jpg")
+
+
+class StaticImage(NamedTuple):
+    data: bytes
+    mimetype: str
+    checksum: str
+
+
+def normalize_filename(filename: str) -> str:
+    # file systems and clients disagree on how accents are encoded
+    return unicodedata.normalize("NFC", filename)
+
+
+def load_category_images(directory: str) -> dict:
+    """Read the image of every category, keyed by its file name."""
+    images = {}
+    for filename in os.listdir(directory):
+        stem, extension = os.path.splitext(normalize_filename(filename))
+        if stem not in CATEGORIES or extension not in IMAGE_EXTENSIONS:
+            continue
+        with open(os.path.join(directory, filename), "rb") as f:
+            data = f.read()
+        images[stem + extension] = StaticImage(
+            data, sniff_mimetype(data), hashlib.sha256(data).hexdigest()
+        )
+    return images
+
+
+def build_categories(images: dict) -> list:
+    """The payload of /categories, in the order of CATEGORIES."""
+    by_category = {os.path.splitext(name)[0]: name for name in images}
+    return [
+        {
+            "image_url": media_url(
+                f"/categories/images/{by_category[category]}",
+                images[by_category[category]].checksum,
+            ),
+            "title": category,
+        }
+        for category in CATEGORIES
+    ]
+
+
+def init_categories(app: Flask, directory: str = IMAGES_PATH):
+    images = load_category_images(directory)
+    app.extensions["category_images"] = images
+    app.extensions["categories"] = build_categories(images)
+
+
+def get_category_image(filename: str):
+    """The preloaded image, or None when there is no such category image."""
+    return current_app.extensions["category_images"].get(normalize_filename(filename))
+
+
+def get_category_list() -> list:
+    return current_app.extensions["categories"]
@@ -0,0 +1,262 @@
+import io
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from multiprocessing import get_context
+from typing import NamedTuple
+
+from flask import Flask, current_app, request, send_file
+from PIL import Image, ImageOps, UnidentifiedImageError
+from sqlalchemy import update
+
+from models import db
+from utils.cache import LRUCache
+from utils.media import add_validators, not_modified
+from utils.storage import BlobStore, StoredBlob, get_blob_store
+
+# longest side in pixels of the pre-generated versions of every image
+COVER_SIZES = (64, 256, 1024)
+AVATAR_SIZES = (64, 256)
+RENDITION_FORMAT = "WEBP"
+RENDITION_MIMETYPE = "image/webp"
+RENDITION_QUALITY = 80
+
+# (offset, magic bytes, mimetype)
+SIGNATURES = [
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (8, b"WEBP", "image/webp"),
+]
+SNIFF_LENGTH = 16
+
+
+def sniff_mimetype(head: bytes) -> str:
+    """Detect the type of an image from its first bytes."""
+    for offset, magic, mimetype in SIGNATURES:
+        if head[offset : offset + len(magic)] == magic:
+            return mimetype
+    return "application/octet-stream"
+
+
+def render_renditions(data: bytes, sizes) -> dict:
+    """
+    Resize an image to every size smaller than the original. Returns the
+    encoded renditions as {size: bytes}, or an empty dict when the data is
+    not an image that can be decoded.
+
+    This is CPU-bound and runs in the worker processes of the pipeline, so
+    it only deals with bytes.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError):
+        return {}
+
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+    renditions = {}
+    for size in sizes:
+        if size >= max(image.size):
+            continue
+        resized = image.copy()
+        resized.thumbnail((size, size), Image.LANCZOS)
+        buffer = io.BytesIO()
+        resized.save(buffer, RENDITION_FORMAT, quality=RENDITION_QUALITY)
+        renditions[str(size)] = buffer.getvalue()
+    return renditions
+
+
+def pick_rendition(renditions: dict, size: int):
+    """The smallest rendition at least as big as the requested size."""
+    candidates = [int(s) for s in renditions or {} if int(s) >= size]
+    if not candidates:
+        return None
+    return renditions[str(min(candidates))]
+
+
+class CachedImage(NamedTuple):
+    data: bytes
+    mimetype: str
+    checksum: str
+    modified_at: datetime
+    version: str  # checksum of the original, the one URLs are versioned with
+
+
+def send_image(table: str, id, select_image, load_legacy):
+    """
+    Send a stored image or, with ?size=, its smallest rendition at least
+    that big. The original is sent when there is none (e.g. they are still
+    being generated or the image is smaller).
+
+    `select_image()` returns the key, checksum, modified_at, mimetype and
+    renditions of the image, or None when the row does not exist, and then
+    None is returned. Versioned URLs are answered from the media cache
+    without querying the database.
+    """
+    size = request.args.get("size", type=int)
+    version = request.args.get("v")
+    cache = get_media_cache()
+    cache_key = (table, str(id), version, size)
+    image = cache.get(cache_key) if version else None
+    if image is not None:
+        response = not_modified(image.checksum, image.modified_at)
+        if response:
+            return response
+    else:
+        row = select_image()
+        if row is None:
+            return None
+        key, checksum, mimetype = row.key, row.checksum, row.mimetype
+        rendition = pick_rendition(row.renditions, size) if size else None
+        if rendition:
+            key, checksum = rendition["key"], rendition["checksum"]
+            mimetype = RENDITION_MIMETYPE
+        response = not_modified(checksum, row.modified_at)
+        if response:
+            return response
+
+        if key is None:  # not moved to the blob store yet
+            data = load_legacy() or b""
+        else:
+            with get_blob_store().open(key) as f:
+                data = f.read()
+        # rows stored before the type was recorded
+        mimetype = mimetype or sniff_mimetype(data[:SNIFF_LENGTH])
+        image = CachedImage(data, mimetype, checksum, row.modified_at, row.checksum)
+        # only the current version is cached, its content never changes, so
+        # a process does not need to hear about edits made in another one.
+        # The original sent while the thumbnails are generated is not kept.
+        current = row.checksum is not None and version == row.checksum[:16]
+        if current and not (size and row.renditions is None):
+            cache.put(cache_key, image, len(data), group=(table, str(id)))
+
+    response = send_file(io.BytesIO(image.data), mimetype=image.mimetype)
+    return add_validators(response, image.checksum, image.modified_at, image.version)
+
+
+def store_image(store: BlobStore, stream):
+    """
+    Put an uploaded image in the store. Returns the arguments of the
+    `set_cover`/`set_image` methods of the models.
+    """
+    blob = store.put(stream)
+    return blob, sniff_mimetype(store.read(blob.key, 0, SNIFF_LENGTH))
+
+
+class ImagePipeline:
+    """
+    Generates the renditions of the uploaded images in a pool of worker
+    processes, so requests return as soon as the original is stored.
+    The renditions are written to the row when they are ready, as long as
+    the image was not replaced in the meantime.
+
+    At most `max_pending` images are queued. When the queue is full the
+    request waits up to `timeout` seconds for a slot and then renders the
+    image itself, which slows down uploads instead of letting the queue
+    grow without limit. With no workers every image is rendered inline.
+    """
+
+    def __init__(self, app: Flask, workers: int, max_pending: int, timeout: float):
+        self.app = app
+        self.workers = workers
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.executor = None
+        self.pending = 0
+        self.idle = threading.Condition()
+
+    def _get_executor(self):
+        if self.executor is None:
+            # spawned, forking a process with open database connections
+            # and threads is not safe
+            self.executor = ProcessPoolExecutor(
+                self.workers, mp_context=get_context("spawn")
+            )
+        return self.executor
+
+    def submit(self, model, id, column: str, blob: StoredBlob, sizes):
+        """Generate the renditions of the image `column` of a stored row."""
+        data = get_blob_store().read(blob.key, 0, blob.size)
+        if not self.workers or not self.slots.acquire(timeout=self.timeout):
+            self._save(model, id, column, blob, render_renditions(data, sizes))
+            return
+
+        with self.idle:
+            self.pending += 1
+        try:
+            future = self._get_executor().submit(render_renditions, data, sizes)
+        except Exception as e:
+            self._release()
+            if isinstance(e, BrokenProcessPool):
+                # a worker died, the next image starts a new pool
+                self.executor = None
+            self.app.logger.exception(f"Could not queue {model.__name__} {id}")
+            self._save(model, id, column, blob, render_renditions(data, sizes))
+            return
+        future.add_done_callback(
+            lambda future: self._done(future, model, id, column, blob)
+        )
+
+    def _done(self, future, model, id, column, blob):
+        try:
+            with self.app.app_context():
+                self._save(model, id, column, blob, future.result())
+        except Exception:
+            self.app.logger.exception(f"Could not render {model.__name__} {id}")
+        finally:
+            self._release()
+
+    def _release(self):
+        self.slots.release()
+        with self.idle:
+            self.pending -= 1
+            self.idle.notify_all()
+
+    def _save(self, model, id, column, blob, renditions):
+        store = get_blob_store()
+        stored = {}
+        for size, data in renditions.items():
+            rendition = store.put_bytes(data)
+            stored[size] = {"key": rendition.key, "checksum": rendition.checksum}
+        checksum = getattr(model, f"{column}_checksum")
+        db.session.execute(
+            update(model)
+            .where(model.id == id, checksum == blob.checksum)
+            .values({f"{column}_renditions": stored})
+        )
+        db.session.commit()
+        get_media_cache().invalidate((model.__tablename__, str(id)))
+
+    def join(self, timeout=None) -> bool:
+        """Wait until the queued images are processed."""
+        with self.idle:
+            return self.idle.wait_for(lambda: self.pending == 0, timeout)
+
+
+def init_image_pipeline(app: Flask):
+    app.extensions["image_pipeline"] = ImagePipeline(
+        app,
+        app.config["IMAGE_WORKERS"],
+        app.config["IMAGE_QUEUE_SIZE"],
+        app.config["IMAGE_QUEUE_TIMEOUT"],
+    )
+
+
+def get_image_pipeline() -> ImagePipeline:
+    return current_app.extensions["image_pipeline"]
+
+
+def init_media_cache(app: Flask):
+    app.extensions["media_cache"] = LRUCache(
+        app.config["MEDIA_CACHE_SIZE"], app.config["MEDIA_CACHE_ITEM_SIZE"]
+    )
+
+
+def get_media_cache() -> LRUCache:
+    return current_app.extensions["media_cache"]
@@ -0,0 +1,136 @@
+from datetime import datetime
+
+from flask import Response, jsonify, request, stream_with_context
+from werkzeug.datastructures import ContentRange, Range
+
+# the content behind a versioned media URL never changes
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def media_url(path: str, checksum: str) -> str:
+    """
+    URL of a media file, versioned with its checksum when it is known so
+    browsers and CDNs can keep it forever.
+    """
+    if checksum is None:
+        return path
+    return f"{path}?v={checksum[:16]}"
+
+
+def not_modified(checksum: str, modified_at: datetime):
+    """
+    Return a 304 response when the copy the client has is still valid.
+    Only the stored validators are needed, not the file itself.
+    """
+    if checksum is None:
+        return None
+    if request.if_none_match:
+        if not request.if_none_match.contains(checksum):
+            return None
+    elif not (
+        request.if_modified_since
+        and modified_at
+        and modified_at.replace(microsecond=0) <= request.if_modified_since
+    ):
+        return None
+    return add_validators(Response(status=304), checksum, modified_at)
+
+
+def add_validators(
+    response: Response, checksum: str, modified_at: datetime, version: str = None
+):
+    """
+    `version` is the checksum the URL is versioned with, when it differs
+    from the one of the file sent (e.g. a thumbnail of a cover).
+    """
+    if checksum is None:
+        return response
+    response.set_etag(checksum)
+    response.last_modified = modified_at
+    if request.args.get("v") == (version or checksum)[:16]:
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+    else:
+        # unversioned URLs may change, but revalidating them is cheap
+        response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def resolve_byte_range(byte_range: Range, size: int):
+    """
+    Translate the parsed Range header of a request into a (start, stop)
+    pair (stop excluded) for a resource of the given size.
+    Returns None when the whole resource has to be sent and raises
+    ValueError when the requested range cannot be satisfied.
+    """
+    # multipart/byteranges is not supported, so multiple ranges are
+    # answered with the complete resource as the RFC allows
+    if byte_range is None or byte_range.units != "bytes":
+        return None
+    if len(byte_range.ranges) != 1:
+        return None
+
+    start, stop = byte_range.ranges[0]
+    if start < 0:  # suffix range, i.e. the last N bytes
+        start = max(size + start, 0)
+        stop = size
+    else:
+        stop = size if stop is None else min(stop, size)
+
+    if start >= stop:
+        raise ValueError("Range not satisfiable")
+    return start, stop
+
+
+def iter_chunks(read, start: int, stop: int, chunk_size: int):
+    """
+    Yield the bytes between start and stop calling `read` once per chunk,
+    so at most `chunk_size` bytes are held in memory at any time.
+    """
+    offset = start
+    while offset < stop:
+        length = min(chunk_size, stop - offset)
+        yield read(offset, length)
+        offset += length
+
+
+def send_byte_range(
+    read,
+    size: int,
+    byte_range: Range,
+    mimetype: str,
+    chunk_size: int,
+    checksum: str = None,
+    modified_at: datetime = None,
+):
+    """
+    Build the streamed response for a resource that supports partial
+    requests. `read(offset, length)` must return the requested window of
+    bytes, so only the bytes that are actually sent are fetched from the
+    database, one chunk at a time.
+    """
+    response = not_modified(checksum, modified_at)
+    if response:
+        return response
+
+    # a range of a file that changed since the client got the rest is useless
+    if "If-Range" in request.headers and request.if_range.etag != checksum:
+        byte_range = None
+
+    try:
+        window = resolve_byte_range(byte_range, size)
+    except ValueError:
+        response = jsonify({"success": False, "error": "Range not satisfiable"})
+        response.status_code = 416
+        response.headers["Content-Range"] = f"bytes */{size}"
+        return response
+
+    start, stop = window if window else (0, size)
+    # the request context keeps the database session alive while streaming
+    body = stream_with_context(iter_chunks(read, start, stop, chunk_size))
+    response = Response(body, mimetype=mimetype)
+    if window:
+        response.status_code = 206
+        response.content_range = ContentRange("bytes", start, stop, size)
+    response.content_length = stop - start
+    response.accept_ranges = "bytes"
+    return add_validators(response, checksum, modified_at)
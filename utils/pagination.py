@@ -0,0 +1,88 @@
+import base64
+import json
+from datetime import datetime
+
+from flask import jsonify, request
+from sqlalchemy import tuple_
+from sqlalchemy.orm import scoped_session
+
+from models import db
+
+# rows of a page of the list endpoints when ?limit= is not given, and at most
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values) -> str:
+    """Opaque ?cursor= of the page after the row with these sort keys."""
+    data = json.dumps([str(value) for value in values]).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def decode_cursor(cursor: str, types) -> list:
+    """
+    The sort keys of a cursor, converted to `types` (e.g. the python types
+    of the columns). Raises InvalidCursor if it is not a cursor of keys of
+    these types.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor))
+        if len(values) != len(types):
+            raise ValueError(f"Expected {len(types)} keys")
+        return [_from_string(type_, value) for type_, value in zip(types, values)]
+    except (TypeError, ValueError) as e:
+        raise InvalidCursor(f"Invalid cursor {cursor!r}") from e
+
+
+def _from_string(type_, value: str):
+    if type_ is datetime:
+        return datetime.fromisoformat(value)
+    return type_(value)
+
+
+def keyset_page(
+    session: scoped_session, statement, keys, limit: int, cursor=None, descending=True
+):
+    """
+    A page of the rows of `statement` sorted by the `keys` columns, all in
+    descending or all in ascending order. The last key has to be unique
+    (e.g. the id). Returns the rows and the cursor of the next page, or
+    None on the last page.
+
+    The page after a cursor starts where the previous one ended, which the
+    index of the keys finds directly, unlike an offset that reads and
+    discards all the rows before it. Raises InvalidCursor if the cursor is
+    invalid.
+    """
+    if cursor is not None:
+        types = [key.type.python_type for key in keys]
+        after = tuple_(*decode_cursor(cursor, types))
+        statement = statement.where(
+            tuple_(*keys) < after if descending else tuple_(*keys) > after
+        )
+    order = [key.desc() if descending else key.asc() for key in keys]
+    # one more row tells whether there is a next page
+    rows = session.scalars(statement.order_by(*order).limit(limit + 1)).all()
+    if len(rows) <= limit:
+        return rows, None
+    last = rows[limit - 1]
+    return rows[:limit], encode_cursor(getattr(last, key.key) for key in keys)
+
+
+def paginate(statement, keys, descending=True, page_size=PAGE_SIZE):
+    """`keyset_page` with the ?limit= and ?cursor= of the request."""
+    limit = min(request.args.get("limit", default=page_size, type=int), MAX_PAGE_SIZE)
+    cursor = request.args.get("cursor")
+    return keyset_page(db.session, statement, keys, max(limit, 1), cursor, descending)
+
+
+def page_response(items: list, next_cursor):
+    """The items of a page, with the cursor of the next one in X-Next-Cursor."""
+    response = jsonify(items)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
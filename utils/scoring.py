@@ -0,0 +1,44 @@
+import numpy as np
+from rapidfuzz.distance import Levenshtein
+from rapidfuzz.process import cdist
+
+
+def batch_distances(query: str, names, cutoff: float) -> np.ndarray:
+    """
+    Normalized Levenshtein distance between the query and every name, in
+    one call to the native kernel of rapidfuzz. The names further than
+    `cutoff` are not computed to the end and get 1.0.
+    """
+    if not len(names):
+        return np.empty(0)
+    return cdist(
+        [query],
+        names,
+        scorer=Levenshtein.normalized_distance,
+        score_cutoff=cutoff,
+        dtype=np.float64,
+    )[0]
+
+
+def top_matches(ids, distances: np.ndarray, cutoff: float, limit=None, after=None):
+    """
+    The (id, distance) pairs of the distances within `cutoff`, sorted from
+    the best match, ties by id, only the ones after the (distance, id)
+    `after` cursor. With a limit only the best `limit` are sorted, they
+    are picked with argpartition.
+    """
+    keep = distances <= cutoff
+    if after is not None:
+        # ties of the cursor are compared by id, they are only a few
+        ties = np.flatnonzero(keep & (distances == after[0]))
+        keep &= distances > after[0]
+        keep[[i for i in ties if ids[i] > after[1]]] = True
+    selected = np.flatnonzero(keep)
+
+    if limit is not None and len(selected) > limit:
+        kth = np.partition(distances[selected], limit - 1)[limit - 1]
+        # everything tied with the last one is kept to be ordered by id
+        selected = selected[distances[selected] <= kth]
+
+    matches = sorted((float(distances[i]), ids[i]) for i in selected)
+    return [(id, distance) for distance, id in matches[:limit]]
@@ -0,0 +1,494 @@
+import heapq
+import math
+import threading
+import time
+import uuid
+
+from flask import current_app
+from Levenshtein import distance as levenshtein_distance
+from sqlalchemy import cast, func, literal, select, union_all
+from sqlalchemy.dialects.postgresql import REGCONFIG
+from sqlalchemy.orm import scoped_session
+from unidecode import unidecode
+
+from utils.cache import LRUCache
+from utils.scoring import batch_distances, top_matches
+
+# matches further than this normalized Levenshtein distance are discarded
+MATCH_THRESHOLD = 0.45
+# text search configurations the episodes are indexed and searched with
+SEARCH_CONFIGS = ("spanish", "simple")
+# matches returned at once when ?limit= is not given, and at most
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+# the pages of matches are keyed by the (distance, id) of their last one
+SEARCH_CURSOR_TYPES = (float, uuid.UUID)
+
+
+def normalize(name: str) -> str:
+    # we do not consider uppercase and accents
+    return unidecode(name).lower()
+
+
+def normalized_distance(a: str, b: str) -> float:
+    """Levenshtein distance divided by the length of the longest string."""
+    longest = max(len(a), len(b))
+    if not longest:
+        return 0.0
+    return levenshtein_distance(a, b) / longest
+
+
+def match_percentage(distance: float) -> float:
+    return round(float((1 - distance) * 100), 2)
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree, a metric tree of strings under the Levenshtein
+    distance. The children of a node are keyed by their distance to it, so
+    by the triangle inequality a search within a radius r only has to
+    visit the children at a distance in [d - r, d + r] of each node.
+
+    Every node holds the ids of the rows with that string. Removing an id
+    leaves its node in place, as it is still needed to route searches.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.nodes = {}  # string -> [string, ids, children]
+
+    def add(self, string: str, id):
+        if string in self.nodes:
+            self.nodes[string][1].add(id)
+            return
+        new = self.nodes[string] = [string, {id}, {}]
+        if self.root is None:
+            self.root = new
+            return
+        node = self.root
+        while True:
+            d = levenshtein_distance(string, node[0])
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = new
+                return
+            node = child
+
+    def remove(self, string: str, id):
+        if string in self.nodes:
+            self.nodes[string][1].discard(id)
+
+    def search(self, string: str, radius: int):
+        """Yield the (string, ids, distance) of the nodes within `radius`."""
+        if self.root is None:
+            return
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            d = levenshtein_distance(string, node[0])
+            if d <= radius and node[1]:
+                yield node[0], node[1], d
+            for distance, child in node[2].items():
+                if d - radius <= distance <= d + radius:
+                    stack.append(child)
+
+    def scan(self, string: str, radius: int):
+        """Same as `search`, comparing every string."""
+        for other, ids, _ in self.nodes.values():
+            if ids:
+                d = levenshtein_distance(string, other, score_cutoff=radius)
+                if d <= radius:
+                    yield other, ids, d
+
+
+class NameIndex:
+    """
+    Names grouped by length in BK-trees. The allowed distance of a match
+    depends on the length of the longest of the two strings, so a search
+    skips the lengths too far from the query's and uses the exact radius
+    of every other length.
+
+    BK-trees only prune well with small radii, the normalized threshold
+    allows a distance of almost half the length, so the trees of long
+    names are scanned, still with the cheap cutoff of the radius.
+    """
+
+    # largest radius a BK-tree is searched with instead of scanned
+    MAX_TREE_RADIUS = 2
+
+    def __init__(self):
+        self.trees = {}  # length -> BKTree
+
+    def add(self, name: str, id):
+        self.trees.setdefault(len(name), BKTree()).add(name, id)
+
+    def remove(self, name: str, id):
+        if len(name) in self.trees:
+            self.trees[len(name)].remove(name, id)
+
+    def search(self, query: str, limit=None, after=None) -> list:
+        """
+        The (id, distance) of the names within MATCH_THRESHOLD, see
+        `score_by_length`.
+        """
+
+        def score(length, tree):
+            longest = max(length, len(query), 1)
+            radius = int(MATCH_THRESHOLD * longest)
+            if abs(length - len(query)) > radius:
+                return
+            if radius <= self.MAX_TREE_RADIUS:
+                found = tree.search(query, radius)
+            else:
+                found = tree.scan(query, radius)
+            for _, ids, d in found:
+                for id in ids:
+                    yield id, d / longest
+
+        return score_by_length(self.trees, query, score, limit, after)
+
+
+class SearchIndex:
+    """
+    In-memory NameIndex over a column of normalized names. It is built
+    from the database the first time it is searched and then kept up to
+    date by the views that create, rename and delete rows. Every worker
+    process has its own copy.
+    """
+
+    def __init__(self, column):
+        self.model = column.class_
+        self.column = column
+        self.index = None
+        self.names = {}  # id -> normalized name
+        self.lock = threading.Lock()
+
+    def build(self, session: scoped_session):
+        index = NameIndex()
+        names = {}
+        for id, name in session.execute(select(self.model.id, self.column)):
+            names[id] = name
+            index.add(name, id)
+        self.index, self.names = index, names
+
+    def put(self, id, name: str):
+        """Add a row or update its name, ignored until the index is built."""
+        with self.lock:
+            if self.index is None:
+                return
+            self._remove(id)
+            self.names[id] = normalize(name)
+            self.index.add(self.names[id], id)
+
+    def discard(self, id):
+        with self.lock:
+            if self.index is not None:
+                self._remove(id)
+
+    def _remove(self, id):
+        name = self.names.pop(id, None)
+        if name is not None:
+            self.index.remove(name, id)
+
+    def search(
+        self, session: scoped_session, query: str, limit=None, after=None
+    ) -> list:
+        """The (id, distance) within MATCH_THRESHOLD of the normalized query."""
+        with self.lock:
+            if self.index is None:
+                self.build(session)
+            return self.index.search(query, limit, after)
+
+
+def get_search_index(column) -> SearchIndex:
+    """The BK-tree of a column, e.g. `get_search_index(User.username)`."""
+    indexes = current_app.extensions.setdefault("search_indexes", {})
+    key = f"{column.class_.__tablename__}.{column.key}"
+    if key not in indexes:
+        indexes[key] = SearchIndex(column)
+    return indexes[key]
+
+
+def text_search_query(query: str):
+    """
+    tsquery matching the documents with every word of a query typed in the
+    search box, stemmed in spanish or as it is.
+    """
+    tsquery = None
+    for config in SEARCH_CONFIGS:
+        part = func.websearch_to_tsquery(cast(config, REGCONFIG), query)
+        tsquery = part if tsquery is None else tsquery.op("||")(part)
+    return tsquery
+
+
+def length_window(length: int):
+    """
+    Lengths a name can have to be within MATCH_THRESHOLD of a query of the
+    given length. The distance is at least the difference of the lengths,
+    so shorter names need length >= (1 - MATCH_THRESHOLD) * len(query) and
+    longer ones length <= len(query) / (1 - MATCH_THRESHOLD).
+    """
+    # the epsilon keeps exact bounds from being lost to rounding
+    shortest = math.ceil(length * (1 - MATCH_THRESHOLD) - 1e-9)
+    longest = math.floor(length / (1 - MATCH_THRESHOLD) + 1e-9)
+    return shortest, longest
+
+
+def match_distance(name: str, query: str):
+    """
+    Normalized distance between a name and the query, or None when it is
+    above MATCH_THRESHOLD. The Levenshtein computation stops as soon as it
+    goes over the allowed distance.
+    """
+    longest = max(len(name), len(query), 1)
+    cutoff = int(MATCH_THRESHOLD * longest)
+    d = levenshtein_distance(name, query, score_cutoff=cutoff)
+    return d / longest if d <= cutoff else None
+
+
+def length_bound(length: int, query_length: int) -> float:
+    """
+    Lowest normalized distance between a query and a name of the given
+    length, as every character of difference has to be inserted.
+    """
+    return abs(length - query_length) / max(length, query_length, 1)
+
+
+def best_matches(scored, limit=None, after=None):
+    """
+    The (id, distance) pairs sorted from the best match, ties by id, only
+    the ones after the (distance, id) `after` cursor. With a limit only the
+    best `limit` ones are kept, with a heap.
+    """
+    if after is not None:
+        scored = (match for match in scored if (match[1], match[0]) > after)
+    if limit is None:
+        return sorted(scored, key=lambda match: (match[1], match[0]))
+    return heapq.nsmallest(limit, scored, key=lambda match: (match[1], match[0]))
+
+
+def score_by_length(groups: dict, query: str, score, limit=None, after=None):
+    """
+    `best_matches` of names grouped by length, `score(length, group)`
+    yields the (id, distance) of a group within MATCH_THRESHOLD.
+
+    The groups are scored from the lengths closest to the query's. With a
+    limit, scoring stops as soon as `limit` matches are closer than the
+    `length_bound` of the next group, none of its names can beat them.
+    """
+    matches = []
+    for length in sorted(groups, key=lambda length: length_bound(length, len(query))):
+        if limit is not None and len(matches) >= limit:
+            matches = best_matches(matches, limit)
+            if matches[-1][1] < length_bound(length, len(query)):
+                break
+        matches.extend(
+            match
+            for match in score(length, groups[length])
+            if after is None or (match[1], match[0]) > after
+        )
+    return best_matches(matches, limit)
+
+
+def score_names(names, query: str, limit=None, after=None) -> list:
+    """
+    `best_matches` of the (id, name) pairs read from the database, scored
+    all at once by `batch_distances`.
+    """
+    names = list(names)
+    distances = batch_distances(query, [name for _, name in names], MATCH_THRESHOLD)
+    ids = [id for id, _ in names]
+    return top_matches(ids, distances, MATCH_THRESHOLD, limit, after)
+
+
+def candidate_names(model, column, query: str):
+    """
+    The (id, name) of the rows of `model` that may be within
+    MATCH_THRESHOLD of the normalized query: the names whose length is in
+    its window (the `<column>_length` column).
+
+    No trigram similarity can narrow them down further without losing
+    matches: every edit changes up to 3 trigrams, so names 45% away from
+    the query may share almost none with it, "cat" and "bat" only share "at ".
+    """
+    length = getattr(model, f"{column.key}_length")
+    shortest, longest = length_window(len(query))
+    return select(model.id, column).where(length.between(shortest, longest))
+
+
+def fuzzy_search(
+    session: scoped_session,
+    model,
+    column,
+    query: str,
+    options=(),
+    limit=None,
+    after=None,
+):
+    """
+    Rows of `model` whose `column`, of normalized names, is within
+    MATCH_THRESHOLD of the query, as (row, distance) pairs sorted from the
+    best match, ties by id. At most `limit` of them are returned, after the
+    (distance, id) `after` cursor.
+
+    The candidates come from the in-memory BK-tree when SEARCH_BACKEND is
+    "bktree", or else from `candidate_names`. Only the rows returned are
+    loaded, with `options`.
+    """
+    query = normalize(query)
+
+    if current_app.config["SEARCH_BACKEND"] == "bktree":
+        matches = get_search_index(column).search(session, query, limit, after)
+        return _load(session, model, matches, options)
+
+    names = session.execute(candidate_names(model, column, query))
+    return _load(session, model, score_names(names, query, limit, after), options)
+
+
+def fuzzy_search_many(session: scoped_session, searches, query: str, limit=None):
+    """
+    `fuzzy_search` in several tables at once. `searches` is a list of
+    (model, column, options) and the (row, distance) pairs of each one are
+    returned in a list, in the same order, at most `limit` per table.
+
+    The candidate names of every table are read with a single UNION ALL
+    query, and then the rows of each table with one query.
+    """
+    query = normalize(query)
+
+    if current_app.config["SEARCH_BACKEND"] == "bktree":
+        scored = [
+            get_search_index(column).search(session, query, limit)
+            for _, column, _ in searches
+        ]
+    else:
+        selects = [
+            candidate_names(model, column, query).add_columns(
+                literal(i).label("search")
+            )
+            for i, (model, column, _) in enumerate(searches)
+        ]
+        names = [[] for _ in searches]
+        for id, name, i in session.execute(union_all(*selects)):
+            names[i].append((id, name))
+        scored = [score_names(group, query, limit) for group in names]
+
+    return [
+        _load(session, model, matches, options)
+        for (model, _, options), matches in zip(searches, scored)
+    ]
+
+
+def _load(session: scoped_session, model, matches, options):
+    """Replace the ids of (id, distance) pairs by their rows, in order."""
+    if not matches:
+        return []
+    rows = session.scalars(
+        select(model)
+        .options(*options)
+        .where(model.id.in_([id for id, _ in matches]))
+    ).all()
+    by_id = {row.id: row for row in rows}
+    return [(by_id[id], distance) for id, distance in matches if id in by_id]
+
+
+class SearchCache:
+    """
+    Results of the fuzzy searches, as the ranked (id, distance) pairs of a
+    normalized query, and the serialized rows they are shown with.
+
+    Every table has a catalogue version that the views bump when a row is
+    created, renamed or deleted. It is part of the keys of the results, so
+    a change leaves the older results unused until they are evicted. The
+    versions are per process, so results also expire after a TTL to pick
+    up the changes made in other processes.
+    """
+
+    def __init__(self, size: int, entity_size: int, ttl: float):
+        self.results = LRUCache(size, ttl=ttl)
+        self.entities = LRUCache(entity_size, ttl=ttl)
+        self.versions = {}  # table -> version
+        self.time_saved = 0.0
+        self.lock = threading.Lock()
+
+    def version(self, table: str) -> int:
+        return self.versions.get(table, 0)
+
+    def bump(self, table: str):
+        """Invalidate the results of a table after a row changed its name."""
+        with self.lock:
+            self.versions[table] = self.version(table) + 1
+
+    def invalidate(self, table: str, id):
+        """Forget a row that changed, e.g. its description."""
+        self.entities.invalidate((table, str(id)))
+
+    def stats(self) -> dict:
+        stats = self.results.stats()
+        lookups = stats["hits"] + stats["misses"]
+        return {
+            **stats,
+            "hit_rate": round(stats["hits"] / lookups, 4) if lookups else None,
+            "time_saved_ms": round(self.time_saved * 1000, 2),
+            "entities": self.entities.stats(),
+        }
+
+
+def init_search_cache(app):
+    app.extensions["search_cache"] = SearchCache(
+        app.config["SEARCH_CACHE_SIZE"],
+        app.config["SEARCH_CACHE_ENTITIES"],
+        app.config["SEARCH_CACHE_TTL"],
+    )
+
+
+def get_search_cache() -> SearchCache:
+    return current_app.extensions["search_cache"]
+
+
+def cached_fuzzy_search(
+    session: scoped_session,
+    model,
+    column,
+    query: str,
+    serialize,
+    options=(),
+    limit=None,
+    after=None,
+):
+    """
+    `fuzzy_search` with the SearchCache, returns (serialize(row), distance)
+    pairs. On a hit only the rows missing from the cache are loaded.
+    """
+    cache = get_search_cache()
+    table = model.__tablename__
+    key = (table, column.key, normalize(query), limit, after, cache.version(table))
+    start = time.perf_counter()
+
+    def put_entity(row):
+        data = serialize(row)
+        entity = (table, str(row.id))
+        cache.entities.put(entity, data, 1, group=entity)
+        return data
+
+    cached = cache.results.get(key)
+    if cached is None:
+        matches = fuzzy_search(session, model, column, query, options, limit, after)
+        results = [(put_entity(row), distance) for row, distance in matches]
+        ids = [(row.id, distance) for row, distance in matches]
+        cache.results.put(key, (ids, time.perf_counter() - start), 1)
+        return results
+
+    ids, elapsed = cached
+    found = {id: cache.entities.get((table, str(id))) for id, _ in ids}
+    missing = [id for id, data in found.items() if data is None]
+    if missing:
+        rows = session.scalars(
+            select(model).options(*options).where(model.id.in_(missing))
+        ).all()
+        for row in rows:
+            found[row.id] = put_entity(row)
+    with cache.lock:
+        cache.time_saved += max(elapsed - (time.perf_counter() - start), 0)
+    # rows deleted since the results were cached are skipped
+    return [(found[id], distance) for id, distance in ids if found[id] is not None]
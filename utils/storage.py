@@ -0,0 +1,192 @@
+import hashlib
+import io
+import os
+import tempfile
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from typing import BinaryIO, Iterator, NamedTuple
+
+from flask import Flask, current_app
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class StoredBlob(NamedTuple):
+    key: str
+    size: int
+    checksum: str  # sha256 of the content, hex encoded
+
+
+class BlobStore(ABC):
+    """
+    Content-addressed storage for media (audio, covers and avatars).
+    Blobs are immutable: the key is derived from the sha256 of the
+    content, so storing the same bytes twice returns the same key.
+    """
+
+    @abstractmethod
+    def put(self, stream: BinaryIO) -> StoredBlob:
+        ...
+
+    @abstractmethod
+    def open(self, key: str) -> BinaryIO:
+        ...
+
+    @abstractmethod
+    def read(self, key: str, offset: int, length: int) -> bytes:
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    def keys(self, before: datetime) -> Iterator[str]:
+        """The keys of the blobs last written before `before`."""
+
+    def put_bytes(self, data: bytes) -> StoredBlob:
+        return self.put(io.BytesIO(data))
+
+
+def _spool(stream: BinaryIO, directory=None):
+    """
+    Copy a stream to a temporary file chunk by chunk while hashing it.
+    Returns the open temporary file (positioned at the start), the size
+    and the sha256 digest.
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    tmp = tempfile.NamedTemporaryFile(dir=directory, delete=False)
+    try:
+        while chunk := stream.read(COPY_CHUNK_SIZE):
+            sha256.update(chunk)
+            tmp.write(chunk)
+            size += len(chunk)
+        tmp.flush()
+        tmp.seek(0)
+    except BaseException:
+        tmp.close()
+        os.unlink(tmp.name)
+        raise
+    return tmp, size, sha256.hexdigest()
+
+
+class LocalBlobStore(BlobStore):
+    """
+    Stores every blob in a file named after its checksum, sharded in two
+    levels of directories (ab/cd/abcd...) to keep directories small.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def put(self, stream: BinaryIO) -> StoredBlob:
+        tmp, size, checksum = _spool(stream, os.path.join(self.root, "tmp"))
+        tmp.close()
+        key = f"{checksum[:2]}/{checksum[2:4]}/{checksum}"
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # the rename is atomic, readers never see a half written blob
+        os.replace(tmp.name, path)
+        return StoredBlob(key, size, checksum)
+
+    def open(self, key: str) -> BinaryIO:
+        return open(self._path(key), "rb")
+
+    def read(self, key: str, offset: int, length: int) -> bytes:
+        with self.open(key) as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def keys(self, before: datetime) -> Iterator[str]:
+        for directory, subdirectories, names in os.walk(self.root):
+            if directory == self.root and "tmp" in subdirectories:
+                subdirectories.remove("tmp")  # blobs being written
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    mtime = os.path.getmtime(path)
+                except FileNotFoundError:
+                    continue  # deleted meanwhile
+                if datetime.fromtimestamp(mtime, timezone.utc) < before:
+                    yield os.path.relpath(path, self.root).replace(os.sep, "/")
+
+
+class S3BlobStore(BlobStore):
+    """
+    Stores blobs in an S3 compatible bucket. `client` only needs the
+    put_object, get_object, delete_object and list_objects_v2 calls of a
+    boto3 S3 client, so any local stand-in implementing them works as well.
+    """
+
+    def __init__(self, client, bucket: str, prefix: str = ""):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def put(self, stream: BinaryIO) -> StoredBlob:
+        tmp, size, checksum = _spool(stream)
+        key = f"{checksum[:2]}/{checksum[2:4]}/{checksum}"
+        try:
+            self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=tmp)
+        finally:
+            tmp.close()
+            os.unlink(tmp.name)
+        return StoredBlob(key, size, checksum)
+
+    def open(self, key: str) -> BinaryIO:
+        return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)[
+            "Body"
+        ]
+
+    def read(self, key: str, offset: int, length: int) -> bytes:
+        if length <= 0:  # there is no range for it
+            return b""
+        body = self.client.get_object(
+            Bucket=self.bucket,
+            Key=self.prefix + key,
+            Range=f"bytes={offset}-{offset + length - 1}",
+        )["Body"]
+        return body.read()
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def keys(self, before: datetime) -> Iterator[str]:
+        params = {"Bucket": self.bucket, "Prefix": self.prefix}
+        while True:
+            response = self.client.list_objects_v2(**params)
+            for blob in response.get("Contents", []):
+                if blob["LastModified"] < before:
+                    yield blob["Key"].removeprefix(self.prefix)
+            if not response.get("IsTruncated"):
+                return
+            params["ContinuationToken"] = response["NextContinuationToken"]
+
+
+def init_blob_store(app: Flask):
+    if app.config["BLOB_STORE"] == "s3":
+        import boto3  # only needed by deployments storing media in S3
+
+        client = boto3.client("s3", endpoint_url=app.config["S3_ENDPOINT_URL"])
+        store = S3BlobStore(
+            client, app.config["S3_BUCKET"], app.config["S3_PREFIX"]
+        )
+    else:
+        store = LocalBlobStore(app.config["BLOB_STORE_PATH"])
+    app.extensions["blob_store"] = store
+
+
+def get_blob_store() -> BlobStore:
+    return current_app.extensions["blob_store"]
+
@@ -0,0 +1,217 @@
+import os
+import shutil
+import tempfile
+import uuid
+from datetime import datetime, timezone
+
+from flask import Request
+from sqlalchemy import select
+from sqlalchemy.orm import scoped_session
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from werkzeug.sansio.multipart import (
+    NEED_DATA,
+    Data,
+    Epilogue,
+    Field,
+    File,
+    MultipartDecoder,
+)
+
+from models import UploadSession
+
+READ_CHUNK_SIZE = 64 * 1024
+# spooled uploads bigger than this are moved from memory to a temporary file
+SPOOL_MEMORY_SIZE = 1024 * 1024
+
+
+class StreamingUpload:
+    """
+    Incremental reader of a multipart/form-data request body.
+
+    Form fields are collected as they arrive and files are exposed as
+    streams, so a view can validate the fields sent before a file without
+    reading the file at all, and then copy the file to the blob store
+    chunk by chunk while its size is checked.
+    """
+
+    def __init__(self, request: Request, max_file_size: int):
+        self.max_file_size = max_file_size
+        if request.mimetype != "multipart/form-data":
+            self.form = MultiDict(request.form)
+            self._events = iter(())
+            return
+        boundary = request.mimetype_params.get("boundary")
+        if not boundary:
+            raise BadRequest("Missing multipart boundary")
+        self.form = MultiDict()
+        self._stream = request.stream
+        self._decoder = MultipartDecoder(boundary.encode())
+        self._events = self._iter_events()
+
+    def _iter_events(self):
+        while True:
+            event = self._decoder.next_event()
+            if event is NEED_DATA:
+                chunk = self._stream.read(READ_CHUNK_SIZE)
+                try:
+                    self._decoder.receive_data(chunk or None)
+                except ValueError:
+                    raise BadRequest("Malformed multipart body")
+                continue
+            if isinstance(event, Epilogue):
+                return
+            yield event
+
+    def _read_data(self):
+        """Yield the data of the part whose headers were just read."""
+        for event in self._events:
+            if isinstance(event, Data):
+                yield event.data
+                if not event.more_data:
+                    return
+
+    def _next_file(self):
+        """Collect the fields up to the next file part and return it."""
+        for event in self._events:
+            if isinstance(event, Field):
+                value = b"".join(self._read_data()).decode()
+                self.form.add(event.name, value)
+            elif isinstance(event, File):
+                return event
+        return None
+
+    def open_file(self, name: str, required_fields=()):
+        """
+        Read the body up to the file called `name` and return a stream of
+        its content, or None when the file was not sent. When a field in
+        `required_fields` has not arrived before the file, the file is
+        spooled and the rest of the body is read, so the caller can always
+        validate those fields before storing the file.
+        """
+        while (part := self._next_file()) is not None:
+            if part.name != name or not part.filename:
+                for _ in self._read_data():  # not expected, skip it
+                    pass
+                continue
+            stream = _FileStream(self._read_data(), self.max_file_size)
+            if all(field in self.form for field in required_fields):
+                return stream
+            spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_SIZE)
+            shutil.copyfileobj(stream, spooled, READ_CHUNK_SIZE)
+            spooled.seek(0)
+            self.finish()
+            return spooled
+        return None
+
+    def finish(self):
+        """Read the remaining fields, skipping any other file."""
+        while self._next_file() is not None:
+            for _ in self._read_data():
+                pass
+
+
+class _FileStream:
+    """Readable file object over the data of a multipart file part."""
+
+    def __init__(self, chunks, max_size: int):
+        self.chunks = chunks
+        self.max_size = max_size
+        self.received = 0
+        self.buffer = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.received += len(chunk)
+            if self.received > self.max_size:
+                raise RequestEntityTooLarge()
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+def chunk_path(root: str, id_upload, index: int) -> str:
+    return os.path.join(root, str(id_upload), str(index))
+
+
+def write_chunk(root: str, id_upload, index: int, stream, max_size: int) -> int:
+    """
+    Copy the body of a chunk request to disk, replacing a previous attempt
+    of the same chunk. Returns the size of the chunk.
+    """
+    path = chunk_path(root, id_upload, index)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    source = _FileStream(iter(lambda: stream.read(READ_CHUNK_SIZE), b""), max_size)
+    tmp = f"{path}.part"
+    try:
+        with open(tmp, "wb") as f:
+            shutil.copyfileobj(source, f, READ_CHUNK_SIZE)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    os.replace(tmp, path)
+    return source.received
+
+
+class ChunkReader:
+    """Readable file object over the chunks of an upload, in order."""
+
+    def __init__(self, paths):
+        self.paths = iter(paths)
+        self.current = None
+
+    def read(self, size=-1):
+        while True:
+            if self.current is None:
+                path = next(self.paths, None)
+                if path is None:
+                    return b""
+                self.current = open(path, "rb")
+            data = self.current.read(size)
+            if data or size == 0:
+                return data
+            self.current.close()
+            self.current = None
+
+
+def delete_upload(root: str, upload: UploadSession, session: scoped_session):
+    shutil.rmtree(os.path.join(root, str(upload.id)), ignore_errors=True)
+    session.delete(upload)
+    session.commit()
+
+
+def delete_expired_uploads(root: str, session: scoped_session) -> int:
+    """
+    Garbage collect the sessions abandoned before being finalized, and the
+    chunks left behind by sessions deleted with their podcast or user.
+    """
+    expired = session.scalars(
+        select(UploadSession).where(UploadSession.expires_at < datetime.now(timezone.utc))
+    ).all()
+    for upload in expired:
+        delete_upload(root, upload, session)
+
+    # listed before the query, a directory is only created for a session
+    # that already exists
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        names = []
+    ids = set()
+    for name in names:
+        try:
+            ids.add(uuid.UUID(name))
+        except ValueError:
+            continue  # not a directory of the uploads
+    existing = set(
+        session.scalars(select(UploadSession.id).where(UploadSession.id.in_(ids)))
+    )
+    for id in ids - existing:
+        shutil.rmtree(os.path.join(root, str(id)), ignore_errors=True)
+    return len(expired)